@@ -1,18 +1,59 @@
 """
 Empirical Land Surface model generation, run, and evaluation library
-"""
 
+Submodules are imported on first use (PEP 562), so lightweight uses such as
+prediction-only workers don't pay for the plotting and data loading libraries.
+Entry points call init() to set the pals_utils config defaults (and the plot
+style) that used to be set as import side effects.
+"""
 
-from . import models
-from . import evaluate
-from . import plots
-from . import clusterregression
-from . import transforms
-from . import data
-from . import gridded_datasets
-from . import offline_simulation
-from . import offline_eval
+import importlib
 
 
 __all__ = ["models", "evaluate", "plots", "clusterregression", "transforms",
-           "data", "gridded_datasets", "offline_simulation", "offline_eval"]
+           "data", "gridded_datasets", "gridded_prediction", "offline_simulation",
+           "offline_eval"]
+
+# pals_utils config defaults, see init_config
+DEFAULT_CONFIG = [
+    (['datasets', 'train'], 'PLUMBER_ext'),
+    (['qc_format'], 'PALS'),
+]
+
+
+def init_config(overwrite=True):
+    """Set the pals_utils config defaults (DEFAULT_CONFIG)
+
+    :overwrite: replace values that are already set. Without it, only missing values
+        are set (as a fallback for code that needs the config before init() is called).
+    """
+    from pals_utils.data import get_config, set_config
+
+    for keys, value in DEFAULT_CONFIG:
+        if not overwrite:
+            try:
+                get_config(keys)
+                continue
+            except KeyError:
+                pass
+        set_config(keys, value)
+
+
+def init(plots=False):
+    """Explicit initialisation for scripts: config defaults, and optionally the plot style"""
+    init_config()
+    if plots:
+        from empirical_lsm.plots import set_style
+        set_style()
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {m!r} has no attribute {n!r}".format(m=__name__, n=name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: catalogue.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: SQLite catalogue of pipeline artefacts.
+
+Every simulation, metric, figure and rst file is recorded with its model, site,
+mtime, size and content hash when it's written, so discovery (which models have
+simulations, which sites have metrics, when a model page last changed) is an indexed
+query instead of a filesystem scan. The catalogue is built from a full scan the first
+time it's used (under a file lock, so concurrent workers don't scan twice), and can
+be rebuilt with rebuild_catalogue() if files are changed outside the pipeline.
+Simulations in consolidated files are recorded per site, with the hash and size of
+their own netCDF group, so writing one site doesn't rehash the whole file.
+"""
+
+import os
+import sqlite3
+import hashlib
+import netCDF4
+
+from contextlib import closing
+from datetime import datetime as dt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CATALOGUE_PATH = 'cache/catalogue.sqlite'
+
+SIM_DIR = 'model_data'
+SOURCE_DIR = 'source/models'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artefacts (
+    path TEXT NOT NULL,
+    site TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    hash TEXT,
+    recorded TEXT,
+    PRIMARY KEY (path, site)
+);
+CREATE INDEX IF NOT EXISTS artefacts_kind_model ON artefacts (kind, model, site);
+CREATE INDEX IF NOT EXISTS artefacts_model ON artefacts (model, mtime);
+"""
+
+# Catalogues created or checked by this process, by absolute path
+_initialised = set()
+
+
+def connect(path=None):
+    """Connect to the catalogue, creating and populating it if it doesn't exist"""
+    # imported here, sim_store imports this module
+    from empirical_lsm.sim_store import file_lock
+
+    if path is None:
+        path = CATALOGUE_PATH
+    key = os.path.abspath(path)
+    if key in _initialised and os.path.exists(path):
+        return sqlite3.connect(path, timeout=60)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # other processes wait here until the first scan is complete
+    with file_lock(path):
+        exists = os.path.exists(path)
+        conn = sqlite3.connect(path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        if not exists:
+            scan_artefacts(conn)
+    _initialised.add(key)
+
+    return conn
+
+
+def parse_artefact_path(path):
+    """Get the kind, model and site of an artefact from its path
+
+    :returns: (kind, model, site) tuple, site may be None. None if path isn't a known artefact.
+    """
+    parts = os.path.normpath(path).split(os.sep)
+
+    if len(parts) == 3 and parts[0] == SIM_DIR and parts[2].endswith('.nc'):
+        model = parts[1]
+        base = parts[2][:-3]
+        if base == model:
+            # consolidated model file, sites are recorded separately
+            return ('sim', model, None)
+        elif base.startswith(model + '_'):
+            return ('sim', model, base[len(model) + 1:])
+
+    source_parts = SOURCE_DIR.split('/')
+    if parts[:2] == source_parts and len(parts) >= 4:
+        model = parts[2]
+        filename = parts[-1]
+        if parts[3] == 'metrics' and len(parts) == 5 and filename.endswith('_metrics.csv'):
+            return ('metrics', model, filename[len(model) + 1:-len('_metrics.csv')])
+        if parts[3] == 'figures' and filename.endswith('.png'):
+            return ('figure', model, parts[4] if len(parts) == 6 else None)
+        if len(parts) == 4 and filename.endswith('.rst'):
+            if filename == 'index.rst':
+                return ('rst', model, None)
+            return ('rst', model, filename[len(model) + 1:-len('.rst')])
+
+    return None
+
+
+def file_hash(path, blocksize=2 ** 20):
+    """sha1 of a file's contents"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def group_hash(path, group):
+    """sha1 and size in bytes of one netCDF group's variables and attributes"""
+    from empirical_lsm.sim_store import file_lock
+
+    sha = hashlib.sha1()
+    size = 0
+    with file_lock(path, shared=True), netCDF4.Dataset(path) as ds:
+        g = ds.groups[group]
+        for name in sorted(g.ncattrs()):
+            sha.update(('%s=%r' % (name, g.getncattr(name))).encode())
+        for name in sorted(g.variables):
+            var = g.variables[name]
+            var.set_auto_mask(False)
+            data = var[...]
+            sha.update(name.encode())
+            sha.update(data.tobytes())
+            size += data.nbytes
+
+    return sha.hexdigest(), size
+
+
+def _artefact_row(path, site=None):
+    parsed = parse_artefact_path(path)
+    if parsed is None:
+        return None
+    kind, model, path_site = parsed
+    stat = os.stat(path)
+    if kind == 'sim' and path_site is None and site is not None:
+        # one site in a consolidated file
+        content_hash, size = group_hash(path, site)
+    else:
+        content_hash, size = file_hash(path), stat.st_size
+    if site is None:
+        site = path_site
+
+    return (os.path.normpath(path), site or '', kind, model, stat.st_mtime, size,
+            content_hash, str(dt.now()))
+
+
+def _insert_rows(conn, rows):
+    conn.executemany("INSERT OR REPLACE INTO artefacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def record_artefact(path, site=None):
+    """Record a newly written artefact in the catalogue
+
+    :site: site name, for files holding one of many sites (consolidated simulations)
+    """
+    row = _artefact_row(path, site)
+    if row is None:
+        logger.debug("Not a catalogued artefact path: {p}".format(p=path))
+        return
+
+    with closing(connect()) as conn, conn:
+        _insert_rows(conn, [row])
+
+
+def remove_artefact(path, site=None):
+    """Remove an artefact from the catalogue (the file itself is not touched)"""
+    with closing(connect()) as conn, conn:
+        if site is None:
+            conn.execute("DELETE FROM artefacts WHERE path = ?", (os.path.normpath(path),))
+        else:
+            conn.execute("DELETE FROM artefacts WHERE path = ? AND site = ?", (os.path.normpath(path), site))
+
+
+def _consolidated_sites(path):
+    from empirical_lsm.sim_store import file_lock
+
+    with file_lock(path, shared=True), netCDF4.Dataset(path) as ds:
+        return list(ds.groups)
+
+
+def scan_artefacts(conn):
+    """Record all artefacts on disk (a full filesystem scan)"""
+    t_start = dt.now()
+    rows = []
+    for top in [SIM_DIR, SOURCE_DIR]:
+        for dirpath, dirnames, filenames in os.walk(top):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                parsed = parse_artefact_path(path)
+                if parsed is None:
+                    continue
+                if parsed[0] == 'sim' and parsed[2] is None:
+                    rows.extend(_artefact_row(path, s) for s in _consolidated_sites(path))
+                else:
+                    rows.append(_artefact_row(path))
+
+    with conn:
+        _insert_rows(conn, rows)
+
+    logger.info("Catalogued {n} artefacts in {t:.1f}s".format(n=len(rows), t=(dt.now() - t_start).total_seconds()))
+
+
+def rebuild_catalogue():
+    """Rebuild the catalogue from scratch, from a full filesystem scan"""
+    with closing(connect()) as conn:
+        with conn:
+            conn.execute("DELETE FROM artefacts")
+        scan_artefacts(conn)
+
+
+def _query(sql, args=()):
+    with closing(connect()) as conn:
+        return conn.execute(sql, args).fetchall()
+
+
+def list_models(kinds=None):
+    """Models with artefacts of any of the given kinds, sorted
+
+    :kinds: list of artefact kinds ('sim', 'metrics', 'figure', 'rst'), or None for all
+    """
+    if kinds is None:
+        rows = _query("SELECT DISTINCT model FROM artefacts ORDER BY model")
+    else:
+        rows = _query("SELECT DISTINCT model FROM artefacts WHERE kind IN ({k}) ORDER BY model"
+                      .format(k=','.join('?' * len(kinds))), list(kinds))
+
+    return [r[0] for r in rows]
+
+
+def list_sites(model, kind):
+    """Sites with an artefact of the given kind for a model, sorted"""
+    rows = _query("SELECT DISTINCT site FROM artefacts WHERE kind = ? AND model = ? AND site != '' ORDER BY site",
+                  (kind, model))
+
+    return [r[0] for r in rows]
+
+
+def list_artefacts(kind, model=None, site=None):
+    """Catalogued artefacts of a kind, optionally for one model and/or site
+
+    :returns: list of dicts with path, site, kind, model, mtime, size and hash
+    """
+    sql = "SELECT path, site, kind, model, mtime, size, hash FROM artefacts WHERE kind = ?"
+    args = [kind]
+    if model is not None:
+        sql += " AND model = ?"
+        args.append(model)
+    if site is not None:
+        sql += " AND site = ?"
+        args.append(site)
+    sql += " ORDER BY path, site"
+
+    keys = ['path', 'site', 'kind', 'model', 'mtime', 'size', 'hash']
+    return [dict(zip(keys, r)) for r in _query(sql, args)]
+
+
+def newest_mtime(model, kinds=None, exclude=()):
+    """Most recent mtime of a model's artefacts (0 if there are none)
+
+    :exclude: paths to ignore (e.g. the file being rebuilt)
+    """
+    sql = "SELECT MAX(mtime) FROM artefacts WHERE model = ?"
+    args = [model]
+    if kinds is not None:
+        sql += " AND kind IN ({k})".format(k=','.join('?' * len(kinds)))
+        args.extend(kinds)
+    if len(exclude) > 0:
+        sql += " AND path NOT IN ({p})".format(p=','.join('?' * len(exclude)))
+        args.extend(os.path.normpath(p) for p in exclude)
+
+    result = _query(sql, args)[0][0]
+
+    return 0 if result is None else result
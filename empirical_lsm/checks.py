@@ -12,7 +12,8 @@ import os
 import numpy as np
 
 import pandas as pd
-import xarray as xr
+
+from empirical_lsm.sim_store import sim_exists, open_sim
 
 import logging
 logger = logging.getLogger(__name__)
@@ -62,12 +63,11 @@ def check_model_data(models, sites):
     for model in models:
         print('Checking {m}:'.format(m=model))
         for site in sites:
-            file_path = 'model_data/{m}/{m}_{s}.nc'.format(m=model, s=site)
-            if not os.path.exists(file_path):
+            if not sim_exists(model, site):
                 logger.warning('missing model run: {m} at {s}', dict(m=model, s=site))
                 print('x', end='', flush=True)
                 continue
-            with xr.open_dataset(file_path) as ds:
+            with open_sim(model, site) as ds:
                 try:
                     model_sanity_check(ds, model, site)
                 except RuntimeError as e:
@@ -8,8 +8,13 @@ Original code by jnorthman: https://gist.github.com/jnothman/566ebde618ec18f2bea
 
 import numpy as np
 
+from collections import OrderedDict
+from datetime import datetime as dt
+
 from sklearn.base import BaseEstimator, clone
-from sklearn.utils import safe_mask
+from sklearn.utils import safe_mask, check_random_state
+
+from empirical_lsm.instrument import stage, timed
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,16 +28,122 @@ class ModelByCluster(BaseEstimator):
     :clusterer: scikit-learn style clustering model
 
     :regression: scikit-learn style regression model
+
+    :cluster_sample: if set, fit the clusterer on a stratified (per-site) subsample
+        of the data, then assign all rows and fit the regressions on the full data.
+        An int is a total number of samples, a float is a fraction of the data.
+
+    :chunk_size: number of rows to assign to clusters at a time
+
+    :random_state: seed for the cluster subsample
+
+    :min_cluster_size: if set, clusters with fewer training samples than this are
+        merged into their nearest populated neighbour, and get no regression of their own.
+        Clusters with no training samples (e.g. for a variable missing in part of the
+        data) are always merged, so that no test rows are left without a regression.
     """
 
-    def __init__(self, clusterer, estimator):
+    shared_features_ok = True
+
+    def __init__(self, clusterer, estimator, cluster_sample=None, chunk_size=100000,
+                 random_state=None, min_cluster_size=None):
         self.clusterer = clusterer
         self.estimator = estimator
+        self.cluster_sample = cluster_sample
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+        self.min_cluster_size = min_cluster_size
 
     def fit(self, X, y):
+        self.fit_times_ = {}
+
+        clusters, cluster_ids = self._fit_clusters(X)
+
+        self.cluster_counts_ = np.bincount(clusters, minlength=self.clusterer_.n_clusters)
+        self.cluster_map_ = self._merge_small_clusters(X, clusters, self.cluster_counts_)
+        if not np.array_equal(self.cluster_map_, np.arange(len(self.cluster_map_))):
+            clusters = self.cluster_map_[clusters]
+            cluster_ids = np.unique(clusters)
+
+        t_start = dt.now()
+        self.estimators_ = {}
+        with stage('regression'):
+            for c in cluster_ids:
+                mask = clusters == c
+                est = clone(self.estimator)
+                est.fit(X[safe_mask(X, mask)], y[safe_mask(y, mask)])
+                self.estimators_[c] = est
+        self.fit_times_['regression'] = (dt.now() - t_start).total_seconds()
+
+        logger.info("MBC: clustered {ns} of {n} samples, fit times (s): {t}".format(
+            ns=self.n_cluster_samples_, n=X.shape[0],
+            t=', '.join('%s: %.2f' % (k, v) for k, v in self.fit_times_.items())))
+
+        return self
+
+    def fit_multi(self, X, ys):
+        """Cluster once, then fit regressions for several output variables
+
+        Each output variable gets its own per-cluster regressions, fitted on the rows
+        where that variable is finite. Clusters with too few (or no) samples for a
+        variable are merged into their nearest neighbour for that variable only.
+
+        :X: finite training features
+        :ys: OrderedDict of {variable: y}, y may contain NaNs
+        """
+        self.fit_times_ = {}
+
+        clusters, cluster_ids = self._fit_clusters(X)
+        self.cluster_counts_ = np.bincount(clusters, minlength=self.clusterer_.n_clusters)
+
+        t_start = dt.now()
+        self.multi_cluster_maps_ = OrderedDict()
+        self.multi_estimators_ = OrderedDict()
+        for v, y in ys.items():
+            self._fit_var_estimators(X, clusters, v, y)
+        self.fit_times_['regression'] = (dt.now() - t_start).total_seconds()
+
+        logger.info("MBC: clustered {ns} of {n} samples once for {nv} variables, fit times (s): {t}".format(
+            ns=self.n_cluster_samples_, n=X.shape[0], nv=len(ys),
+            t=', '.join('%s: %.2f' % (k, v) for k, v in self.fit_times_.items())))
+
+        return self
+
+    @timed('regression')
+    def _fit_var_estimators(self, X, clusters, v, y):
+        """Fit per-cluster regressions for one output variable, on its valid rows"""
+        y_ok = np.isfinite(np.asarray(y, dtype=float)).reshape(len(y), -1).all(axis=1)
+        if not y_ok.any():
+            logger.warning("MBC: no valid training data for {v}, it will be predicted as NaN".format(v=v))
+        counts = np.bincount(clusters[y_ok], minlength=self.clusterer_.n_clusters)
+        cluster_map = self._merge_small_clusters(X, clusters, counts)
+        var_clusters = cluster_map[clusters]
+
+        estimators = {}
+        for c in np.unique(var_clusters[y_ok]):
+            mask = (var_clusters == c) & y_ok
+            est = clone(self.estimator)
+            est.fit(X[safe_mask(X, mask)], y[safe_mask(y, mask)])
+            estimators[c] = est
+
+        self.multi_cluster_maps_[v] = cluster_map
+        self.multi_estimators_[v] = estimators
+
+    @timed('cluster')
+    def _fit_clusters(self, X):
+        """Fit the clusterer, and assign all rows of X to clusters
+
+        :returns: (cluster for each row, unique cluster ids)
+        """
+        t_start = dt.now()
         self.clusterer_ = clone(self.clusterer)
+        if self.cluster_sample is None:
+            X_cluster = X
+        else:
+            sample_idx = self._get_sample_index(X)
+            X_cluster = _take_rows(X, sample_idx)
         for i in range(10):
-            clusters = self.clusterer_.fit_predict(X)
+            clusters = self.clusterer_.fit_predict(X_cluster)
             cluster_ids = np.unique(clusters)
 
             if len(cluster_ids) == self.clusterer_.n_clusters:
@@ -43,34 +154,141 @@ class ModelByCluster(BaseEstimator):
                     "MBC: clustering failed after 10 attempts - some clusters have no data.\n" + \
                     "    Probably too little data available: " + \
                     "Only {n} data points for {k} clusters.".format(
-                        n=X.shape[0], k=self.clusterer_.n_clusters)
+                        n=X_cluster.shape[0], k=self.clusterer_.n_clusters)
                 logger.warning("MBC: Clustering failed, trying again")
+        self.fit_times_['cluster'] = (dt.now() - t_start).total_seconds()
+        self.n_cluster_samples_ = X_cluster.shape[0]
 
-        self.estimators_ = {}
-        for c in cluster_ids:
-            mask = clusters == c
-            est = clone(self.estimator)
-            est.fit(X[safe_mask(X, mask)], y[safe_mask(y, mask)])
-            self.estimators_[c] = est
+        if self.cluster_sample is not None:
+            t_start = dt.now()
+            clusters = self._predict_clusters(X)
+            cluster_ids = np.unique(clusters)
+            self.fit_times_['assign'] = (dt.now() - t_start).total_seconds()
 
-        return self
+        return clusters, cluster_ids
+
+    def _get_sample_index(self, X):
+        """Stratified random subsample of rows, proportional to the size of each site
+
+        :X: array or dataframe (with an optional 'site' index level)
+        :returns: sorted array of row positions
+        """
+        n_samples = X.shape[0]
+        if isinstance(self.cluster_sample, float):
+            n_target = int(np.ceil(self.cluster_sample * n_samples))
+        else:
+            n_target = int(self.cluster_sample)
+        if n_target >= n_samples:
+            return np.arange(n_samples)
+
+        rng = check_random_state(self.random_state)
+
+        if hasattr(X, 'index') and 'site' in X.index.names:
+            sites = np.asarray(X.index.get_level_values('site'))
+            strata = [np.flatnonzero(sites == s) for s in np.unique(sites)]
+        else:
+            strata = [np.arange(n_samples)]
+
+        sample_idx = []
+        for rows in strata:
+            n_stratum = int(np.ceil(n_target * len(rows) / n_samples))
+            sample_idx.append(rng.choice(rows, min(n_stratum, len(rows)), replace=False))
+
+        return np.sort(np.concatenate(sample_idx))
+
+    def _merge_small_clusters(self, X, clusters, counts):
+        """Map each empty or under-populated cluster onto its nearest populated cluster
+
+        :X: training data
+        :clusters: cluster assignment for each row of X
+        :counts: number of rows in each cluster
+        :returns: array mapping each cluster id to the cluster id used for regression
+        """
+        cluster_map = np.arange(len(counts))
+        min_size = max(self.min_cluster_size or 1, 1)
+
+        populated = counts >= min_size
+        if not populated.any():
+            populated = counts == counts.max()
+        small = np.flatnonzero(~populated)
+        if len(small) == 0:
+            return cluster_map
+
+        if hasattr(self.clusterer_, 'cluster_centers_'):
+            centers = self.clusterer_.cluster_centers_
+        else:
+            X_values = np.asarray(X)
+            centers = np.full([len(counts), X_values.shape[1]], np.nan)
+            for c in np.flatnonzero(counts):
+                centers[c] = X_values[clusters == c].mean(axis=0)
+
+        targets = np.flatnonzero(populated)
+        for c in small:
+            distances = np.sum((centers[targets] - centers[c]) ** 2, axis=1)
+            if np.isfinite(distances).any():
+                cluster_map[c] = targets[np.nanargmin(distances)]
+            else:
+                cluster_map[c] = targets[np.argmax(counts[targets])]
+
+        logger.info("MBC: merged {n} clusters with fewer than {m} samples: {c}".format(
+            n=len(small), m=min_size,
+            c=', '.join('%d->%d' % (c, cluster_map[c]) for c in small)))
+
+        return cluster_map
+
+    @timed('assign')
+    def _predict_clusters(self, X):
+        """Assign clusters to all rows of X, chunk_size rows at a time"""
+        clusters = np.empty(X.shape[0], dtype=int)
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            clusters[chunk] = self.clusterer_.predict(_take_rows(X, chunk))
+        return clusters
 
     def predict(self, X):
         # this returns -1 if any of the values squared are too large
         # models with numerical instability will fail.
-        clusters = self.clusterer_.predict(X)
+        clusters = self.cluster_map_[self._predict_clusters(X)]
+
+        return self._predict_estimators(X, clusters, self.estimators_)
 
+    def predict_multi(self, X):
+        """Predict all output variables fitted with fit_multi, assigning clusters once
+
+        :returns: OrderedDict of {variable: prediction}
+        """
+        clusters = self._predict_clusters(X)
+
+        return OrderedDict((v, self._predict_estimators(X, self.multi_cluster_maps_[v][clusters], estimators))
+                           for v, estimators in self.multi_estimators_.items())
+
+    @timed('regression_predict')
+    def _predict_estimators(self, X, clusters, estimators):
+        """Predict each cluster's rows with its estimator (rows with no estimator are NaN)
+
+        Without any estimators (a variable with no training data), all rows are NaN.
+        """
         y_tmp = []
         idx = []
-        for c, est in self.estimators_.items():
+        for c, est in estimators.items():
             mask = clusters == c
             if mask.any():
                 idx.append(np.flatnonzero(mask))
                 y_tmp.append(est.predict(X[safe_mask(X, mask)]))
 
+        if len(y_tmp) == 0:
+            return np.full(X.shape[0], np.nan)
+
         y_tmp = np.concatenate(y_tmp)
         idx = np.concatenate(idx)
-        y = np.full([X.shape[0], y_tmp.shape[1]], np.nan)
+        y = np.full([X.shape[0]] + list(y_tmp.shape[1:]), np.nan)
         y[idx] = y_tmp
 
         return y
+
+
+def _take_rows(X, rows):
+    """Select rows by position from an array or a dataframe"""
+    if hasattr(X, 'iloc'):
+        return X.iloc[rows]
+    return X[rows]
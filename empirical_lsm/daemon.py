@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: daemon.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Optional local daemon that runs CLI jobs in warm processes.
+
+Every CLI invocation otherwise pays to import pandas, xarray, sklearn, matplotlib and
+seaborn, and to load the training stores. The daemon (scripts/tools/lsm_daemon.py)
+does that once. It then listens on a Unix socket. Each job is run in a process
+forked from the warm daemon, so it starts with everything already imported and the
+preloaded training stores attached. Pool workers started by the job are forked from
+it in turn, so they're warm too.
+
+The scripts in scripts/offline_runs take a --daemon flag. With it, they send their
+parsed arguments to the daemon, which runs the script's main(args). Log messages are
+streamed back to the caller. Without a running daemon, the script runs locally.
+
+This module only imports the standard library, so clients stay cheap to start.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import importlib
+import importlib.util
+import threading
+import traceback
+import socketserver
+
+logger = logging.getLogger(__name__)
+
+
+DAEMON_CONFIG = dict(
+    socket=os.environ.get('EMPIRICAL_LSM_DAEMON') or 'cache/daemon.sock',
+    # maximum concurrent jobs
+    max_jobs=8,
+)
+
+# Imported by the daemon before it starts listening
+WARM_MODULES = ['numpy', 'pandas', 'xarray', 'sklearn', 'matplotlib', 'seaborn',
+                'empirical_lsm.offline_simulation', 'empirical_lsm.offline_eval',
+                'empirical_lsm.scheduler', 'empirical_lsm.model_search', 'empirical_lsm.checks']
+
+
+class DaemonJobError(RuntimeError):
+    """A job failed in the daemon"""
+    pass
+
+
+def configure(**kwargs):
+    """Update the daemon configuration (see DAEMON_CONFIG)"""
+    for k in kwargs:
+        if k not in DAEMON_CONFIG:
+            raise KeyError("Unknown daemon option: %s" % k)
+    DAEMON_CONFIG.update(kwargs)
+
+
+def get_pid_path(socket_path):
+    return socket_path + '.pid'
+
+
+def _send(f, **message):
+    f.write((json.dumps(message, default=str) + '\n').encode())
+    f.flush()
+
+
+##################
+# Client
+##################
+
+def _connect(socket_path=None):
+    if socket_path is None:
+        socket_path = DAEMON_CONFIG['socket']
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def is_running(socket_path=None):
+    """Whether a daemon is listening on the socket"""
+    try:
+        sock = _connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    sock.close()
+    return True
+
+
+def submit_script(path, args, socket_path=None, log_stream=None):
+    """Run a script's main(args) in the daemon, streaming its log messages
+
+    :path: script file, which must define main(args)
+    :args: parsed (docopt) arguments, must be JSON-serialisable
+    :log_stream: where to write forwarded log messages (default: stderr)
+    :raises DaemonJobError: if the job fails
+    """
+    if log_stream is None:
+        log_stream = sys.stderr
+
+    with _connect(socket_path) as sock, sock.makefile('rwb') as f:
+        _send(f, script=os.path.abspath(path), args=args, cwd=os.getcwd())
+
+        result = None
+        for line in f:
+            message = json.loads(line.decode())
+            if 'log' in message:
+                print(message['log'], file=log_stream)
+            else:
+                result = message
+                break
+
+    if result is None:
+        raise DaemonJobError("Daemon closed the connection before the job finished")
+    if result.get('error') is not None:
+        raise DaemonJobError(result['error'])
+
+
+def run_script(path, main, args, use_daemon=True, socket_path=None):
+    """Run a script's main(args) in the daemon if one is running, and locally otherwise"""
+    if use_daemon:
+        if is_running(socket_path):
+            return submit_script(path, args, socket_path)
+        logger.warning("No daemon running on {s}, running locally".format(
+            s=DAEMON_CONFIG['socket'] if socket_path is None else socket_path))
+
+    return main(args)
+
+
+##################
+# Server
+##################
+
+class _LogForwarder(logging.Handler):
+    """Sends log records to the client"""
+
+    def __init__(self, f):
+        super().__init__(logging.INFO)
+        self.f = f
+        self.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+
+    def emit(self, record):
+        try:
+            _send(self.f, log=self.format(record))
+        except OSError:
+            # client went away, keep running the job
+            pass
+
+
+def run_request(request, f, daemon_cwd):
+    """Run one job request (in a process forked from the daemon)"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    root = logging.getLogger()
+    root.addHandler(_LogForwarder(f))
+    if root.level == logging.NOTSET or root.level > logging.INFO:
+        root.setLevel(logging.INFO)
+
+    if request['cwd'] != daemon_cwd:
+        # preloaded stores are keyed by relative path, so aren't valid elsewhere
+        from empirical_lsm import training_store
+        training_store._attached_stores.clear()
+    os.chdir(request['cwd'])
+
+    t_start = time.time()
+    try:
+        spec = importlib.util.spec_from_file_location('_daemon_script', request['script'])
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        script.main(request['args'])
+    except BaseException:
+        # reported to the client, the daemon carries on
+        _send(f, error=traceback.format_exc(), seconds=time.time() - t_start)
+        return
+    _send(f, error=None, seconds=time.time() - t_start)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            # connection check, see is_running
+            return
+        request = json.loads(line.decode())
+        logger.info("Running {s} in {c}".format(s=request['script'], c=request['cwd']))
+        run_request(request, self.wfile, self.server.cwd)
+
+
+class _ForkingUnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # don't wait for running jobs when stopping
+    block_on_close = False
+
+
+def warm_up(modules=None, preload=()):
+    """Import modules, and attach the training stores for preload models in this process
+
+    :returns: shared memory blocks to release on exit
+    """
+    if modules is None:
+        modules = WARM_MODULES
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except ImportError as e:
+            logger.warning("Couldn't import {m}: {e}".format(m=m, e=e))
+
+    if len(preload) == 0:
+        return []
+
+    from empirical_lsm.models import get_model
+    from empirical_lsm.offline_simulation import share_train_stores
+    from empirical_lsm.training_store import attach_store
+
+    handles, blocks = share_train_stores([get_model(n) for n in preload])
+    for handle in handles:
+        attach_store(handle)
+    logger.info("Preloaded {n} training store(s)".format(n=len(handles)))
+
+    return blocks
+
+
+# Set by SIGTERM, see serve
+_stopping = threading.Event()
+
+
+def _terminate(signum, frame):
+    _stopping.set()
+
+
+def serve(socket_path=None, preload=(), modules=None):
+    """Warm up, then run jobs from the socket until terminated (see stop)
+
+    :preload: model names whose training stores are loaded up front
+    """
+    if socket_path is None:
+        socket_path = DAEMON_CONFIG['socket']
+    if is_running(socket_path):
+        raise RuntimeError("A daemon is already running on {s}".format(s=socket_path))
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    t_start = time.time()
+    blocks = warm_up(modules, preload)
+    logger.info("Warmed up in {t:.1f}s".format(t=time.time() - t_start))
+
+    # written first, so the daemon can be stopped as soon as it's listening
+    _stopping.clear()
+    signal.signal(signal.SIGTERM, _terminate)
+    with open(get_pid_path(socket_path), 'w') as f:
+        f.write(str(os.getpid()))
+    server = _ForkingUnixServer(socket_path, _JobHandler)
+    server.max_children = DAEMON_CONFIG['max_jobs']
+    server.cwd = os.getcwd()
+    # seconds between checks for SIGTERM
+    server.timeout = 0.5
+    os.chmod(socket_path, 0o600)
+
+    logger.info("Daemon {p} listening on {s}".format(p=os.getpid(), s=socket_path))
+    try:
+        while not _stopping.is_set():
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for path in [socket_path, get_pid_path(socket_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        if len(blocks) > 0:
+            from empirical_lsm.training_store import release_blocks
+            release_blocks(blocks)
+        logger.info("Daemon stopped")
+
+
+def stop(socket_path=None):
+    """Stop a running daemon
+
+    :returns: True if a daemon was signalled
+    """
+    if socket_path is None:
+        socket_path = DAEMON_CONFIG['socket']
+    try:
+        with open(get_pid_path(socket_path)) as f:
+            pid = int(f.read())
+    except FileNotFoundError:
+        return False
+
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        os.remove(get_pid_path(socket_path))
+        return False
+
+    return True
@@ -13,42 +13,82 @@ import numpy as np
 import pandas as pd
 import os
 
-from pals_utils.data import get_sites, copy_data, get_met_data, get_config, set_config, \
-    pals_xr_to_df, get_multisite_met_df, get_multisite_flux_df
+from concurrent.futures import ThreadPoolExecutor
+
+from pals_utils.data import get_sites, get_met_data, get_config, pals_xr_to_df
 
 from empirical_lsm.transforms import rolling_mean
+from empirical_lsm.instrument import timed
+from empirical_lsm.sim_store import get_sim_path, open_sim
+from empirical_lsm.training_store import get_training_store, load_sites, assemble_store, TrainingSet
+from empirical_lsm import init_config
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-set_config(['datasets', 'train'], 'PLUMBER_ext')
-set_config(['qc_format'], 'PALS')
+def get_train_sites():
+    """Configured training sites
+
+    Set the training set using pals.data.set_config(['datasets', 'train']), or
+    empirical_lsm.init() for the default."""
+    init_config(overwrite=False)
+
+    return get_sites(get_config(['datasets', 'train']))
+
+
+def new_sim_dataset(old_ds):
+    """Empty simulation dataset with the same geo data as old_ds
+
+    Only coordinates, non-time-varying variables (lat/lon etc.) and attributes are copied;
+    forcing variables are not.
+    """
+    geo_vars = {v: old_ds[v].variable.copy() for v in old_ds.data_vars if 'time' not in old_ds[v].dims}
+
+    return xr.Dataset(geo_vars, coords=dict(time=old_ds.coords['time'], y=[1.0], x=[1.0]),
+                      attrs=dict(old_ds.attrs))
 
 
 def sim_dict_to_xr(sim_dict, old_ds):
     """Converts a dictionary of arrays into a xarray dataset with the same geo data as old_ds
 
-    Also works with dataframes (by column)
+    Also works with dataframes (by column). Array data is not copied, so prediction buffers
+    can be handed over directly (see sim_array_to_xr).
 
     :sim_dict: Dictionary of simulated variable vectors
     :old_ds: xarray dataset from which to copy metadata
     :returns: xarray dataset with sim_dict data
 
     """
-    sim_data = copy_data(old_ds)
+    sim_data = new_sim_dataset(old_ds)
 
     for v in sim_dict:
-        sim_var = np.array(sim_dict[v])
-        sim_var.shape = (sim_var.shape[0], 1, 1)
+        sim_var = np.asarray(sim_dict[v])
+        if sim_var.ndim > 1:
+            sim_var = sim_var.reshape(sim_var.shape[0])
         # Currently only works with single variable predictions...
-        sim_array = xr.DataArray(sim_var, dims=['time', 'y', 'x'],
-                                 coords=dict(time=old_ds.coords['time'], y=[1.0], x=[1.0]))
-        sim_data[v] = sim_array
+        sim_data[v] = (['time', 'y', 'x'], sim_var[:, np.newaxis, np.newaxis])
 
     return sim_data
 
 
+def get_sim_buffer(old_ds, flux_vars):
+    """Preallocated (time, variable) prediction buffer for sim_array_to_xr
+
+    Fortran-ordered, so each variable's column is contiguous.
+    """
+    return np.empty([len(old_ds['time']), len(flux_vars)], order='F')
+
+
+def sim_array_to_xr(sim_array, flux_vars, old_ds):
+    """Converts a (time, variable) array into a xarray dataset, without copying
+
+    :sim_array: array of predictions, e.g. from get_sim_buffer or a multivariate model
+    :flux_vars: variable names, in column order
+    """
+    return sim_dict_to_xr({v: sim_array[:, i] for i, v in enumerate(flux_vars)}, old_ds)
+
+
 def get_sim_nc_path(name, site):
     """return the sim netcdf path, and make parent directories if they don't already exist.
 
@@ -56,65 +96,165 @@ def get_sim_nc_path(name, site):
     :site: PALS site name to run the model at
     :returns: sim netcdf path
     """
-    model_path = 'model_data/{n}/'.format(n=name)
-    os.makedirs(model_path, exist_ok=True)
-    nc_path = '{p}{n}_{s}.nc'.format(p=model_path, n=name, s=site)
+    nc_path = get_sim_path(name, site)
+    os.makedirs(os.path.dirname(nc_path), exist_ok=True)
 
     return nc_path
 
 
-def get_multimodel_data(site, names, variables):
-    """Returns a DF with variable columns, time/model indices."""
+# Some benchmark models report time at the end of the averaging period
+MODEL_TIME_OFFSETS = {
+    'COLASSiB.2.0': pd.Timedelta('-30min'),
+    'ORCHIDEE.trunk_r1401': pd.Timedelta('-15min'),
+}
 
-    data = []
-    for n in names:
-        path = "model_data/{n}/{n}_{s}.nc".format(n=n, s=site)
-        try:
-            with xr.open_dataset(path) as ds:
-                df = pals_xr_to_df(ds, variables)
-                df['name'] = n
 
-                # offset time indices
-                if n == 'COLASSiB.2.0':
-                    df.index = df.index + pd.Timedelta('-30min')
-                if n == 'ORCHIDEE.trunk_r1401':
-                    df.index = df.index + pd.Timedelta('-15min')
+def get_model_times(ds, name):
+    """Time index of a model simulation, with the model's time offset applied"""
+    times = pd.DatetimeIndex(ds['time'].values, name='time')
+    if name in MODEL_TIME_OFFSETS:
+        times = times + MODEL_TIME_OFFSETS[name]
+
+    return times
+
+
+class MultiModelCube(object):
+
+    """Model outputs at one site, as a (model, time, variable) array
+
+    Model files are read concurrently, then placed in a preallocated cube on a common
+    time axis. Pandas views are only built on request.
+    """
+
+    def __init__(self, site, names, variables, nthreads=None):
+        self.site = site
+        self.names = list(names)
+        self.variables = list(variables)
 
-                df.set_index('name', append=True, inplace=True)
-                data.append(df)
+        if nthreads is None:
+            nthreads = min(len(self.names), os.cpu_count())
 
+        with ThreadPoolExecutor(max(nthreads, 1)) as executor:
+            model_data = list(executor.map(self._read, self.names))
+
+        self.times = model_data[0][0]
+        for times, values in model_data[1:]:
+            if not times.equals(self.times):
+                self.times = self.times.union(times)
+
+        self.cube = np.full([len(self.names), len(self.times), len(self.variables)], np.nan)
+        self.present = np.zeros([len(self.names), len(self.times)], dtype=bool)
+        for i, (times, values) in enumerate(model_data):
+            positions = self.times.get_indexer(times)
+            self.present[i, positions] = True
+            self.cube[i, positions] = values
+
+    def _read(self, name):
+        """Read one model's times and variables
+
+        Repeated timestamps (e.g. from a badly concatenated simulation) are dropped,
+        keeping the first, so that each model has one value per time.
+
+        :returns: (times, (time, variable) array)
+        """
+        try:
+            with open_sim(name, self.site) as ds:
+                times = get_model_times(ds, name)
+                values = np.empty([len(times), len(self.variables)])
+                for j, v in enumerate(self.variables):
+                    values[:, j] = ds[v].values.reshape(len(times))
         except (OSError, RuntimeError) as e:
-            raise Exception(path, e)
+            raise Exception(get_sim_path(name, self.site), e)
+
+        duplicated = times.duplicated()
+        if duplicated.any():
+            logger.warning("{n} at {s} has {d} repeated timestamps, keeping the first of each".format(
+                n=name, s=self.site, d=duplicated.sum()))
+            times = times[~duplicated]
+            values = values[~duplicated]
+
+        return times, values
+
+    def long_df(self):
+        """DF with variable columns, time/model indices (as get_multimodel_data)"""
+        model_idx, time_idx = np.nonzero(self.present)
+        index = pd.MultiIndex.from_arrays(
+            [self.times[time_idx], np.array(self.names, dtype=object)[model_idx]],
+            names=['time', 'name'])
+        columns = pd.Index(self.variables, name='variable')
+
+        return pd.DataFrame(self.cube[model_idx, time_idx], index=index, columns=columns)
+
+    def wide_df(self, variables=None):
+        """DF with model columns, time/variable indices (as get_multimodel_wide_df)
+
+        Rows where no model has a value are dropped.
+
+        :variables: a list of variables, or a single variable name to get a time-indexed DF
+        """
+        columns = pd.Index(self.names, name='name')
+        if isinstance(variables, str):
+            j = self.variables.index(variables)
+            return pd.DataFrame(self.cube[:, :, j].T, index=self.times, columns=columns).dropna(how='all')
 
-    df = pd.concat(data)
-    df.columns.name = 'variable'
-    return df
+        if variables is None:
+            variables = self.variables
+        var_idx = [self.variables.index(v) for v in variables]
+        index = pd.MultiIndex.from_product([self.times, variables], names=['time', 'variable'])
+        values = self.cube[:, :, var_idx].reshape(len(self.names), -1).T
 
+        return pd.DataFrame(values, index=index, columns=columns).dropna(how='all')
 
-def get_multimodel_wide_df(site, names, variables):
+
+def get_multimodel_data(site, names, variables, nthreads=None):
+    """Returns a DF with variable columns, time/model indices."""
+    return MultiModelCube(site, names, variables, nthreads).long_df()
+
+
+def get_multimodel_wide_df(site, names, variables, nthreads=None):
     """Returns a DF with model columns, time/variable indices."""
     if isinstance(variables, list):
-        df = get_multimodel_data(site, names, variables)
-        return df.stack().unstack(level='name')[names]
+        return MultiModelCube(site, names, variables, nthreads).wide_df()
     elif isinstance(variables, str):
-        df = get_multimodel_data(site, names, [variables])
-        return df.stack().unstack(level='name')[names].xs(variables, level=1)
+        return MultiModelCube(site, names, [variables], nthreads).wide_df(variables)
     else:
         raise Exception("WTF is variables? %s" % type(variables))
 
 
-def get_train_data(train_sites, met_vars, flux_vars, use_names, qc=True, fix_closure=True):
+def get_train_data(train_sites, met_vars, flux_vars, use_names, qc=True, fix_closure=True, cache=True,
+                   nthreads=None):
+    """Gets multi-site training data
+
+    :cache: load data via the memory-mapped training store (see empirical_lsm.training_store)
+    :nthreads: number of threads for loading sites concurrently (default: one per site, up to ncpus)
+    :returns: dict with a TrainingSet over all train_sites
+    """
 
-    met_train = get_multisite_met_df(train_sites, variables=met_vars, qc=qc, name=use_names)
-    flux_train = get_multisite_flux_df(train_sites, variables=flux_vars, qc=qc, name=use_names, fix_closure=fix_closure)
+    if cache:
+        store = get_training_store(train_sites, met_vars, flux_vars, qc=qc, fix_closure=fix_closure,
+                                   nthreads=nthreads)
+    else:
+        site_frames, load_times = load_sites(train_sites, met_vars, flux_vars, qc=qc,
+                                             fix_closure=fix_closure, nthreads=nthreads)
+        store = assemble_store(train_sites, site_frames, met_vars, flux_vars, qc=qc, fix_closure=fix_closure,
+                               load_times=load_times)
 
     return dict(
         train_sites=train_sites,
         met_vars=met_vars,
         flux_vars=flux_vars,
         fix_closure=fix_closure,
-        met_train=met_train,
-        flux_train=flux_train)
+        train_set=TrainingSet(store, use_names=use_names))
+
+
+def get_train_store(met_vars, flux_vars, qc=True, fix_closure=True):
+    """Training store over all configured training sites
+
+    This is the store shared by all leave-one-out runs in get_train_test_data.
+    """
+    train_sites = get_train_sites()
+
+    return get_training_store(train_sites, met_vars, flux_vars, qc=qc, fix_closure=fix_closure)
 
 
 def get_test_data(site, met_vars, use_names, qc=False, fix_closure=True):
@@ -131,6 +271,7 @@ def get_test_data(site, met_vars, use_names, qc=False, fix_closure=True):
         met_test_xr=met_test_xr)
 
 
+@timed('load_data')
 def get_train_test_data(site, met_vars, flux_vars, use_names, qc=True, fix_closure=True):
     """Gets training and testing data, PLUMBER style (leave one out)
 
@@ -144,18 +285,16 @@ def get_train_test_data(site, met_vars, flux_vars, use_names, qc=True, fix_closu
         qc = False
 
     else:
-        train_sites = get_sites(get_config(['datasets', 'train']))
+        train_sites = get_train_sites()
         test_site = site
-        if test_site not in train_sites:
-            # Running on a non-training site, train on all training sites.
-            train_sites = train_sites
-        else:
-            # Running on a training site, so leave it out.
-            train_sites = [s for s in train_sites if s != test_site]
-        logger.info("Training with {n} datasets".format(n=len(train_sites)))
 
+    # All leave-one-out runs share one store over all training sites. If we're
+    # running on a training site, leave it out of the view.
     train_dict = get_train_data(train_sites, met_vars, flux_vars, use_names=use_names,
                                 qc=qc, fix_closure=fix_closure)
+    train_dict['train_set'] = train_dict['train_set'].leave_out(test_site)
+    train_dict['train_sites'] = train_dict['train_set'].sites
+    logger.info("Training with {n} datasets".format(n=len(train_dict['train_sites'])))
 
     test_dict = get_test_data(test_site, met_vars, use_names=use_names, qc=False)
 
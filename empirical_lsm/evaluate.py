@@ -10,12 +10,14 @@ Description: PALS-style model evaluation
 
 import pandas as pd
 import numpy as np
-import glob
 import os
 
-from pals_utils.data import get_site_code, get_sites, get_config
+from pals_utils.data import get_site_code, get_sites
 from pals_utils.stats import run_metrics
 
+from empirical_lsm.qc_index import get_qc_flag_mask, get_good_qc
+from empirical_lsm.catalogue import record_artefact, list_artefacts
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -39,18 +41,16 @@ def evaluate_simulation(sim_data, flux_data, name, site=None, qc=True):
     eval_vars = sorted(set(flux_vars).intersection(sim_data.data_vars)
                                      .intersection(flux_data.data_vars))
 
-    if get_config('qc_format') == 'PALS':
-        good_qc = 1
-    elif get_config('qc_format') == 'FluxnetLSM':
-        good_qc = 0
+    if qc:
+        good_qc = get_good_qc()
 
     metric_data = pd.DataFrame()
     metric_data.index.name = 'metric'
     for v in eval_vars:
         if qc:
-            v_qc = v + '_qc'
-            sim_v = sim_data[v].values.ravel()[flux_data[v_qc].values.ravel() == good_qc]
-            obs_v = flux_data[v].values.ravel()[flux_data[v_qc].values.ravel() == good_qc]
+            qc_mask = get_qc_flag_mask(flux_data, v, good_qc)
+            sim_v = sim_data[v].values.ravel()[qc_mask]
+            obs_v = flux_data[v].values.ravel()[qc_mask]
         else:
             sim_v = sim_data[v].values.ravel()
             obs_v = flux_data[v].values.ravel()
@@ -62,6 +62,7 @@ def evaluate_simulation(sim_data, flux_data, name, site=None, qc=True):
     os.makedirs(eval_dir, exist_ok=True)
     eval_path = '{d}/{n}_{s}_metrics.csv'.format(d=eval_dir, n=name, s=site)
     metric_data.to_csv(eval_path)
+    record_artefact(eval_path)
 
     return metric_data
 
@@ -118,23 +119,16 @@ def get_metric_data(names):
     :returns: All metric data as a pandas dataframe
 
     """
-    import re
-    import pandas as pd
-
-    pat = re.compile('[^\W_]+(?=_metrics.csv$)')
-
     data = []
 
     for name in names:
-        model_dir = 'source/models/' + name
-        csv_files = glob.glob(model_dir + '/metrics/*csv')
+        csv_files = list_artefacts('metrics', name)
         if len(csv_files) == 0:
             continue
         model_dfs = []
         for csvf in csv_files:
-            site = re.search(pat, csvf).group(0)
-            df = pd.DataFrame.from_csv(csvf)
-            df['site'] = site
+            df = pd.DataFrame.from_csv(csvf['path'])
+            df['site'] = csvf['site']
             model_dfs.append(df)
         model_df = pd.concat(model_dfs)
         model_df['name'] = name
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: executors.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Executor backends for running (model, site) tasks in parallel.
+
+All *_mp helpers run their tasks through get_executor(), which returns either:
+
+- LocalExecutor: a multiprocessing Pool on this host (the default), or
+- QueueExecutor: a work queue in a shared directory. Tasks are pickled into
+  <queue_dir>/pending/. Workers on any number of nodes (scripts/tools/queue_worker.py,
+  or local stand-in processes) claim them under a file lock. While a task runs, the
+  worker heartbeats its lease. A task whose lease hasn't been renewed within the
+  lease time (its worker died) is requeued, up to max_attempts times. Results are
+  written back to <queue_dir>/results/<job>/.
+
+Queued tasks carry the submitting process's worker context: the pals_utils config
+(e.g. the flux variables), the instrumentation, profiling and thread budget settings,
+and the thread limit. Workers apply it before each task, so queued runs match Pool runs.
+
+Select the backend with configure(backend='queue', queue_dir=...), or with the
+EMPIRICAL_LSM_QUEUE environment variable (a queue directory).
+"""
+
+import os
+import glob
+import json
+import time
+import uuid
+import pickle
+import socket
+import threading
+
+from multiprocessing import Pool, Process
+
+from empirical_lsm.sim_store import file_lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+EXECUTOR_CONFIG = dict(
+    backend='queue' if os.environ.get('EMPIRICAL_LSM_QUEUE') else 'local',
+    queue_dir=os.environ.get('EMPIRICAL_LSM_QUEUE') or 'cache/queue',
+    # seconds without a heartbeat before a task is requeued
+    lease=300,
+    # seconds between heartbeats
+    heartbeat=30,
+    # seconds between polls for new tasks or results
+    poll=2,
+    max_attempts=3,
+    # stand-in worker processes started on this host by QueueExecutor
+    local_workers=0,
+    # seconds before warning that no worker has claimed any of a job's tasks
+    unclaimed_warning=60,
+)
+
+# pals_utils config passed to queue workers (see get_worker_context)
+CONTEXT_CONFIG_KEYS = [['vars', 'flux'], ['vars', 'met'], ['datasets', 'train'], ['qc_format']]
+
+
+def configure(**kwargs):
+    """Update the executor configuration (see EXECUTOR_CONFIG)"""
+    for k in kwargs:
+        if k not in EXECUTOR_CONFIG:
+            raise KeyError("Unknown executor option: %s" % k)
+    EXECUTOR_CONFIG.update(kwargs)
+
+
+def get_executor(ncores, initializer=None, initargs=(), n_threads=None):
+    """Executor for the configured backend
+
+    :ncores: number of local processes (LocalExecutor)
+    :initializer: Pool worker initializer (LocalExecutor only, queue workers run on other hosts)
+    :n_threads: BLAS/OpenMP thread limit for each task (QueueExecutor only, the
+        LocalExecutor's initializer sets it)
+    """
+    if EXECUTOR_CONFIG['backend'] == 'local':
+        return LocalExecutor(ncores, initializer, initargs)
+    elif EXECUTOR_CONFIG['backend'] == 'queue':
+        return QueueExecutor(EXECUTOR_CONFIG['queue_dir'], local_workers=EXECUTOR_CONFIG['local_workers'],
+                             n_threads=n_threads)
+    else:
+        raise ValueError("Unknown executor backend: %s" % EXECUTOR_CONFIG['backend'])
+
+
+class LocalExecutor(object):
+
+    """Runs tasks in a multiprocessing Pool on this host"""
+
+    def __init__(self, ncores, initializer=None, initargs=()):
+        self.ncores = ncores
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+
+    def __enter__(self):
+        self.pool = Pool(self.ncores, initializer=self.initializer, initargs=self.initargs)
+        return self
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        self.pool = None
+        return False
+
+    def starmap(self, f, args_list):
+        """Like Pool.starmap"""
+        return self.pool.starmap(f, args_list)
+
+
+##################
+# Shared-directory work queue
+##################
+
+def _queue_paths(queue_dir):
+    return dict((d, os.path.join(queue_dir, d)) for d in ['pending', 'running', 'results'])
+
+
+def _write_atomic(path, obj):
+    tmp_path = '{p}.tmp{pid}'.format(p=path, pid=os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+
+def _read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_result(queue_dir, task, value=None, error=None):
+    result_dir = os.path.join(_queue_paths(queue_dir)['results'], task['job'])
+    os.makedirs(result_dir, exist_ok=True)
+    _write_atomic(os.path.join(result_dir, '%06d.result' % task['index']), dict(value=value, error=error))
+
+
+def claim_task(queue_dir, worker_id):
+    """Move the oldest pending task to running, with a lease held by worker_id
+
+    :returns: (task file name, task dict), or None if there are no pending tasks
+    """
+    paths = _queue_paths(queue_dir)
+    with file_lock(os.path.join(queue_dir, 'queue')):
+        pending = sorted(os.listdir(paths['pending']))
+        for task_file in pending:
+            if not task_file.endswith('.task'):
+                continue
+            running_path = os.path.join(paths['running'], task_file)
+            os.rename(os.path.join(paths['pending'], task_file), running_path)
+            with open(running_path + '.lease', 'w') as f:
+                json.dump(dict(worker=worker_id, claimed=time.time()), f)
+            return task_file, _read_pickle(running_path)
+
+    return None
+
+
+def requeue_stale_tasks(queue_dir, lease=None, max_attempts=None):
+    """Requeue running tasks whose lease has expired (their worker died)
+
+    Tasks that have already been attempted max_attempts times get an error result instead.
+
+    :returns: number of tasks requeued or failed
+    """
+    if lease is None:
+        lease = EXECUTOR_CONFIG['lease']
+    if max_attempts is None:
+        max_attempts = EXECUTOR_CONFIG['max_attempts']
+    paths = _queue_paths(queue_dir)
+
+    n = 0
+    with file_lock(os.path.join(queue_dir, 'queue')):
+        now = time.time()
+        for lease_path in glob.glob(os.path.join(paths['running'], '*.task.lease')):
+            try:
+                if now - os.path.getmtime(lease_path) < lease:
+                    continue
+            except FileNotFoundError:
+                continue
+            running_path = lease_path[:-len('.lease')]
+            task_file = os.path.basename(running_path)
+            task = _read_pickle(running_path)
+            task['attempts'] += 1
+            if task['attempts'] >= max_attempts:
+                logger.error("Task {t} lost its worker {n} times, giving up".format(t=task_file, n=task['attempts']))
+                _write_result(queue_dir, task, error="worker died {n} times".format(n=task['attempts']))
+                os.remove(running_path)
+            else:
+                logger.warning("Task {t} lease expired, requeueing".format(t=task_file))
+                _write_atomic(running_path, task)
+                os.rename(running_path, os.path.join(paths['pending'], task_file))
+            os.remove(lease_path)
+            n += 1
+
+    return n
+
+
+def get_worker_context(n_threads=None):
+    """Settings of this process that queued tasks must run with
+
+    :n_threads: BLAS/OpenMP thread limit for each task
+    :returns: picklable dict, see apply_worker_context
+    """
+    from pals_utils.data import get_config
+    from empirical_lsm.instrument import INSTRUMENT_CONFIG
+    from empirical_lsm.profiling import PROFILE_CONFIG
+    from empirical_lsm.thread_budget import THREAD_BUDGET_CONFIG
+
+    config = []
+    for keys in CONTEXT_CONFIG_KEYS:
+        try:
+            config.append((keys, get_config(keys)))
+        except KeyError:
+            pass
+
+    return dict(config=config,
+                instrument=dict(INSTRUMENT_CONFIG),
+                profiling=dict(PROFILE_CONFIG),
+                thread_budget=dict(THREAD_BUDGET_CONFIG),
+                n_threads=n_threads)
+
+
+def apply_worker_context(context):
+    """Apply a task's worker context (see get_worker_context) in this process"""
+    from pals_utils.data import set_config
+    from empirical_lsm import instrument, profiling, thread_budget
+
+    for keys, value in context['config']:
+        set_config(keys, value)
+    instrument.configure(**context['instrument'])
+    profiling.configure(**context['profiling'])
+    thread_budget.configure(**context['thread_budget'])
+
+
+def _run_task(task):
+    """Run a task in its worker context"""
+    context = task.get('context')
+    if context is None:
+        return task['f'](*task['args'])
+
+    from empirical_lsm.thread_budget import thread_limit
+
+    apply_worker_context(context)
+    if context['n_threads'] is None:
+        return task['f'](*task['args'])
+    with thread_limit(context['n_threads']):
+        return task['f'](*task['args'])
+
+
+def _heartbeat(lease_path, interval, stop):
+    while not stop.wait(interval):
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return
+
+
+def run_worker(queue_dir=None, idle_timeout=None, max_tasks=None):
+    """Pull and run tasks from a queue until it's idle for idle_timeout seconds
+
+    :idle_timeout: seconds to wait for new tasks before exiting (None: run forever, 0: exit when idle)
+    :max_tasks: exit after this many tasks
+    :returns: number of tasks run
+    """
+    if queue_dir is None:
+        queue_dir = EXECUTOR_CONFIG['queue_dir']
+    paths = _queue_paths(queue_dir)
+    for p in paths.values():
+        os.makedirs(p, exist_ok=True)
+    worker_id = '{h}:{p}'.format(h=socket.gethostname(), p=os.getpid())
+    logger.info("Queue worker {w} started on {q}".format(w=worker_id, q=queue_dir))
+
+    n_tasks = 0
+    idle_since = time.time()
+    while max_tasks is None or n_tasks < max_tasks:
+        requeue_stale_tasks(queue_dir)
+        claimed = claim_task(queue_dir, worker_id)
+        if claimed is None:
+            if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                break
+            time.sleep(EXECUTOR_CONFIG['poll'])
+            continue
+
+        task_file, task = claimed
+        running_path = os.path.join(paths['running'], task_file)
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(running_path + '.lease', EXECUTOR_CONFIG['heartbeat'], stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            value = _run_task(task)
+        except Exception as e:
+            logger.exception("Task {t} failed".format(t=task_file))
+            _write_result(queue_dir, task, error=repr(e))
+        else:
+            _write_result(queue_dir, task, value=value)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        with file_lock(os.path.join(queue_dir, 'queue')):
+            for path in [running_path, running_path + '.lease']:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        n_tasks += 1
+        idle_since = time.time()
+
+    logger.info("Queue worker {w} finished after {n} tasks".format(w=worker_id, n=n_tasks))
+
+    return n_tasks
+
+
+class QueueExecutor(object):
+
+    """Runs tasks through a work queue in a shared directory"""
+
+    def __init__(self, queue_dir, local_workers=0, n_threads=None):
+        """
+        :queue_dir: queue directory, on a filesystem shared with the worker nodes
+        :local_workers: number of stand-in worker processes to run on this host
+        :n_threads: BLAS/OpenMP thread limit for each task
+        """
+        self.queue_dir = queue_dir
+        self.local_workers = local_workers
+        self.n_threads = n_threads
+        self.workers = []
+        for p in _queue_paths(queue_dir).values():
+            os.makedirs(p, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for w in self.workers:
+            w.join(timeout=EXECUTOR_CONFIG['poll'])
+            if w.is_alive():
+                w.terminate()
+        self.workers = []
+        return False
+
+    def submit(self, f, args_list, context=None):
+        """Queue tasks
+
+        :context: worker context for the tasks (default: this process's, see get_worker_context)
+        :returns: job id
+        """
+        if context is None:
+            context = get_worker_context(self.n_threads)
+        job = '{t}_{u}'.format(t=time.strftime('%Y%m%d%H%M%S'), u=uuid.uuid4().hex[:8])
+        pending = _queue_paths(self.queue_dir)['pending']
+        for i, args in enumerate(args_list):
+            task = dict(job=job, index=i, f=f, args=tuple(args), attempts=0, context=context)
+            _write_atomic(os.path.join(pending, '{j}_{i:06d}.task'.format(j=job, i=i)), task)
+        logger.info("Queued {n} tasks as job {j} in {q}".format(n=len(args_list), j=job, q=self.queue_dir))
+
+        return job
+
+    def _ensure_local_workers(self):
+        self.workers = [w for w in self.workers if w.is_alive()]
+        while len(self.workers) < self.local_workers:
+            w = Process(target=run_worker, kwargs=dict(queue_dir=self.queue_dir, idle_timeout=0))
+            w.start()
+            self.workers.append(w)
+
+    def wait(self, job, n_tasks):
+        """Wait for all of a job's results
+
+        :returns: list of results, in task order
+        """
+        paths = _queue_paths(self.queue_dir)
+        result_dir = os.path.join(paths['results'], job)
+        t_start = time.time()
+        warned = False
+        while True:
+            n_done = len(glob.glob(os.path.join(result_dir, '*.result')))
+            if n_done >= n_tasks:
+                break
+            requeue_stale_tasks(self.queue_dir)
+            n_pending = len(glob.glob(os.path.join(paths['pending'], job + '_*.task')))
+            if self.local_workers > 0 and n_pending > 0:
+                self._ensure_local_workers()
+            elif (not warned and n_done == 0 and n_pending == n_tasks and
+                  time.time() - t_start > EXECUTOR_CONFIG['unclaimed_warning']):
+                logger.warning("No worker has claimed any of job {j}'s tasks after {t:.0f}s. Is a queue_worker.py "
+                               "running on {q}?".format(j=job, t=time.time() - t_start, q=self.queue_dir))
+                warned = True
+            time.sleep(EXECUTOR_CONFIG['poll'])
+
+        results = [_read_pickle(os.path.join(result_dir, '%06d.result' % i)) for i in range(n_tasks)]
+        for i in range(n_tasks):
+            os.remove(os.path.join(result_dir, '%06d.result' % i))
+        os.rmdir(result_dir)
+
+        errors = [(i, r['error']) for i, r in enumerate(results) if r['error'] is not None]
+        if len(errors) > 0:
+            raise RuntimeError("{n} of {N} queued tasks failed: {e}".format(
+                n=len(errors), N=n_tasks, e='; '.join('task %d: %s' % e for e in errors)))
+
+        return [r['value'] for r in results]
+
+    def starmap(self, f, args_list):
+        """Like Pool.starmap, with tasks run by queue workers"""
+        args_list = list(args_list)
+        job = self.submit(f, args_list)
+
+        return self.wait(job, len(args_list))
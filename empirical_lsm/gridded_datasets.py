@@ -91,14 +91,25 @@ def get_cruncep_datetime(timestep, year):
     return np.datetime64("{y}-{m:02d}-{d:02d}T{h:02d}:00".format(y=year, m=month, d=day, h=hour))
 
 
-def correct_CRUNCEP_coords(data, v, year):
+def select_region(data, region=None):
+    """Subsets data to a region before it is read from disk
+
+    :region: dict of slices by dimension name, like dict(lat=slice(0, 10)). Dimensions
+        that data doesn't have are ignored.
+    """
+    if region is None:
+        return data
+    return data.isel(**{d: s for d, s in region.items() if d in data.dims})
+
+
+def correct_CRUNCEP_coords(data, v, year, region=None):
     """Converts coordinates to match PRINCETON dataset"""
 
     data = data.rename({"longitude": "lon",
                         "latitude": "lat",
                         "time_counter": "time"})
     data['time'] = np.vectorize(get_cruncep_datetime)(data.time, year)
-    return data[v].copy()
+    return select_region(data[v], region).copy()
 
 
 def correct_WATCH_WFDEI_coords(data, v, year):
@@ -114,7 +125,7 @@ def correct_WATCH_WFDEI_coords(data, v, year):
 
 # Individual dataloaders
 
-def get_CRUNCEP_data(met_vars, year):
+def get_CRUNCEP_data(met_vars, year, region=None):
 
     file_tpl = "{d}/gridded/CRUNCEP/cruncep2015_1_{v}_{y}.nc"
 
@@ -125,7 +136,7 @@ def get_CRUNCEP_data(met_vars, year):
     for v, fv in dataset_vars.items():
         # TODO: CRUNCEP uses a mask variable, so replace with NANs?
         with xr.open_dataset(file_tpl.format(d=pud.get_data_dir(), v=fv, y=year)) as ds:
-            data[v] = correct_CRUNCEP_coords(ds, infile_vars[v], year)
+            data[v] = correct_CRUNCEP_coords(ds, infile_vars[v], year, region)
     data = xr.Dataset(data)
 
     # CRUNCEP uses stupid units: ftp://nacp.ornl.gov/synthesis/2009/frescati/model_driver/cru_ncep/analysis/readme.htm
@@ -134,20 +145,20 @@ def get_CRUNCEP_data(met_vars, year):
     return data
 
 
-def get_GSWP3_data(met_vars, year):
+def get_GSWP3_data(met_vars, year, region=None):
 
     file_tpl = "{d}/gridded/GSWP3/{v}/GSWP3.BC.{v}.3hrMap.{y}.nc"
 
     data = {}
     for v in met_vars:
         with xr.open_dataset(file_tpl.format(d=pud.get_data_dir(), v=v, y=year)) as ds:
-            data[v] = ds[v].copy()
+            data[v] = select_region(ds[v], region).copy()
     data = xr.Dataset(data)
 
     return data
 
 
-def get_PRINCETON_data(met_vars, year):
+def get_PRINCETON_data(met_vars, year, region=None):
 
     file_tpl = "{d}/gridded/PRINCETON/0_5_3hourly/{v}_3hourly_{y}-{y}.nc"
 
@@ -156,13 +167,13 @@ def get_PRINCETON_data(met_vars, year):
     data = {}
     for v, fv in dataset_vars.items():
         with xr.open_dataset(file_tpl.format(d=pud.get_data_dir(), v=fv, y=year)) as ds:
-            data[v] = ds[fv].copy()
+            data[v] = select_region(ds[fv], region).copy()
     data = xr.Dataset(data)
 
     return data
 
 
-def get_WATCH_WFDEI_data(met_vars, year):
+def get_WATCH_WFDEI_data(met_vars, year, region=None):
 
     file_tpl = "{d}/gridded/WATCH_WFDEI/{v}_WFDEI/{v}_WFDEI_{y}*.nc"
 
@@ -172,7 +183,7 @@ def get_WATCH_WFDEI_data(met_vars, year):
         datasets = [xr.open_dataset(f, decode_times=False) for f in files]
         # TODO: WATCH_FDEI uses a fill-value mask, so replace with NANs?
         data[v] = xr.concat(
-            [correct_WATCH_WFDEI_coords(ds, v, year) for ds in datasets],
+            [correct_WATCH_WFDEI_coords(select_region(ds, region), v, year) for ds in datasets],
             dim='time')
         [ds.close() for ds in datasets]
     data = xr.Dataset(data)
@@ -228,8 +239,10 @@ def get_relhum(data):
     data['RelHum'] = pud.Spec2RelHum(data['Qair'], data['Tair'], data['PSurf'])
 
 
-def get_dataset_data(dataset, met_vars, year):
+def get_dataset_data(dataset, met_vars, year, region=None):
     """Loads a single xarray dataset from multiple files.
+
+    :region: dict of slices by dimension name, to read only part of the grid (see select_region)
     """
     relhum = 'RelHum' in met_vars
     if relhum:
@@ -239,13 +252,13 @@ def get_dataset_data(dataset, met_vars, year):
         met_vars = set(met_vars).union(['Tair', 'Qair', 'PSurf'])
 
     if dataset == 'CRUNCEP':
-        data = get_CRUNCEP_data(met_vars, year)
+        data = get_CRUNCEP_data(met_vars, year, region)
     if dataset == 'GSWP3':
-        data = get_GSWP3_data(met_vars, year)
+        data = get_GSWP3_data(met_vars, year, region)
     if dataset == 'PRINCETON':
-        data = get_PRINCETON_data(met_vars, year)
+        data = get_PRINCETON_data(met_vars, year, region)
     if dataset == 'WATCH_WFDEI':
-        data = get_WATCH_WFDEI_data(met_vars, year)
+        data = get_WATCH_WFDEI_data(met_vars, year, region)
 
     if relhum:
         get_relhum(data)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: gridded_prediction.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Vectorised prediction of fitted models over gridded forcing.
+
+Rather than selecting and predicting each grid cell separately, the forcing is
+stacked into one (variable, lon, lat, time) array. Land cells (cells whose first
+timestep is within the valid range for all variables) are gathered into
+(cell x time, variable) matrices, in batches of whole cells sized to a memory
+budget. Each batch is predicted with one model.predict call, and the results are
+scattered back into a (var, lon, lat, time) cube.
+
+Lagged models (called with a datafreq) get each cell's rows as a time-contiguous
+block, with the cell as the 'site' index level, so lags never cross cells.
+
+For grids that don't fit in memory, predict_tiled reads the forcing in latitude
+bands (or tiles, at high resolution) sized to a memory budget, and writes each
+tile's prediction straight into preallocated, chunked output netCDF files. A JSON
+sidecar records completed tiles, so an interrupted run resumes where it stopped.
+"""
+
+import os
+import json
+import netCDF4
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from datetime import datetime as dt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+GRIDDED_CONFIG = dict(
+    # bytes of model input and output per prediction batch
+    batch_memory=500e6,
+    # forcing values outside this range are fill values (e.g. ocean)
+    valid_range=(-1e8, 1e8),
+    # peak bytes for a tiled prediction (forcing, prediction batches, and output)
+    tile_memory=4e9,
+    # bytes per output netCDF chunk
+    chunk_memory=32e6,
+)
+
+
+def configure(**kwargs):
+    """Update the gridded prediction configuration (see GRIDDED_CONFIG)"""
+    for k in kwargs:
+        if k not in GRIDDED_CONFIG:
+            raise KeyError("Unknown gridded prediction option: %s" % k)
+    GRIDDED_CONFIG.update(kwargs)
+
+
+def get_forcing_array(dataset_data, met_vars=None):
+    """Forcing as a (variable, lon, lat, time) array
+
+    :met_vars: variables in model input order (default: all data variables)
+    """
+    if met_vars is None:
+        met_vars = list(dataset_data.data_vars)
+
+    return np.stack([dataset_data[v].transpose('lon', 'lat', 'time').values for v in met_vars])
+
+
+def get_land_mask(forcing, valid_range=None):
+    """(lon, lat) mask of cells whose first timestep is valid for all variables
+
+    :forcing: (variable, lon, lat, time) array
+    """
+    if valid_range is None:
+        valid_range = GRIDDED_CONFIG['valid_range']
+    first_step = forcing[:, :, :, 0]
+
+    with np.errstate(invalid='ignore'):
+        return np.all((valid_range[0] < first_step) & (first_step < valid_range[1]), axis=0)
+
+
+def get_feature_count(model, n_vars):
+    """Number of model features per input variable set (more for lagged models)"""
+    var_lags = getattr(model, 'var_lags', None)
+    if var_lags is None:
+        return n_vars
+    return sum(len(lags) for lags in var_lags.values())
+
+
+def get_batch_cells(model, n_vars, n_times, n_outputs, batch_memory=None):
+    """Number of grid cells per prediction batch, within the batch memory budget"""
+    if batch_memory is None:
+        batch_memory = GRIDDED_CONFIG['batch_memory']
+
+    # input matrix (plus a working copy), model features, and output, in float64
+    cell_bytes = 8 * n_times * (2 * n_vars + get_feature_count(model, n_vars) + n_outputs)
+
+    return max(1, int(batch_memory // cell_bytes))
+
+
+def predict_cells(model, forcing, lons, lats, met_vars, datafreq=None):
+    """Predict a batch of cells
+
+    :forcing: (variable, lon, lat, time) array
+    :lons, lats: cell indices
+    :datafreq: data rate in hours, for lagged models
+    :returns: (cell, time, output) array
+    """
+    n_cells = len(lons)
+    n_times = forcing.shape[3]
+
+    # (cell, time, variable), with each cell's times contiguous
+    X = forcing[:, lons, lats, :].transpose(1, 2, 0).reshape(n_cells * n_times, len(met_vars))
+
+    if datafreq is None:
+        prediction = model.predict(X)
+    else:
+        index = pd.MultiIndex.from_arrays([np.repeat(np.arange(n_cells), n_times),
+                                           np.tile(np.arange(n_times), n_cells)],
+                                          names=['site', 'time'])
+        prediction = model.predict(pd.DataFrame(X, index=index, columns=met_vars), datafreq=datafreq)
+
+    return np.asarray(prediction).reshape(n_cells, n_times, -1)
+
+
+def predict_gridded(model, dataset_data, flux_vars, datafreq=None, met_vars=None, batch_memory=None):
+    """Predict model results for gridded data
+
+    :model: fitted scikit-learn style model/pipeline
+    :dataset_data: xarray dataset of forcing, with lon, lat and time dimensions
+    :flux_vars: names of the model outputs
+    :datafreq: data rate in hours, for lagged models
+    :met_vars: forcing variables in model input order (default: all data variables)
+    :batch_memory: bytes per prediction batch (default: GRIDDED_CONFIG['batch_memory'])
+    :returns: xarray dataset with a (lon, lat, time) variable per flux variable
+    """
+    if met_vars is None:
+        met_vars = list(dataset_data.data_vars)
+
+    # set prediction metadata
+    prediction = dataset_data[list(dataset_data.coords)]
+
+    forcing = get_forcing_array(dataset_data, met_vars)
+    n_lon, n_lat, n_times = forcing.shape[1:]
+
+    # Arrays like (var, lon, lat, time)
+    result = np.full([len(flux_vars), n_lon, n_lat, n_times], np.nan)
+
+    lons, lats = np.nonzero(get_land_mask(forcing))
+    batch_cells = get_batch_cells(model, len(met_vars), n_times, len(flux_vars), batch_memory)
+    n_batches = int(np.ceil(len(lons) / batch_cells))
+    logger.info("Predicting {n} land cells of {N} in {b} batch(es) of up to {c} cells".format(
+        n=len(lons), N=n_lon * n_lat, b=n_batches, c=batch_cells))
+
+    t_start = dt.now()
+    for i, start in enumerate(range(0, len(lons), batch_cells)):
+        batch_lons = lons[start:start + batch_cells]
+        batch_lats = lats[start:start + batch_cells]
+        cells = predict_cells(model, forcing, batch_lons, batch_lats, met_vars, datafreq)
+        result[:, batch_lons, batch_lats, :] = cells.transpose(2, 0, 1)
+        logger.info("Batch {i}/{n} done ({t:.0f}s elapsed)".format(
+            i=i + 1, n=n_batches, t=(dt.now() - t_start).total_seconds()))
+
+    for i, fv in enumerate(flux_vars):
+        prediction.update(
+            {fv: xr.DataArray(result[i, :, :, :],
+                              dims=['lon', 'lat', 'time'],
+                              coords=dataset_data.coords
+                              )
+             }
+        )
+
+    return prediction
+
+
+# Tiled, out-of-core prediction
+
+def get_grid(load_region):
+    """lon, lat and time coordinates of gridded forcing, from two thin slices
+
+    :load_region: function taking a dict of dimension slices, returning forcing for that region
+    :returns: xarray dataset of coordinates
+    """
+    spatial = load_region(dict(time=slice(0, 1)))
+    temporal = load_region(dict(lon=slice(0, 1), lat=slice(0, 1)))
+
+    return xr.Dataset(coords=dict(lon=spatial['lon'], lat=spatial['lat'], time=temporal['time']))
+
+
+def get_cell_memory(n_vars, n_times, n_outputs):
+    """Bytes per grid cell in a tile: loaded and stacked forcing, the result cube, and its float32 copy"""
+    return 8 * n_times * (2 * n_vars + n_outputs) + 4 * n_times * n_outputs
+
+
+def get_tile_shape(n_lon, n_lat, cell_memory, memory):
+    """(lon, lat) tile shape within a memory budget
+
+    Full latitude bands are used where they fit, otherwise bands are split along longitude.
+    """
+    n_cells = max(1, int(memory // cell_memory))
+    if n_cells >= n_lon:
+        return n_lon, min(n_lat, n_cells // n_lon)
+    return n_cells, 1
+
+
+def get_tiles(n_lon, n_lat, tile_shape):
+    """Tile bounds as (lon_start, lon_end, lat_start, lat_end), band by band"""
+    tile_lon, tile_lat = tile_shape
+
+    return [(lon, min(lon + tile_lon, n_lon), lat, min(lat + tile_lat, n_lat))
+            for lat in range(0, n_lat, tile_lat)
+            for lon in range(0, n_lon, tile_lon)]
+
+
+def get_chunk_shape(tile_shape, n_times, chunk_memory=None):
+    """Output chunk shape: one tile in space, and as many float32 timesteps as fit in chunk_memory"""
+    if chunk_memory is None:
+        chunk_memory = GRIDDED_CONFIG['chunk_memory']
+    time_chunk = int(chunk_memory // (4 * tile_shape[0] * tile_shape[1]))
+
+    return tile_shape[0], tile_shape[1], min(n_times, max(1, time_chunk))
+
+
+def create_output(path, grid, flux_var, chunk_shape, attrs=None):
+    """Preallocate a (lon, lat, time) float32 output file, filled with NaNs"""
+    tmp_path = '{p}.tmp{pid}'.format(p=path, pid=os.getpid())
+    coords = xr.Dataset(coords=grid.coords)
+    if attrs is not None:
+        coords.attrs.update(attrs)
+    coords.to_netcdf(tmp_path, engine='netcdf4')
+
+    with netCDF4.Dataset(tmp_path, 'a') as ds:
+        ds.createVariable(flux_var, 'f4', ('lon', 'lat', 'time'), zlib=True,
+                          chunksizes=chunk_shape, fill_value=np.float32(np.nan))
+    os.rename(tmp_path, path)
+
+
+def get_progress_path(paths):
+    """Sidecar path recording the completed tiles of a set of output files"""
+    return os.path.splitext(sorted(paths.values())[0])[0] + '.tiles.json'
+
+
+def load_progress(progress_path, layout, paths):
+    """Completed tiles from a previous run with the same layout, or None to start afresh"""
+    if not os.path.exists(progress_path) or not all(os.path.exists(p) for p in paths.values()):
+        return None
+    with open(progress_path) as f:
+        progress = json.load(f)
+    if progress['layout'] != layout:
+        logger.warning("Tile layout has changed since the last run, starting again")
+        return None
+
+    return set(tuple(t) for t in progress['done'])
+
+
+def save_progress(progress_path, layout, done):
+    """Record completed tiles, replacing the sidecar atomically"""
+    tmp_path = '{p}.tmp{pid}'.format(p=progress_path, pid=os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(layout=layout, done=sorted(done)), f)
+    os.rename(tmp_path, progress_path)
+
+
+def predict_tiled(model, load_region, flux_vars, paths, datafreq=None, met_vars=None,
+                  memory=None, attrs=None):
+    """Predict model results for gridded data tile by tile, writing them to netCDF as they go
+
+    :model: fitted scikit-learn style model/pipeline
+    :load_region: function taking a dict of dimension slices (e.g. dict(lat=slice(0, 10))),
+        returning the forcing for that region, as for predict_gridded
+    :flux_vars: names of the model outputs
+    :paths: dict of output file paths by flux variable
+    :datafreq: data rate in hours, for lagged models
+    :met_vars: forcing variables in model input order (default: all data variables)
+    :memory: peak bytes for forcing, prediction and output (default: GRIDDED_CONFIG['tile_memory'])
+    :attrs: global attributes for the output files
+    :returns: list of the tiles predicted in this call
+    """
+    if memory is None:
+        memory = GRIDDED_CONFIG['tile_memory']
+
+    grid = get_grid(load_region)
+    if met_vars is None:
+        met_vars = list(load_region(dict(lon=slice(0, 1), lat=slice(0, 1))).data_vars)
+    n_lon, n_lat, n_times = len(grid['lon']), len(grid['lat']), len(grid['time'])
+
+    # a quarter of the budget for prediction batches, the rest for the tile
+    batch_memory = min(GRIDDED_CONFIG['batch_memory'], memory / 4)
+    cell_memory = get_cell_memory(len(met_vars), n_times, len(flux_vars))
+    tile_shape = get_tile_shape(n_lon, n_lat, cell_memory, memory - batch_memory)
+    tiles = get_tiles(n_lon, n_lat, tile_shape)
+
+    layout = dict(grid=[n_lon, n_lat, n_times], tile=list(tile_shape), flux_vars=list(flux_vars))
+    progress_path = get_progress_path(paths)
+    done = load_progress(progress_path, layout, paths)
+    if done is None:
+        chunk_shape = get_chunk_shape(tile_shape, n_times)
+        for fv in flux_vars:
+            create_output(paths[fv], grid, fv, chunk_shape, attrs)
+        done = set()
+        save_progress(progress_path, layout, done)
+    else:
+        logger.info("Resuming after {n} of {N} tiles".format(n=len(done), N=len(tiles)))
+
+    todo = [t for t in tiles if t not in done]
+    logger.info("Predicting {n} tiles of up to {lon}x{lat} cells".format(
+        n=len(todo), lon=tile_shape[0], lat=tile_shape[1]))
+
+    t_start = dt.now()
+    for tile in todo:
+        lon_start, lon_end, lat_start, lat_end = tile
+        forcing = load_region(dict(lon=slice(lon_start, lon_end), lat=slice(lat_start, lat_end)))
+        result = predict_gridded(model, forcing, flux_vars, datafreq=datafreq, met_vars=met_vars,
+                                 batch_memory=batch_memory)
+        del forcing
+
+        for fv in flux_vars:
+            with netCDF4.Dataset(paths[fv], 'a') as ds:
+                ds.variables[fv][lon_start:lon_end, lat_start:lat_end, :] = \
+                    result[fv].transpose('lon', 'lat', 'time').values.astype(np.float32)
+        del result
+
+        done.add(tile)
+        save_progress(progress_path, layout, done)
+        logger.info("Tile {i}/{n} done ({t:.0f}s elapsed)".format(
+            i=len(done), n=len(tiles), t=(dt.now() - t_start).total_seconds()))
+
+    os.remove(progress_path)
+
+    return todo
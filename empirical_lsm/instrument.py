@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: instrument.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Per-stage timing and peak memory instrumentation.
+
+Pipeline stages (data loading, lagging, clustering, regression, prediction, writing)
+are wrapped in stage() context managers. When instrumentation is enabled (with
+configure(enabled=True), or the EMPIRICAL_LSM_INSTRUMENT environment variable), each
+stage's wall time and peak RSS are recorded in the current session; peak RSS is
+sampled by a background thread, which runs only while a stage is active. Sessions are written to a JSON-lines profile log,
+see scripts/tools/profile_summary.py. When disabled, stage() returns a shared no-op
+context manager.
+"""
+
+import os
+import json
+import atexit
+import functools
+import threading
+
+import psutil
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+INSTRUMENT_CONFIG = dict(
+    enabled=os.environ.get('EMPIRICAL_LSM_INSTRUMENT', '') not in ['', '0'],
+    # seconds between RSS samples
+    sample_interval=0.05,
+    log='logs/profile.jsonl',
+)
+
+
+class _NullStage(object):
+    """Does nothing, for when instrumentation is disabled"""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+# Per-process state: stage records, the current stage path, and the RSS sampler
+_records = OrderedDict()
+_stack = []
+_peak = [0]
+_sampler = None
+_sampler_stop = None
+
+
+def configure(**kwargs):
+    """Update the instrumentation configuration (see INSTRUMENT_CONFIG)"""
+    for k in kwargs:
+        if k not in INSTRUMENT_CONFIG:
+            raise KeyError("Unknown instrumentation option: %s" % k)
+    INSTRUMENT_CONFIG.update(kwargs)
+    if not INSTRUMENT_CONFIG['enabled']:
+        _stop_sampler()
+
+
+def enabled():
+    return INSTRUMENT_CONFIG['enabled']
+
+
+def _get_rss():
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def _sample_rss(interval, stop):
+    while not stop.is_set():
+        rss = _get_rss()
+        if rss > _peak[0]:
+            _peak[0] = rss
+        stop.wait(interval)
+
+
+def _start_sampler():
+    global _sampler, _sampler_stop
+    # the thread doesn't survive fork, so check it's alive in this process
+    if _sampler is None or not _sampler.is_alive():
+        _sampler_stop = threading.Event()
+        _sampler = threading.Thread(target=_sample_rss,
+                                    args=(INSTRUMENT_CONFIG['sample_interval'], _sampler_stop),
+                                    daemon=True)
+        _sampler.start()
+
+
+def _stop_sampler():
+    """Stop the RSS sampler thread, if it's running"""
+    global _sampler
+    if _sampler is None:
+        return
+    _sampler_stop.set()
+    if _sampler.is_alive():
+        _sampler.join()
+    _sampler = None
+
+
+atexit.register(_stop_sampler)
+
+
+def stage(name):
+    """Context manager recording the wall time and peak RSS of a stage
+
+    Nested stages are recorded as "outer.inner". Repeated stages are accumulated
+    (total seconds, max peak RSS, number of calls).
+
+    :returns: context manager yielding the stage's record dict (filled on exit),
+        or None when instrumentation is disabled
+    """
+    if not INSTRUMENT_CONFIG['enabled']:
+        return _NULL_STAGE
+
+    return _stage(name)
+
+
+@contextmanager
+def _stage(name):
+    _start_sampler()
+    _stack.append(name)
+    path = '.'.join(_stack)
+    record = _records.setdefault(path, dict(seconds=0.0, peak_rss=0, calls=0))
+
+    # track this stage's peak separately from the enclosing stage's
+    outer_peak = _peak[0]
+    _peak[0] = _get_rss()
+    t_start = dt.now()
+    try:
+        yield record
+    finally:
+        peak = max(_peak[0], _get_rss())
+        _peak[0] = max(outer_peak, peak)
+        record['seconds'] += (dt.now() - t_start).total_seconds()
+        record['peak_rss'] = max(record['peak_rss'], peak)
+        record['calls'] += 1
+        _stack.pop()
+        if len(_stack) == 0:
+            _stop_sampler()
+
+
+def timed(name):
+    """Decorator wrapping a function in stage(name)"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if not INSTRUMENT_CONFIG['enabled']:
+                return f(*args, **kwargs)
+            with _stage(name):
+                return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def start_session():
+    """Clear recorded stages, e.g. at the start of a (model, site) run"""
+    _records.clear()
+
+
+def get_records():
+    """Stages recorded in the current session, as {stage: dict(seconds, peak_rss, calls)}"""
+    return OrderedDict((k, dict(v)) for k, v in _records.items())
+
+
+def get_sim_attrs():
+    """Recorded stages as netCDF attributes (empty when disabled)"""
+    if not INSTRUMENT_CONFIG['enabled'] or len(_records) == 0:
+        return {}
+
+    return {'Profile_stages': json.dumps(get_records())}
+
+
+def write_profile(**kwargs):
+    """Append the current session's stages to the profile log
+
+    :kwargs: identifying fields (e.g. name, site)
+    """
+    if not INSTRUMENT_CONFIG['enabled'] or len(_records) == 0:
+        return
+
+    record = dict(kwargs, stages=get_records(), pid=os.getpid(), time=str(dt.now()))
+
+    os.makedirs(os.path.dirname(INSTRUMENT_CONFIG['log']), exist_ok=True)
+    with open(INSTRUMENT_CONFIG['log'], 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def load_profiles(path=None):
+    """All records in the profile log"""
+    if path is None:
+        path = INSTRUMENT_CONFIG['log']
+
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return records
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: ledger.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Pipeline state ledger.
+
+Each (model, site, stage) job is recorded in an SQLite table with its status
+('running', 'done', 'failed', or 'interrupted'), a hash of its inputs, timings,
+attempt count and last error. A job is up to date if it's done and its inputs
+haven't changed since, so interrupted pipelines resume where they stopped, and
+failed jobs can be retried on their own. Input hashes come from the model spec and
+from content hashes in the artefact catalogue, not from file mtimes.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+
+from contextlib import closing
+from datetime import datetime as dt
+
+from empirical_lsm.catalogue import list_artefacts
+from empirical_lsm.model_cache import get_spec_hash
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+LEDGER_PATH = 'cache/ledger.sqlite'
+
+STATUSES = ['running', 'done', 'failed', 'interrupted']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    model TEXT NOT NULL,
+    site TEXT NOT NULL DEFAULT '',
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    input_hash TEXT,
+    started TEXT,
+    finished TEXT,
+    seconds REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (model, site, stage)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, stage);
+"""
+
+JOB_COLUMNS = ['model', 'site', 'stage', 'status', 'input_hash', 'started', 'finished',
+               'seconds', 'attempts', 'error']
+
+
+def connect(path=None):
+    """Connect to the ledger, creating it if it doesn't exist"""
+    if path is None:
+        path = LEDGER_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def hash_inputs(inputs):
+    """Hash of a JSON-serialisable description of a job's inputs"""
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _artefact_hashes(kind, name, site=None):
+    return [[a['path'], a['site'], a['hash']] for a in list_artefacts(kind, name, site)]
+
+
+def get_input_hash(name, site, stage, model=None, train_data=None, **options):
+    """Hash of the inputs to a stage
+
+    run: the model spec, training data fingerprint and run options
+    eval: the simulation's content hash and eval options
+    rst: the metrics and figures for the site
+    index: the metrics and figures for all sites, and which site pages exist
+
+    :model: unfitted model (run stage only)
+    :train_data: training data fingerprint, see model_cache.get_data_fingerprint (run stage only)
+    :options: stage options that affect the output (e.g. multivariate, fix_closure)
+    """
+    if stage == 'run':
+        inputs = dict(spec=get_spec_hash(model), train_data=train_data)
+    elif stage == 'eval':
+        inputs = dict(sim=_artefact_hashes('sim', name, site))
+    elif stage == 'rst':
+        inputs = dict(metrics=_artefact_hashes('metrics', name, site),
+                      figures=_artefact_hashes('figure', name, site))
+    elif stage == 'index':
+        # site rst pages are timestamped, so only their existence is an input
+        inputs = dict(metrics=_artefact_hashes('metrics', name),
+                      figures=_artefact_hashes('figure', name),
+                      pages=sorted(a['path'] for a in list_artefacts('rst', name)))
+    else:
+        raise ValueError("Unknown stage: %s" % stage)
+
+    inputs.update(stage=stage, options=options)
+
+    return hash_inputs(inputs)
+
+
+def get_job(name, site, stage):
+    """Ledger entry for a job as a dict, or None if it has never run"""
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT {c} FROM jobs WHERE model = ? AND site = ? AND stage = ?"
+                           .format(c=', '.join(JOB_COLUMNS)), (name, site or '', stage)).fetchone()
+
+    return None if row is None else dict(zip(JOB_COLUMNS, row))
+
+
+def is_up_to_date(name, site, stage, input_hash):
+    """Whether a job is done, with the same inputs"""
+    job = get_job(name, site, stage)
+
+    return job is not None and job['status'] == 'done' and job['input_hash'] == input_hash
+
+
+def start_job(name, site, stage, input_hash):
+    """Record that a job has started"""
+    with closing(connect()) as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO jobs (model, site, stage, status) VALUES (?, ?, ?, 'running')",
+                     (name, site or '', stage))
+        conn.execute("""UPDATE jobs SET status = 'running', input_hash = ?, started = ?, finished = NULL,
+                            seconds = NULL, error = NULL, attempts = attempts + 1
+                        WHERE model = ? AND site = ? AND stage = ?""",
+                     (input_hash, str(dt.now()), name, site or '', stage))
+
+
+def finish_job(name, site, stage, seconds, error=None):
+    """Record that a job has finished
+
+    :error: error message if the job failed, otherwise None
+    """
+    status = 'done' if error is None else 'failed'
+    with closing(connect()) as conn, conn:
+        conn.execute("""UPDATE jobs SET status = ?, finished = ?, seconds = ?, error = ?
+                        WHERE model = ? AND site = ? AND stage = ?""",
+                     (status, str(dt.now()), seconds, error, name, site or '', stage))
+
+
+def mark_interrupted():
+    """Mark jobs left 'running' by a crashed or killed pipeline as 'interrupted'
+
+    Only call this when no other pipeline is running.
+
+    :returns: number of jobs marked
+    """
+    with closing(connect()) as conn, conn:
+        n = conn.execute("UPDATE jobs SET status = 'interrupted' WHERE status = 'running'").rowcount
+    if n > 0:
+        logger.warning("{n} job(s) were interrupted by a previous run".format(n=n))
+
+    return n
+
+
+def list_jobs(status=None, stage=None, model=None):
+    """Ledger entries, optionally filtered, as a list of dicts"""
+    sql = "SELECT {c} FROM jobs WHERE 1".format(c=', '.join(JOB_COLUMNS))
+    args = []
+    for column, value in [('status', status), ('stage', stage), ('model', model)]:
+        if value is not None:
+            sql += " AND {c} = ?".format(c=column)
+            args.append(value)
+    sql += " ORDER BY model, site, stage"
+
+    with closing(connect()) as conn:
+        return [dict(zip(JOB_COLUMNS, r)) for r in conn.execute(sql, args).fetchall()]
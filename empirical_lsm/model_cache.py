@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: model_cache.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Content-addressed cache of fitted models.
+
+Fitted models are keyed by a canonical description of the unfitted model (estimator
+classes, hyperparameters, forcing variables and lags, but not the model's name), the
+training sites, and a fingerprint of the training data. Models with different names
+but identical structure (e.g. short_term243 and STHWdTdQ_lT6hM_km243, or .N duplicates)
+share cached fits. The on-disk store is limited in size, evicting least recently used
+fits first.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+
+import numpy as np
+
+from datetime import datetime as dt
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+MODEL_CACHE_DIR = 'cache/fitted_models'
+
+MODEL_CACHE_CONFIG = dict(
+    enabled=True,
+    # total size of the on-disk store, least recently used fits are evicted first
+    max_bytes=20e9,
+)
+
+# Model attributes that affect fitting, but aren't estimator parameters
+MODEL_ATTRIBUTES = ['forcing_vars']
+
+
+def canonical_spec(obj):
+    """JSON-serialisable canonical representation of an unfitted model
+
+    Estimators are represented by their class and (recursive) parameters.
+    """
+    if hasattr(obj, 'get_params') and not isinstance(obj, type):
+        params = obj.get_params(deep=False)
+        spec = dict(
+            estimator='{m}.{c}'.format(m=type(obj).__module__, c=type(obj).__name__),
+            params={k: canonical_spec(params[k]) for k in sorted(params)})
+        for attr in MODEL_ATTRIBUTES:
+            if hasattr(obj, attr):
+                spec[attr] = canonical_spec(getattr(obj, attr))
+        return spec
+    if isinstance(obj, type):
+        return '{m}.{c}'.format(m=obj.__module__, c=obj.__name__)
+    if isinstance(obj, dict):
+        # keep insertion order (e.g. var_lags determines column order)
+        return [[canonical_spec(k), canonical_spec(v)] for k, v in obj.items()]
+    if isinstance(obj, (list, tuple)):
+        return [canonical_spec(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+
+    return repr(obj)
+
+
+def get_spec_hash(model):
+    """Hash of a model's canonical spec"""
+    spec = json.dumps(canonical_spec(model), sort_keys=True)
+    return hashlib.sha1(spec.encode()).hexdigest()
+
+
+def get_data_fingerprint(train_set):
+    """Fingerprint of a TrainingSet's underlying store
+
+    Based on the store's metadata (sites, row offsets, variables, qc options and build
+    time), so a rebuilt store invalidates fits, without hashing the data itself.
+    """
+    meta = train_set.meta
+    fingerprint = dict((k, meta[k]) for k in ['sites', 'offsets', 'met_vars', 'flux_vars',
+                                               'qc', 'fix_closure', 'created'] if k in meta)
+    fingerprint = json.dumps(fingerprint, sort_keys=True)
+
+    return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+
+def get_fit_key(model, train_set, flux_vars, mode):
+    """Cache key for a model fitted on a training set
+
+    :flux_vars: variables the model is fitted to
+    :mode: fitting mode (e.g. 'univariate', 'multivariate'), fits in different modes aren't shared
+    """
+    key = dict(spec=get_spec_hash(model),
+               sites=list(train_set.sites),
+               data=get_data_fingerprint(train_set),
+               flux_vars=list(flux_vars),
+               mode=mode)
+    key = json.dumps(key, sort_keys=True)
+
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def get_fit_path(key):
+    return os.path.join(MODEL_CACHE_DIR, key + '.pickle')
+
+
+def load_fit(key):
+    """Load a cached fit, or None if there isn't one (or the cache is disabled)"""
+    if not MODEL_CACHE_CONFIG['enabled']:
+        return None
+
+    path = get_fit_path(key)
+    try:
+        with open(path, 'rb') as f:
+            fitted = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        logger.warning("Discarding unreadable cached fit {p}: {e}".format(p=path, e=e))
+        os.remove(path)
+        return None
+
+    # mark as recently used
+    os.utime(path)
+    logger.info("Loaded cached fit {k}".format(k=key))
+
+    return fitted
+
+
+def save_fit(key, fitted):
+    """Save a fit to the cache, and evict old fits if the cache is too big"""
+    if not MODEL_CACHE_CONFIG['enabled']:
+        return
+
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    path = get_fit_path(key)
+    tmp_path = '{p}.tmp{pid}'.format(p=path, pid=os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(fitted, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    logger.info("Cached fit {k} ({s:.1f}MB)".format(k=key, s=os.path.getsize(path) / 1e6))
+
+    evict_fits(MODEL_CACHE_CONFIG['max_bytes'], keep=[path])
+
+
+def evict_fits(max_bytes, keep=()):
+    """Remove least recently used fits until the cache is smaller than max_bytes
+
+    :keep: paths to never evict (e.g. the fit just saved)
+    """
+    if not os.path.isdir(MODEL_CACHE_DIR):
+        return
+
+    fits = []
+    for f in os.listdir(MODEL_CACHE_DIR):
+        if not f.endswith('.pickle'):
+            continue
+        path = os.path.join(MODEL_CACHE_DIR, f)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        fits.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(f[1] for f in fits)
+    for mtime, size, path in sorted(fits):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        logger.info("Evicted cached fit {p} (last used {t})".format(p=path, t=dt.fromtimestamp(mtime)))
+
+
+def fit_cached(fit, model, train_set, flux_vars, mode, use_cache=True):
+    """Fit a model, or load an identical fit from the cache
+
+    :fit: function that fits model and returns the fitted object
+    :use_cache: load from the cache (the new fit is always saved)
+    :returns: fitted object
+    """
+    key = get_fit_key(model, train_set, flux_vars, mode)
+    if use_cache:
+        fitted = load_fit(key)
+        if fitted is not None:
+            return fitted
+
+    fitted = fit()
+    if fitted is not None:
+        save_fit(key, fitted)
+
+    return fitted
@@ -11,25 +11,27 @@ Description: Models created programattically
 from collections import OrderedDict
 import re
 
-from sklearn.linear_model import LinearRegression
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.neural_network import MLPRegressor
-from sklearn.preprocessing import StandardScaler
-from sklearn.pipeline import make_pipeline
-
-from empirical_lsm.clusterregression import ModelByCluster
-from empirical_lsm.transforms import MissingDataWrapper, LagAverageWrapper, MarkovLagAverageWrapper, Mean
-
 import logging
 logger = logging.getLogger(__name__)
 
 
-def km_regression(k, model):
-    return MissingDataWrapper(ModelByCluster(MiniBatchKMeans(k), model))
+# Clusters with fewer training samples than this are merged into a neighbour in the
+# km models, rather than getting an unstable regression of their own
+MIN_CLUSTER_SIZE = 100
+
+
+def km_regression(k, model, cluster_sample=None, min_cluster_size=None):
+    from sklearn.cluster import MiniBatchKMeans
+    from empirical_lsm.clusterregression import ModelByCluster
+    from empirical_lsm.transforms import MissingDataWrapper
+    return MissingDataWrapper(ModelByCluster(MiniBatchKMeans(k), model,
+                                             cluster_sample=cluster_sample,
+                                             min_cluster_size=min_cluster_size))
 
 
 def km_lin(k):
-    return km_regression(k, LinearRegression())
+    from sklearn.linear_model import LinearRegression
+    return km_regression(k, LinearRegression(), min_cluster_size=MIN_CLUSTER_SIZE)
 
 
 def cur_3_var():
@@ -40,6 +42,10 @@ def cur_3_var():
 
 def MLP(*args, **kwargs):
     """Multilayer perceptron """
+    from sklearn.neural_network import MLPRegressor
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.pipeline import make_pipeline
+    from empirical_lsm.transforms import MissingDataWrapper
     return MissingDataWrapper(make_pipeline(StandardScaler(), MLPRegressor(*args, **kwargs)))
 
 
@@ -61,12 +67,27 @@ def add_var_lag(var_dict, v, lag='cur'):
         var_dict[v] += [lag]
 
 
-def parse_model_name(name):
-    """parses a standard model name"
+# Descriptions of parseable model types
+PARSED_MODEL_TYPES = {
+    'lin': 'lin',
+    'mean': 'mean',
+    'km': 'km',
+    'randomforest': 'RandomForest',
+    'extratrees': 'ExtraTrees',
+    'adaboost': 'AdaBoost',
+}
+
+
+def parse_model_spec(name):
+    """parses a standard model name, without constructing the model
+
+    :returns: dict with name, model_name, k (for km models), var_lags, forcing_vars and description
     """
 
     name_original = name
     var_lags = OrderedDict()
+    model_name = None
+    k = None
 
     while len(name) > 0:
         token = name[0]
@@ -117,182 +138,216 @@ def parse_model_name(name):
             continue
         raise NameError('Unmatched token in name: ' + name)
 
+    if model_name is None:
+        raise NameError('No model type in name: ' + name_original)
+
+    desc = PARSED_MODEL_TYPES[model_name]
+    if model_name == 'km':
+        desc += str(k)
+
+    desc = desc + " model with"
+
+    cur_vars = []
+    lag_vars = []
+    for var, v in var_lags.items():
+        if 'cur' in v:
+            cur_vars += [var]
+        if len(v) > 0:
+            for l in v:
+                if v != 'cur':
+                    lag_vars += ['Lagged ' + var + ' (' + l + ')']
+    desc += ' with ' + ', '.join(cur_vars)
+    if len(lag_vars) > 0:
+        desc += ', ' + ', '.join(lag_vars)
+    desc += ' (parsed)'
+
+    return dict(name=name_original,
+                model_name=model_name,
+                k=k,
+                var_lags=var_lags,
+                forcing_vars=list(var_lags),
+                description=desc)
+
+
+def build_parsed_model(spec):
+    """Construct a model from a parsed model spec (see parse_model_spec)"""
+    from empirical_lsm.transforms import MissingDataWrapper, LagAverageWrapper, Mean
+
+    model_name = spec['model_name']
     if model_name == 'lin':
+        from sklearn.linear_model import LinearRegression
         model = MissingDataWrapper(LinearRegression())
-        desc = 'lin'
     elif model_name == 'mean':
         model = MissingDataWrapper(Mean())
-        desc = 'mean'
     elif model_name == 'km':
-        model = km_regression(k, LinearRegression())
-        desc = 'km' + str(k)
+        from sklearn.linear_model import LinearRegression
+        model = km_regression(spec['k'], LinearRegression(), min_cluster_size=MIN_CLUSTER_SIZE)
     elif model_name == 'randomforest':
         from sklearn.ensemble import RandomForestRegressor
         model = MissingDataWrapper(RandomForestRegressor(n_estimators=100))
-        desc = 'RandomForest'
-        memory_req = 20e9
     elif model_name == 'extratrees':
         from sklearn.ensemble import ExtraTreesRegressor
         model = MissingDataWrapper(ExtraTreesRegressor(n_estimators=100))
-        desc = 'ExtraTrees'
-        memory_req = 30e9
     elif model_name == 'adaboost':
         from sklearn.ensemble import AdaBoostRegressor
         model = MissingDataWrapper(AdaBoostRegressor(n_estimators=100))
-        desc = 'AdaBoost'
-        memory_req = 20e9
-
-    desc = desc + " model with"
 
+    var_lags = spec['var_lags']
     if any([l != ['cur'] for l in var_lags.values()]):
         model = LagAverageWrapper(var_lags, model)
 
-    model.forcing_vars = list(var_lags)
+    model.forcing_vars = list(spec['forcing_vars'])
+    model.description = spec['description']
+    model.name = spec['name']
 
-    cur_vars = []
-    lag_vars = []
-    for k, v in var_lags.items():
-        if 'cur' in v:
-            cur_vars += [k]
-        if len(v) > 0:
-            for l in v:
-                if v != 'cur':
-                    lag_vars += ['Lagged ' + k + ' (' + l + ')']
-    desc += ' with ' + ', '.join(cur_vars)
-    if len(lag_vars) > 0:
-        desc += ', ' + ', '.join(lag_vars)
-    desc += ' (parsed)'
-    model.description = desc
+    return model
 
-    model.name = name_original
 
-    if 'memory_req' in locals():
-        model.memory_requirement = memory_req
+def parse_model_name(name):
+    """parses a standard model name, and returns the model"
+    """
+    return build_parsed_model(parse_model_spec(name))
+
+
+#####################
+# Defined models
+#####################
+
+def _3km27_lag():
+    from sklearn.linear_model import LinearRegression
+    from sklearn.cluster import MiniBatchKMeans
+    from empirical_lsm.transforms import MissingDataWrapper
+    from .models import get_model_from_dict
+    model_dict = {
+        'variable': ['SWdown', 'Tair', 'RelHum'],
+        'clusterregression': {
+            'class': MiniBatchKMeans,
+            'args': {
+                'n_clusters': 27}
+        },
+        'class': LinearRegression,
+        'lag': {
+            'periods': 1,
+            'freq': 'D'}
+    }
+    return MissingDataWrapper(get_model_from_dict(model_dict))
+
+
+def _5km27_lag():
+    from empirical_lsm.transforms import LagAverageWrapper
+    var_lags = OrderedDict()
+    [var_lags.update({v: ['cur', '2d', '7d']}) for v in ['SWdown', 'Tair', 'RelHum', 'Wind']]
+    var_lags.update({'Rainf': ['cur', '2d', '7d', '30d', '90d']})
+    return LagAverageWrapper(var_lags, km_lin(27))
 
-    return model
 
+def _lag_average_model(lags, regressor):
+    """Builder for a model with current SWdown, Tair, RelHum, and extra lagged variables"""
+    def build():
+        from empirical_lsm.transforms import LagAverageWrapper
+        var_lags = cur_3_var()
+        var_lags.update(lags)
+        return LagAverageWrapper(var_lags, regressor())
+    return build
 
-def get_model_from_def(name):
-    """returns a scikit-learn style model/pipeline
 
-    :name: model name
-    :returns: scikit-learn style mode/pipeline
+def _markov_lag_model(lags, regressor):
+    """Builder for a model with current SWdown, Tair, RelHum, and Markov-lagged fluxes"""
+    def build():
+        from empirical_lsm.transforms import MarkovLagAverageWrapper
+        var_lags = cur_3_var()
+        var_lags.update(lags)
+        return MarkovLagAverageWrapper(var_lags, regressor())
+    return build
 
-    """
-    # PLUMBER-style benchmarks
-    if name == '1lin':
-        model = MissingDataWrapper(LinearRegression())
-        model.forcing_vars = ['SWdown']
-        model.description = "PLUMBER-style 1lin (SWdown only)"
 
-    elif name == '3km27':
-        model = km_lin(27)
-        model.forcing_vars = ['SWdown', 'Tair', 'RelHum']
-        model.description = "PLUMBER-style 3km27 (SWdown, Tair, RelHum)"
+def _lin():
+    from sklearn.linear_model import LinearRegression
+    from empirical_lsm.transforms import MissingDataWrapper
+    return MissingDataWrapper(LinearRegression())
+
+
+STH = ['SWdown', 'Tair', 'RelHum']
+
+# Model definitions: either a builder function with forcing_vars and description,
+# or a parseable model name ('parsed').
+MODEL_DEFS = OrderedDict([
+    # PLUMBER-style benchmarks
+    ('1lin', dict(build=_lin, forcing_vars=['SWdown'],
+                  description="PLUMBER-style 1lin (SWdown only)")),
+    ('3km27', dict(build=lambda: km_lin(27), forcing_vars=STH,
+                   description="PLUMBER-style 3km27 (SWdown, Tair, RelHum)")),
 
     # higher non-linearity
-    elif name == '3km243':
-        model = km_lin(243)
-        model.forcing_vars = ['SWdown', 'Tair', 'RelHum']
-        model.description = "Like 3km27, but with more clusters"
+    ('3km243', dict(build=lambda: km_lin(243), forcing_vars=STH,
+                    description="Like 3km27, but with more clusters")),
 
     # All lagged-inputs
-    elif name == '3km27_lag':
-        model_dict = {
-            'variable': ['SWdown', 'Tair', 'RelHum'],
-            'clusterregression': {
-                'class': MiniBatchKMeans,
-                'args': {
-                    'n_clusters': 27}
-            },
-            'class': LinearRegression,
-            'lag': {
-                'periods': 1,
-                'freq': 'D'}
-        }
-        from .models import get_model_from_dict
-        model = MissingDataWrapper(get_model_from_dict(model_dict))
-        model.forcing_vars = ['SWdown', 'Tair', 'RelHum']
-        model.description = "like 3km27, but includes 1-day lagged versions of all three variables"
+    ('3km27_lag', dict(build=_3km27_lag, forcing_vars=STH,
+                       description="like 3km27, but includes 1-day lagged versions of all three variables")),
 
     # Many variables, lags. Doesn't work very well... (not enough non-linearity?)
-    elif name == '5km27_lag':
-        var_lags = OrderedDict()
-        [var_lags.update({v: ['cur', '2d', '7d']}) for v in ['SWdown', 'Tair', 'RelHum', 'Wind']]
-        var_lags.update({'Rainf': ['cur', '2d', '7d', '30d', '90d']})
-        model = LagAverageWrapper(var_lags, km_lin(27))
-        model.forcing_vars = list(var_lags)
-        model.description = "km27 linear regression with SW, T, RH, Wind, Rain, and 2 and 7 day lagged-averages for each, plus 30- and 90-day lagged averages for Rainf (probably needs more clusters...)"
+    ('5km27_lag', dict(build=_5km27_lag, forcing_vars=['SWdown', 'Tair', 'RelHum', 'Wind', 'Rainf'],
+                       description="km27 linear regression with SW, T, RH, Wind, Rain, and 2 and 7 day lagged-averages for each, plus 30- and 90-day lagged averages for Rainf (probably needs more clusters...)")),
 
     # 3km243 with lagged Rainf
-    elif name == 'STH_lR2d30d_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Rainf': ['2d', '30d']})
-        model = LagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(var_lags)
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, and Lagged Rainf (2d,30d)"
+    ('STH_lR2d30d_km243', dict(build=_lag_average_model({'Rainf': ['2d', '30d']}, lambda: km_lin(243)),
+                               forcing_vars=STH + ['Rainf'],
+                               description="km243 Linear model with Swdown, Tair, RelHum, and Lagged Rainf (2d,30d)")),
 
     # 3km243 with lagged Wind
-    elif name == 'STH_lW2d30d_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Wind': ['2d', '30d']})
-        model = LagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(var_lags)
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, and Lagged Wind (2d,30d)"
+    ('STH_lW2d30d_km243', dict(build=_lag_average_model({'Wind': ['2d', '30d']}, lambda: km_lin(243)),
+                               forcing_vars=STH + ['Wind'],
+                               description="km243 Linear model with Swdown, Tair, RelHum, and Lagged Wind (2d,30d)")),
 
     # Lagged and non-lagged rainfall
-    elif name == 'STHR_lR_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Rainf': ['cur', '2d']})
-        model = LagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(var_lags)
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, Rainf, and Lagged Rainf (2d)"
+    ('STHR_lR_km243', dict(build=_lag_average_model({'Rainf': ['cur', '2d']}, lambda: km_lin(243)),
+                           forcing_vars=STH + ['Rainf'],
+                           description="km243 Linear model with Swdown, Tair, RelHum, Rainf, and Lagged Rainf (2d)")),
 
     # Markov-lagged Qle variants (doesn't seem to be working very well)
-    elif name == 'STH_lQle30min_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Qle': ['30min']})
-        model = MarkovLagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(['SWdown', 'Tair', 'RelHum'])
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (30min)"
-    elif name == 'STH_lQle1h_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Qle': ['1h']})
-        model = MarkovLagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(['SWdown', 'Tair', 'RelHum'])
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (1h)"
-    elif name == 'STH_lQle2d_km243':
-        var_lags = cur_3_var()
-        var_lags.update({'Qle': ['2d']})
-        model = MarkovLagAverageWrapper(var_lags, km_lin(243))
-        model.forcing_vars = list(['SWdown', 'Tair', 'RelHum'])
-        model.description = "km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (2d)"
+    ('STH_lQle30min_km243', dict(build=_markov_lag_model({'Qle': ['30min']}, lambda: km_lin(243)),
+                                 forcing_vars=STH,
+                                 description="km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (30min)")),
+    ('STH_lQle1h_km243', dict(build=_markov_lag_model({'Qle': ['1h']}, lambda: km_lin(243)),
+                              forcing_vars=STH,
+                              description="km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (1h)")),
+    ('STH_lQle2d_km243', dict(build=_markov_lag_model({'Qle': ['2d']}, lambda: km_lin(243)),
+                              forcing_vars=STH,
+                              description="km243 Linear model with Swdown, Tair, RelHum, and Markov-Lagged Qle (2d)")),
 
     # Neural network models
-    elif name == 'STH_MLP':
-        var_lags = cur_3_var()
-        model = LagAverageWrapper(var_lags, MLP((15, 10, 5, 10)))
-        model.forcing_vars = list(var_lags)
-        model.description = "Neural-network model with Swdown, Tair, RelHum"
-    elif name == 'STH_MLP_lR2d':
-        var_lags = cur_3_var()
-        var_lags.update({'Rainf': ['2d']})
-        model = LagAverageWrapper(var_lags, MLP((15, 10, 5, 10)))
-        model.forcing_vars = list(var_lags)
-        model.description = "Neural-network model with Swdown, Tair, RelHum, and Lagged Rainf (2d)"
+    ('STH_MLP', dict(build=_lag_average_model({}, lambda: MLP((15, 10, 5, 10))),
+                     forcing_vars=STH,
+                     description="Neural-network model with Swdown, Tair, RelHum")),
+    ('STH_MLP_lR2d', dict(build=_lag_average_model({'Rainf': ['2d']}, lambda: MLP((15, 10, 5, 10))),
+                          forcing_vars=STH + ['Rainf'],
+                          description="Neural-network model with Swdown, Tair, RelHum, and Lagged Rainf (2d)")),
 
     # Named parseable models
-    elif name == 'short_term243':
-        model = parse_model_name('STHWdTdQ_lT6hM_km243')
-        model.name = 'short_term243'
-    elif name == 'long_term243':
-        model = parse_model_name('STHWdTdQ_lS30d_lR30d_lH10d_lT6hM_km243')
-        model.name = 'long_term243'
-    elif name == 'long_term729':
-        model = parse_model_name('STHWdTdQ_lS30d_lR30d_lH10d_lT6hM_km729')
-        model.name = 'long_term729'
+    ('short_term243', dict(parsed='STHWdTdQ_lT6hM_km243')),
+    ('long_term243', dict(parsed='STHWdTdQ_lS30d_lR30d_lH10d_lT6hM_km243')),
+    ('long_term729', dict(parsed='STHWdTdQ_lS30d_lR30d_lH10d_lT6hM_km729')),
+])
 
-    else:
+
+def get_model_from_def(name):
+    """returns a scikit-learn style model/pipeline
+
+    :name: model name
+    :returns: scikit-learn style mode/pipeline
+
+    """
+    if name not in MODEL_DEFS:
         raise NameError("unknown model")
 
+    model_def = MODEL_DEFS[name]
+    if 'parsed' in model_def:
+        model = parse_model_name(model_def['parsed'])
+        model.name = name
+    else:
+        model = model_def['build']()
+        model.forcing_vars = list(model_def['forcing_vars'])
+        model.description = model_def['description']
+
     return model
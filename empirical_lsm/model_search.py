@@ -1,15 +1,14 @@
-import glob
 import os
 import pandas as pd
 
-from multiprocessing import Pool
-
 from matplotlib.cbook import dedent
 from datetime import datetime as dt
 from empirical_lsm.evaluate import get_metric_data
 from empirical_lsm.plots import get_PLUMBER_plot
-from empirical_lsm.offline_eval import dataframe_to_rst
-from empirical_lsm.models import get_model
+from empirical_lsm.offline_eval import dataframe_to_rst, model_details_rst
+from empirical_lsm.catalogue import list_artefacts, list_models, record_artefact
+from empirical_lsm import ledger
+from empirical_lsm.executors import get_executor
 
 import logging
 logger = logging.getLogger(__name__)
@@ -24,24 +23,11 @@ def model_site_index_rst(name):
 
     model_dir = 'source/models/' + name
 
-    try:
-        model = get_model(name)
-        try:
-            description = model.description
-        except:
-            description = "description missing"
-        description = dedent("""
-            {desc}
-
-            .. code:: python
-
-              `{model}`""").format(desc=description, model=model)
-    except:
-        description = "Description missing - unknown model"
+    description = model_details_rst(name)
 
     logger.info('Generating index for {n}.'. format(n=name))
 
-    model_run_files = sorted(glob.glob('{d}/{n}*.rst'.format(d=model_dir, n=name)))
+    model_run_files = [a['path'] for a in list_artefacts('rst', name) if a['site'] != '']
 
     sim_pages = [os.path.splitext(os.path.basename(m))[0] for m in model_run_files]
 
@@ -49,7 +35,7 @@ def model_site_index_rst(name):
 
     try:
         get_PLUMBER_plot(model_dir)
-        plot_files = glob.glob('{d}/figures/*.png'.format(d=model_dir))
+        plot_files = [a['path'] for a in list_artefacts('figure', name, site='')]
         rel_paths = ['figures/' + os.path.basename(p) for p in plot_files]
         plots = '\n\n'.join([
             ".. image :: {file}\n    :width: 300px".format(file=f) for f in sorted(rel_paths)])
@@ -91,6 +77,7 @@ def model_site_index_rst(name):
 
     with open(rst_index, 'w') as f:
         f.write(rst)
+    record_artefact(rst_index)
 
     return
 
@@ -169,58 +156,41 @@ def model_search_index_rst():
     return
 
 
-def newest_file(path):
-    """find the most recently modified file in a path
-
-    :path: directory under which to search
-    :returns: newest file mtime
-
-    """
-    walk = os.walk(path)
-    max_mtime = 0
-    for d in walk:
-        if len(d[2]) == 0:
-            continue
-        local_max = max([os.path.getmtime("%s/%s" % (d[0], f)) for f in d[2]])
-        max_mtime = max(max_mtime, local_max)
-
-    return max_mtime
-
-
 def model_site_index_as_needed(name, rebuild=False):
     """build index only if necessary
 
-    :model_dir: TODO
-    :returns: TODO
+    The index is up to date if the ledger has it built from the same metrics, figures
+    and site pages (see empirical_lsm.ledger).
 
+    :name: model name
+    :rebuild: rebuild even if the index is up to date
     """
     model_dir = "source/models/%s" % name
     rst_path = "{d}/index.rst".format(d=model_dir)
 
-    if rebuild:
-        # Path needs (re)building
-        model_site_index_rst(name)
-    else:
-        if not os.path.exists(rst_path):
-            model_site_index_rst(name)
-        else:
-            # for 'all' only regenerate pages that need it.
-            newest = newest_file(model_dir)
-            # TODO: this doesn't seem to work..
-            if newest > os.path.getmtime(rst_path):
-                model_site_index_rst(name)
-            else:
-                logger.info("skipping %s - rst is up to date" % model_dir)
-
+    input_hash = ledger.get_input_hash(name, None, 'index')
+    if not rebuild and os.path.exists(rst_path) and ledger.is_up_to_date(name, None, 'index', input_hash):
+        logger.info("skipping %s - rst is up to date" % model_dir)
+        return
 
-def get_available_model_dirs():
-    """Searches for existing model output, and returns model paths."""
-    return [d for d in sorted(glob.glob('source/models/*')) if os.path.isdir(d)]
+    t_start = dt.now()
+    ledger.start_job(name, None, 'index', input_hash)
+    try:
+        model_site_index_rst(name)
+    except Exception as e:
+        ledger.finish_job(name, None, 'index', (dt.now() - t_start).total_seconds(), repr(e))
+        raise
+    ledger.finish_job(name, None, 'index', (dt.now() - t_start).total_seconds())
 
 
 def get_available_models():
     """Searches for existing model output, and returns model names."""
-    return [d.replace('source/models/', '') for d in get_available_model_dirs()]
+    return list_models(kinds=['metrics', 'figure', 'rst'])
+
+
+def get_available_model_dirs():
+    """Searches for existing model output, and returns model paths."""
+    return ['source/models/' + n for n in get_available_models()]
 
 
 def model_site_index_rst_mp(names, rebuild=False, no_mp=False):
@@ -231,5 +201,5 @@ def model_site_index_rst_mp(names, rebuild=False, no_mp=False):
     else:
         ncores = min(os.cpu_count(), 1 + int(os.cpu_count() * 0.5))
         f_args = zip(names, [rebuild] * len(names))
-        with Pool(ncores) as p:
-            p.starmap(model_site_index_as_needed, f_args)
+        with get_executor(ncores) as ex:
+            ex.starmap(model_site_index_as_needed, f_args)
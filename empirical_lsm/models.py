@@ -20,6 +20,145 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+#################
+# Model registry
+#################
+
+class ModelSpec(object):
+
+    """Model metadata, with lazy model construction
+
+    Metadata (description, forcing variables, lags, and the definition entry the model
+    is built from) is available without constructing the model. build() constructs a
+    new, unfitted model each time.
+    """
+
+    def __init__(self, name, source, builder, description=None, forcing_vars=None,
+                 var_lags=None, definition=None):
+        self.name = name
+        self.source = source
+        self._builder = builder
+        self.description = description
+        self.forcing_vars = forcing_vars
+        self.var_lags = var_lags
+        # plain dict describing the model's structure (e.g. its yaml entry)
+        self.definition = definition
+
+    def build(self):
+        """Construct a new model"""
+        model = self._builder()
+        if not hasattr(model, 'name'):
+            model.name = self.name
+
+        return model
+
+    def __repr__(self):
+        return "ModelSpec({n!r}, source={s!r})".format(n=self.name, s=self.source)
+
+
+# Parsed once per process, see get_yaml_models
+_yaml_models = None
+
+# Memoised model specs, by name
+_model_specs = {}
+
+
+def get_yaml_models():
+    """All model definitions in model_search.yaml (parsed once per process)"""
+    global _yaml_models
+    if _yaml_models is None:
+        filename = pkg_resources.resource_filename('empirical_lsm', 'data/model_search.yaml')
+        with open(filename) as f:
+            _yaml_models = yaml.safe_load(f)
+
+    return _yaml_models
+
+
+def get_def_spec(name):
+    """Spec for a model defined in model_defs, or None"""
+    from .model_defs import MODEL_DEFS
+
+    if name not in MODEL_DEFS:
+        return None
+
+    model_def = MODEL_DEFS[name]
+    if 'parsed' in model_def:
+        spec = get_parsed_spec(model_def['parsed'])
+        return ModelSpec(name, 'def', lambda: get_model_from_def(name), spec.description,
+                         spec.forcing_vars, spec.var_lags,
+                         dict(model_defs=name, parsed=model_def['parsed'], **spec.definition))
+
+    return ModelSpec(name, 'def', lambda: get_model_from_def(name), model_def['description'],
+                     list(model_def['forcing_vars']), model_def.get('var_lags', None),
+                     dict(model_defs=name))
+
+
+def get_yaml_spec(name):
+    """Spec for a model defined in model_search.yaml, or None"""
+    yaml_models = get_yaml_models()
+    if name not in yaml_models:
+        return None
+
+    model_dict = yaml_models[name]
+
+    return ModelSpec(name, 'yaml', lambda: get_model_from_dict(model_dict),
+                     model_dict.get('description', None),
+                     model_dict.get('forcing_vars', get_config(['vars', 'met'])),
+                     model_dict.get('var_lags', None), model_dict)
+
+
+def get_parsed_spec(name):
+    """Spec for a parseable model name, or None"""
+    from .model_defs import parse_model_spec, build_parsed_model
+
+    try:
+        parsed = parse_model_spec(name)
+    except (NameError, AttributeError, KeyError, IndexError):
+        return None
+
+    return ModelSpec(name, 'parsed', lambda: build_parsed_model(parsed), parsed['description'],
+                     parsed['forcing_vars'], parsed['var_lags'],
+                     dict(model=parsed['model_name'], k=parsed['k']))
+
+
+# Model sources, in order of precedence
+MODEL_SOURCES = [
+    ('model_defs module', get_def_spec),
+    ('yaml', get_yaml_spec),
+    ('name', get_parsed_spec),
+]
+
+
+def get_model_spec(name):
+    """Get a (memoised) model spec by name
+
+    :raises: KeyError for unknown models
+    """
+    if name not in _model_specs:
+        for source, get_spec in MODEL_SOURCES:
+            spec = get_spec(name)
+            if spec is not None:
+                logger.debug("Model {n} found in {s}".format(n=name, s=source))
+                _model_specs[name] = spec
+                break
+        else:
+            raise KeyError("Unknown model {n}".format(n=name))
+
+    return _model_specs[name]
+
+
+def get_model_description(name):
+    """Description of a model, without constructing it"""
+    try:
+        spec = get_model_spec(name)
+    except KeyError:
+        return "Description missing - unknown model"
+    if spec.description is None:
+        return "description missing"
+
+    return spec.description
+
+
 #################
 # Model loaders
 #################
@@ -31,40 +170,30 @@ def get_model(name):
     :returns: scikit-learn style mode/pipeline
 
     """
-
     try:
-        from .model_defs import get_model_from_def
-        model = get_model_from_def(name)
-        logger.info("Model {n} loaded from model_defs module".format(n=name))
-    except NameError:
-        try:
-            model = get_model_from_yaml(name)
-            logger.info("Model {n} loaded from yaml".format(n=name))
-        except KeyError:
-            try:
-                from .model_defs import parse_model_name
-                model = parse_model_name(name)
-                logger.info("Model {n} parsed from name".format(n=name))
-            except NameError:
-                sys.exit("Unknown model {n}".format(n=name))
-
-    if not hasattr(model, 'name'):
-        model.name = name
+        spec = get_model_spec(name)
+    except KeyError:
+        sys.exit("Unknown model {n}".format(n=name))
+
+    model = spec.build()
+    logger.info("Model {n} loaded from {s}".format(n=name, s=spec.source))
 
     return model
 
 
+def get_model_from_def(name):
+    """return a model defined in the model_defs module"""
+    from .model_defs import get_model_from_def
+    return get_model_from_def(name)
+
+
 def get_model_from_yaml(name):
     """return a model as defines in model_search.yaml
 
     :returns: sklearn model pipeline
 
     """
-    filename = pkg_resources.resource_filename('empirical_lsm', 'data/model_search.yaml')
-    with open(filename) as f:
-        model_dict = yaml.load(f)[name]
-
-    return get_model_from_dict(model_dict)
+    return get_model_from_dict(get_yaml_models()[name])
 
 
 def get_model_from_dict(model_dict):
@@ -96,9 +225,11 @@ def get_model_from_dict(model_dict):
         from empirical_lsm.clusterregression import ModelByCluster
         clusterer = model_dict['clusterregression']['class']
         cluster_args = model_dict['clusterregression']['args']
+        cluster_sample = model_dict['clusterregression'].get('sample', None)
+        min_cluster_size = model_dict['clusterregression'].get('min_cluster_size', None)
         model = ModelByCluster(
             get_clusterer(clusterer, cluster_args),
-            model)
+            model, cluster_sample=cluster_sample, min_cluster_size=min_cluster_size)
 
     pipe_list.append(model)
 
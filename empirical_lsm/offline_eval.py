@@ -9,10 +9,8 @@ Description: Evaluation functions for offline runs
 """
 
 import xarray as xr
+import yaml
 import os
-import glob
-
-from multiprocessing import Pool
 
 from matplotlib.cbook import dedent
 from datetime import datetime as dt
@@ -23,8 +21,11 @@ from pals_utils.logging import setup_logger
 
 from empirical_lsm.evaluate import evaluate_simulation, load_sim_evaluation
 from empirical_lsm.plots import diagnostic_plots
-from empirical_lsm.data import get_sim_nc_path
-from empirical_lsm.models import get_model
+from empirical_lsm.sim_store import open_sim, write_sim
+from empirical_lsm.catalogue import record_artefact, list_artefacts
+from empirical_lsm.models import get_model_spec, get_model_description
+from empirical_lsm.profiling import profiled
+from empirical_lsm.executors import get_executor
 
 import logging
 logger = logging.getLogger(__name__)
@@ -36,6 +37,33 @@ def dataframe_to_rst(dataframe):
     return tabulate(dataframe.round(4), headers='keys', tablefmt='rst')
 
 
+def model_details_rst(name):
+    """Model description and structure as rst, from the model spec
+
+    The structure (source, forcing variables, lags, and the model's definition entry)
+    is rendered without constructing the model.
+    """
+    try:
+        spec = get_model_spec(name)
+    except KeyError:
+        return "Description missing - unknown model"
+
+    details = ['source: {s}'.format(s=spec.source),
+               'forcing_vars: {fvs}'.format(fvs=spec.forcing_vars)]
+    if spec.var_lags is not None:
+        details.append('var_lags: {l}'.format(l=dict(spec.var_lags)))
+    if spec.definition is not None:
+        definition = dict((k, v) for k, v in spec.definition.items() if k != 'description')
+        details += yaml.safe_dump(definition, default_flow_style=False).splitlines()
+
+    return dedent("""
+        {desc}
+
+        .. code:: python
+
+          {details}""").format(desc=get_model_description(name), details='\n  '.join(details))
+
+
 def model_site_rst_format(name, site, eval_text, plot_files):
     """format all the datas into an rst!
     """
@@ -53,32 +81,7 @@ def model_site_rst_format(name, site, eval_text, plot_files):
     title = '{name} at {site}'.format(name=name, site=site)
     title += '\n' + '=' * len(title)
 
-    try:
-        model = get_model(name)
-    except:
-        model = None
-
-    if hasattr(model, "_var_lags"):
-        forcing_vars = model._var_lags
-    elif hasattr(model, "forcing_vars"):
-        forcing_vars = model.forcing_vars
-    else:
-        forcing_vars = None
-
-    if model is not None:
-        try:
-            description = model.description
-        except:
-            description = "description missing"
-        description = dedent("""
-            {desc}
-
-            .. code:: python
-
-              {model}
-              {fvs}""").format(desc=description, model=model, fvs=forcing_vars)
-    else:
-        description = "Description missing - unknown model"
+    description = model_details_rst(name)
 
     template = dedent("""
     {title}
@@ -103,8 +106,7 @@ def model_site_rst_format(name, site, eval_text, plot_files):
     {plots}
     """)
 
-    output = (template.format(model=model,
-                              title=title,
+    output = (template.format(title=title,
                               desc=description,
                               plots=plots_text,
                               date=date,
@@ -132,11 +134,14 @@ def model_site_rst_write(name, site, eval_results, plot_files):
 
     with open(model_site_rst_file, 'w') as f:
         f.write(output)
+    record_artefact(model_site_rst_file)
 
     return
 
 
-def eval_simulation(name, site, sim_file=None, plots=False, fix_closure=True, qc=True):
+@profiled('eval')
+def eval_simulation(name, site, sim_file=None, plots=False, fix_closure=True, qc=True,
+                    raise_errors=False):
     """Main function for evaluating an existing simulation.
 
     Copies simulation data to source directory.
@@ -146,6 +151,8 @@ def eval_simulation(name, site, sim_file=None, plots=False, fix_closure=True, qc
     :name: name of the model
     :site: PALS site name to run the model at
     :sim_file: Path to simulation netcdf. Only required if simulation is at a non-standard place.
+    :raise_errors: raise if the simulation can't be opened, instead of logging and skipping the
+        site (e.g. so the scheduler's ledger records a failure rather than a done eval)
     """
     args = locals()
     args_str = '\n'.join([k + ': ' + str(args[k]) for k in sorted(args.keys())])
@@ -153,22 +160,21 @@ def eval_simulation(name, site, sim_file=None, plots=False, fix_closure=True, qc
     logger = setup_logger(__name__, 'logs/eval/{m}/{s}/{m}_{s}.log'.format(m=name, s=site))
     logger.info("Evaluating model.\nArgs:\n{a}".format(a=args_str))
 
-    nc_path = get_sim_nc_path(name, site)
-
-    if sim_file is None:
-        filename = nc_path
-    else:
-        filename = sim_file
-
     try:
-        sim_data = xr.open_dataset(filename)
+        if sim_file is None:
+            sim_data = open_sim(name, site)
+        else:
+            sim_data = xr.open_dataset(sim_file)
     except (OSError, RuntimeError) as e:
-        logger.error("Sim file ({f}) doesn't exist. What are you doing? {e}".format(f=filename, e=e))
+        logger.error("Sim data for {n} at {s} doesn't exist. What are you doing? {e}".format(n=name, s=site, e=e))
+        if raise_errors:
+            raise
         return
 
     if sim_file is not None:
         # WARNING! over writes existing sim!
-        sim_data.to_netcdf(nc_path)
+        sim_data.load()
+        write_sim(sim_data, name, site)
 
     flux_data = get_flux_data([site], fix_closure=fix_closure)[site]
 
@@ -200,13 +206,15 @@ def get_existing_plots(name, site):
 
     flux_vars = ['Qle', 'Qh', 'NEE']
 
+    site_plots = [os.path.basename(a['path']) for a in list_artefacts('figure', name, site)]
     for v in flux_vars:
-        plots[v] = ['figures/{s}/{p}'.format(s=site, p=os.path.basename(p)) for p in
-                    sorted(glob.glob('{d}/{s}/{n}_{v}_{s}_*.png'.format(d=plot_dir, n=name, v=v, s=site)))]
+        prefix = '{n}_{v}_{s}_'.format(n=name, v=v, s=site)
+        plots[v] = ['figures/{s}/{p}'.format(s=site, p=p) for p in site_plots if p.startswith(prefix)]
 
     return plots
 
 
+@profiled('rst')
 def main_rst_gen(name, site):
     """Main function for formatting existing simulation evaluations and plots
 
@@ -246,8 +254,8 @@ def eval_simulation_mp(name, site, sim_file=None, plots=False, no_mp=False,
         else:
             f_args = [[name, s, None, plots, fix_closure, qc] for s in datasets]
             ncores = min(os.cpu_count(), 1 + int(os.cpu_count() * 0.5))
-            with Pool(ncores) as p:
-                p.starmap(eval_simulation, f_args)
+            with get_executor(ncores) as ex:
+                ex.starmap(eval_simulation, f_args)
 
 
 def main_rst_gen_mp(name, site, sim_file=None, no_mp=False):
@@ -269,8 +277,8 @@ def main_rst_gen_mp(name, site, sim_file=None, no_mp=False):
         else:
             f_args = [[name, s] for s in datasets]
             ncores = min(os.cpu_count(), 2 + int(os.cpu_count() * 0.25))
-            with Pool(ncores) as p:
-                p.starmap(main_rst_gen, f_args)
+            with get_executor(ncores) as ex:
+                ex.starmap(main_rst_gen, f_args)
 
     else:
         main_rst_gen(name, site)
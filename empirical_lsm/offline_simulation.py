@@ -8,7 +8,6 @@ Github: https://github.com/naught101/empirical_lsm
 Description: Helper functions for running offline simulations.
 """
 
-import pandas as pd
 import numpy as np
 import sys
 import os
@@ -17,17 +16,26 @@ import psutil
 import pickle
 
 from copy import deepcopy
+from collections import OrderedDict
 from datetime import datetime as dt
 
-from multiprocessing import Pool
-
 from pals_utils.data import get_config, get_sites
 from pals_utils.logging import setup_logger
 
 from empirical_lsm.transforms import LagWrapper, LagAverageWrapper
 from empirical_lsm.models import get_model
-from empirical_lsm.data import sim_dict_to_xr, get_train_test_data
+from empirical_lsm.data import sim_dict_to_xr, sim_array_to_xr, get_sim_buffer, get_train_test_data, \
+    get_train_store, get_train_sites
+from empirical_lsm.training_store import share_store, release_blocks, init_worker
 from empirical_lsm.checks import model_sanity_check, run_var_checks
+from empirical_lsm.sim_store import sim_exists, write_sim
+from empirical_lsm.model_cache import fit_cached
+from empirical_lsm.resource_model import record_resources, get_pool_size, get_n_training_samples
+from empirical_lsm.instrument import stage, start_session, get_sim_attrs, write_profile
+from empirical_lsm.profiling import profiled
+from empirical_lsm.executors import get_executor, EXECUTOR_CONFIG
+from empirical_lsm.thread_budget import get_thread_split, get_thread_limit, get_total_threads, \
+    init_worker as init_worker_threads
 
 import logging
 logger = logging.getLogger(__name__)
@@ -50,80 +58,127 @@ def bytes_human_readable(n):
 
 def fit_univariate(model, flux_vars, train_data):
     models = {}
+    train_set = train_data["train_set"]
+    met_train = None
     for v in flux_vars:
         # TODO: Might eventually want to update this to run multivariate-out models
         # There isn't much point right now, because there is almost no data where all variables are available.
-        flux_train_v = train_data["flux_train"][[v]]
-
         models[v] = deepcopy(model)
 
         if hasattr(models[v], 'partial_data_ok'):
             # model accepts partial data
             logger.info("Training {v} using all (possibly incomplete) data.".format(v=v))
-            models[v].fit(X=train_data["met_train"], y=flux_train_v)
+            if met_train is None:
+                met_train = train_set.frame('met')
+            models[v].fit(X=met_train, y=train_set.frame('flux', [v]))
         else:
             # Ditch all of the incomplete data
-            qc_index = (~pd.concat([train_data["met_train"], flux_train_v], axis=1).isnull()).apply(all, axis=1)
-            if qc_index.sum() > 0:
+            qc_rows = train_set.complete_rows(met_vars=train_data["met_vars"], flux_vars=[v])
+            if len(qc_rows) > 0:
                 logger.info("Training {v} using {count} complete samples out of {total}"
-                            .format(v=v, count=qc_index.sum(),
-                                    total=train_data["met_train"].shape[0]))
+                            .format(v=v, count=len(qc_rows), total=train_set.n_rows))
             else:
                 logger.warning("No training data, skipping variable %s" % v)
                 continue
 
-            models[v].fit(X=train_data["met_train"][qc_index], y=flux_train_v[qc_index])
+            models[v].fit(X=train_set.frame('met', rows=qc_rows),
+                          y=train_set.frame('flux', [v], rows=qc_rows))
         logger.info("Fitting complete.")
 
     return(models)
 
 
-def predict_univariate(var_models, flux_vars, test_data):
-    sim_data_dict = dict()
+def uses_shared_features(model):
+    """Whether a model can fit all flux variables on one shared feature matrix"""
+    return hasattr(model, 'partial_data_ok') and getattr(model, 'shared_features_ok', False)
 
-    for v in flux_vars:
-        sim_data_dict[v] = var_models[v].predict(test_data["met_test"])
-        logger.info("Prediction complete for {v}.".format(v=v))
 
-        if run_var_checks(sim_data_dict[v]):
-            name = "%s_%s_%s" % (var_models[v].name, v, test_data["site"])
-            save_model_structure(var_models[v], name)
+def fit_univariate_shared(model, flux_vars, train_data):
+    """Fits one output variable at a time, on shared features
+
+    Lagged features (and clusters, for cluster models) are computed once for all
+    variables, only the per-variable regressions are fitted separately.
+    """
+    train_set = train_data["train_set"]
+    model = deepcopy(model)
 
-    if len(sim_data_dict) < 1:
+    logger.info("Training {v} on shared features, using all (possibly incomplete) data.".format(v=flux_vars))
+    flux_train = train_set.frame('flux', flux_vars)
+    model.fit_multi(train_set.frame('met'), OrderedDict((v, flux_train[[v]]) for v in flux_vars))
+    logger.info("Fitting complete.")
+
+    return model
+
+
+def predict_univariate(var_models, flux_vars, test_data):
+    """Predict each flux variable
+
+    :var_models: dict of fitted models by variable, or a model fitted with fit_univariate_shared
+    """
+    if len(flux_vars) < 1:
         logger.warning("No fluxes successfully fitted, quitting")
         sys.exit()
 
-    sim_data = sim_dict_to_xr(sim_data_dict, test_data["met_test_xr"])
+    sim_array = get_sim_buffer(test_data["met_test_xr"], flux_vars)
+
+    if isinstance(var_models, dict):
+        predictions = None
+    else:
+        predictions = var_models.predict_multi(test_data["met_test"])
+
+    for i, v in enumerate(flux_vars):
+        if predictions is None:
+            sim_array[:, i] = np.ravel(var_models[v].predict(test_data["met_test"]))
+        else:
+            sim_array[:, i] = np.ravel(predictions[v])
+        logger.info("Prediction complete for {v}.".format(v=v))
+
+        if run_var_checks(sim_array[:, i]):
+            model = var_models if predictions is not None else var_models[v]
+            name = "%s_%s_%s" % (model.name, v, test_data["site"])
+            save_model_structure(model, name)
+
+    sim_data = sim_array_to_xr(sim_array, flux_vars, test_data["met_test_xr"])
 
     return sim_data
 
 
-def fit_predict_univariate(model, flux_vars, train_test_data):
-    """Fits a model one output variable at a time """
+def fit_predict_univariate(model, flux_vars, train_test_data, use_cache=True, shared_features=True):
+    """Fits a model one output variable at a time
 
-    var_models = fit_univariate(model, flux_vars, train_test_data)
+    :shared_features: compute features once for all variables, if the model supports it
+    """
+    with stage('fit'):
+        if shared_features and uses_shared_features(model):
+            var_models = fit_cached(lambda: fit_univariate_shared(model, flux_vars, train_test_data),
+                                    model, train_test_data["train_set"], flux_vars, 'univariate_shared', use_cache)
+        else:
+            var_models = fit_cached(lambda: fit_univariate(model, flux_vars, train_test_data),
+                                    model, train_test_data["train_set"], flux_vars, 'univariate', use_cache)
 
-    sim_data = predict_univariate(var_models, flux_vars, train_test_data)
+    with stage('predict'):
+        sim_data = predict_univariate(var_models, flux_vars, train_test_data)
 
     return sim_data
 
 
 def fit_multivariate(model, flux_vars, train_data):
+    train_set = train_data["train_set"]
     if hasattr(model, 'partial_data_ok'):
             # model accepts partial data
         logger.info("Training {v} using all (possibly incomplete) data.".format(v=flux_vars))
-        model.fit(X=train_data["met_train"], y=train_data["flux_train"])
+        model.fit(X=train_set.frame('met'), y=train_set.frame('flux', flux_vars))
     else:
         # Ditch all of the incomplete data
-        qc_index = (~pd.concat([train_data["met_train"], train_data["flux_train"]], axis=1).isnull()).apply(all, axis=1)
-        if qc_index.sum() > 0:
+        qc_rows = train_set.complete_rows(met_vars=train_data["met_vars"], flux_vars=flux_vars)
+        if len(qc_rows) > 0:
             logger.info("Training {v} using {count} complete samples out of {total}"
-                        .format(v=flux_vars, count=qc_index.sum(), total=train_data["met_train"].shape[0]))
+                        .format(v=flux_vars, count=len(qc_rows), total=train_set.n_rows))
         else:
             logger.warning("No training data, failing")
             return
 
-        model.fit(X=train_data["met_train"][qc_index], y=train_data["flux_train"][qc_index])
+        model.fit(X=train_set.frame('met', rows=qc_rows), y=train_set.frame('flux', flux_vars, rows=qc_rows))
     logger.info("Fitting complete.")
 
     return model
@@ -134,21 +189,24 @@ def predict_multivariate(model, flux_vars, test_data):
     sim_data = model.predict(test_data["met_test"])
     logger.info("Prediction complete.")
 
-    # TODO: some models return arrays... convert to dicts in that case.
+    # Some models return arrays, others dataframes
     if isinstance(sim_data, np.ndarray):
-        sim_data = {v: sim_data[:, i] for i, v in enumerate(flux_vars)}
-
-    sim_data = sim_dict_to_xr(sim_data, test_data["met_test_xr"])
+        sim_data = sim_array_to_xr(sim_data, flux_vars, test_data["met_test_xr"])
+    else:
+        sim_data = sim_dict_to_xr(sim_data, test_data["met_test_xr"])
 
     return sim_data
 
 
-def fit_predict_multivariate(model, flux_vars, train_test_data):
+def fit_predict_multivariate(model, flux_vars, train_test_data, use_cache=True):
     """Fits a model multiple outputs variable at once"""
 
-    model = fit_multivariate(model, flux_vars, train_test_data)
+    with stage('fit'):
+        model = fit_cached(lambda: fit_multivariate(model, flux_vars, train_test_data),
+                           model, train_test_data["train_set"], flux_vars, 'multivariate', use_cache)
 
-    sim_data = predict_multivariate(model, flux_vars, train_test_data)
+    with stage('predict'):
+        sim_data = predict_multivariate(model, flux_vars, train_test_data)
 
     return sim_data
 
@@ -167,43 +225,60 @@ def add_sim_metadata(sim_data, name, model, site, met_vars, **kwargs):
     sim_data.attrs.update(kwargs)
 
 
-def fit_predict(model, name, site, multivariate=False, fix_closure=True):
+def get_model_met_vars(model):
+    """Forcing variables used by a model"""
+    if hasattr(model, 'forcing_vars'):
+        return model.forcing_vars
+    else:
+        logger.warning("Warning: no forcing vars, using defaults (all)")
+        return get_config(['vars', 'met'])
+
+
+def fit_predict(model, name, site, multivariate=False, fix_closure=True, use_cache=True):
     """Fit and predict a model
 
     :model: sklearn-style model or pipeline (regression estimator)
     :name: name of the model
     :site: PALS site name to run the model at
+    :use_cache: reuse an identical cached fit, if there is one (see empirical_lsm.model_cache)
     :returns: xarray dataset of simulation
 
     """
-    if hasattr(model, 'forcing_vars'):
-        met_vars = model.forcing_vars
-    else:
-        logger.warning("Warning: no forcing vars, using defaults (all)")
-        met_vars = get_config(['vars', 'met'])
+    met_vars = get_model_met_vars(model)
 
     use_names = isinstance(model, (LagWrapper, LagAverageWrapper))
 
-    train_test_data = get_train_test_data(site, met_vars, get_config(['vars', 'flux']), use_names, fix_closure=True)
+    train_test_data = get_train_test_data(site, met_vars, get_config(['vars', 'flux']), use_names,
+                                          fix_closure=fix_closure)
 
     logger.info("Running {n} at {s}".format(n=name, s=site))
 
     logger.info('Fitting and running {f} using {m}'.format(f=get_config(['vars', 'flux']), m=met_vars))
     t_start = dt.now()
-    if multivariate:
-        sim_data = fit_predict_multivariate(model, get_config(['vars', 'flux']), train_test_data)
-    else:
-        sim_data = fit_predict_univariate(model, get_config(['vars', 'flux']), train_test_data)
+    with stage('fit_predict') as timing:
+        if multivariate:
+            sim_data = fit_predict_multivariate(model, get_config(['vars', 'flux']), train_test_data, use_cache)
+        else:
+            sim_data = fit_predict_univariate(model, get_config(['vars', 'flux']), train_test_data, use_cache)
+    run_seconds = (dt.now() - t_start).total_seconds()
     run_time = str(dt.now() - t_start).split('.')[0]
 
     process = psutil.Process(os.getpid())
-    mem_usage = bytes_human_readable(process.memory_info().rss)
+    rss = process.memory_info().rss
+    mem_usage = bytes_human_readable(rss)
+
+    # Sampled peak RSS if instrumentation is enabled, otherwise current RSS
+    peak_rss = rss if timing is None else max(rss, timing['peak_rss'])
+    record_resources(model, train_test_data["train_set"].n_rows, peak_rss, run_seconds,
+                     n_outputs=len(get_config(['vars', 'flux'])), site=site, multivariate=multivariate,
+                     threads=get_thread_limit())
 
     logger.info("Model fit and run in %s, using %s memory." % (run_time, mem_usage))
 
     add_sim_metadata(sim_data, name, model, site, met_vars,
                      Fit_predict_time=run_time,
-                     Fit_predict_mem_usage=mem_usage)
+                     Fit_predict_mem_usage=mem_usage,
+                     **get_sim_attrs())
 
     return sim_data
 
@@ -223,6 +298,7 @@ def save_model_structure(model, name='None'):
     return
 
 
+@profiled('run')
 def run_simulation(model, name, site, multivariate=False, overwrite=False, fix_closure=True):
     """Main function for fitting and running a model.
 
@@ -233,12 +309,7 @@ def run_simulation(model, name, site, multivariate=False, overwrite=False, fix_c
     args = locals()
     args_str = '\n'.join([k + ': ' + str(args[k]) for k in sorted(args.keys())])
 
-    sim_dir = 'model_data/{n}'.format(n=name)
-    os.makedirs(sim_dir, exist_ok=True)
-
-    nc_file = '{d}/{n}_{s}.nc'.format(d=sim_dir, n=name, s=site)
-
-    if os.path.isfile(nc_file) and not overwrite:
+    if sim_exists(name, site) and not overwrite:
         logger.warning("Sim netcdf already exists for {n} at {s}, use --overwrite to re-run."
                        .format(n=name, s=site))
         return
@@ -246,12 +317,16 @@ def run_simulation(model, name, site, multivariate=False, overwrite=False, fix_c
     run_logger = setup_logger(__name__, 'logs/run/{m}/{s}/{m}_{s}.log'.format(m=name, s=site))
     run_logger.info("Running model.\nArgs:\n{a}".format(a=args_str))
 
+    start_session()
+
     for i in range(3):
         # We attempt to run the model up to 3 times, incase of numerical problems
         try:
+            # Retries must refit, rather than reloading the same cached fit
             sim_data = fit_predict(model, name, site,
                                    multivariate=multivariate,
-                                   fix_closure=fix_closure)
+                                   fix_closure=fix_closure,
+                                   use_cache=(i == 0))
         except AssertionError as e:
             logger.exception("Model failed: " + str(e))
             return
@@ -271,17 +346,74 @@ def run_simulation(model, name, site, multivariate=False, overwrite=False, fix_c
             # model run successful, presumably
             break
 
-    if os.path.isfile(nc_file):
-        logger.warning("Overwriting sim file at {f}".format(f=nc_file))
-    else:
-        logger.info("Writing sim file at {f}".format(f=nc_file))
+    if sim_exists(name, site):
+        logger.warning("Overwriting sim data for {n} at {s}".format(n=name, s=site))
 
     # if site != 'debug':
-    sim_data.to_netcdf(nc_file)
+    with stage('write'):
+        nc_file = write_sim(sim_data, name, site)
+    logger.info("Wrote sim data to {f}".format(f=nc_file))
+
+    write_profile(name=name, site=site, multivariate=multivariate)
 
     return
 
 
+def share_train_stores(models, fix_closure=True):
+    """Load training stores once in the parent process, for sharing with Pool workers
+
+    :models: list of models that will be run
+    :returns: (handles for training_store.init_worker, shared memory blocks to release)
+    """
+    handles = []
+    blocks = []
+    seen = set()
+    for model in models:
+        met_vars = get_model_met_vars(model)
+        if tuple(met_vars) in seen:
+            continue
+        seen.add(tuple(met_vars))
+
+        store = get_train_store(met_vars, get_config(['vars', 'flux']), fix_closure=fix_closure)
+        handle, store_blocks = share_store(store)
+        handles.append(handle)
+        blocks += store_blocks
+
+    return handles, blocks
+
+
+def run_pool(ncores, f_args, models, fix_closure=True, n_threads=1):
+    """Run simulations on the configured executor
+
+    With the local executor, training data is shared between the Pool workers.
+    Each task's BLAS/OpenMP threads are limited to n_threads with either executor.
+    """
+    if EXECUTOR_CONFIG['backend'] != 'local':
+        with get_executor(ncores, n_threads=n_threads) as ex:
+            ex.starmap(run_simulation, f_args)
+        return
+
+    handles, blocks = share_train_stores(models, fix_closure)
+    try:
+        with get_executor(ncores, initializer=init_worker_threads,
+                          initargs=(n_threads, init_worker, (handles,))) as ex:
+            ex.starmap(run_simulation, f_args)
+    finally:
+        release_blocks(blocks)
+
+
+def get_pool_split(models):
+    """Number of pool processes and threads per process for running models
+
+    Processes are limited by the models' estimated memory use, and processes x threads by the thread budget.
+    """
+    train_vars = get_config(['vars', 'met']) + get_config(['vars', 'flux'])
+    n_samples = get_n_training_samples(get_train_sites(), train_vars)
+    max_processes = get_pool_size(models, n_samples, max_cores=get_total_threads())
+
+    return get_thread_split(models, n_samples, max_processes)
+
+
 def run_model_site_tuples_mp(tuples_list, no_mp=False, multivariate=False, overwrite=False, fix_closure=True):
     """Run (model, site) pairs"""
 
@@ -295,10 +427,8 @@ def run_model_site_tuples_mp(tuples_list, no_mp=False, multivariate=False, overw
     if no_mp:
         [run_simulation(*args) for args in f_args]
     else:  # multiprocess
-        ncores = get_suitable_ncores()
-        # TODO: Deal with memory requirement?
-        with Pool(ncores) as p:
-            p.starmap(run_simulation, f_args)
+        ncores, n_threads = get_pool_split(list(all_models.values()))
+        run_pool(ncores, f_args, list(all_models.values()), fix_closure, n_threads)
 
 
 def run_simulation_mp(name, site, no_mp=False, multivariate=False, overwrite=False, fix_closure=True):
@@ -315,13 +445,10 @@ def run_simulation_mp(name, site, no_mp=False, multivariate=False, overwrite=Fal
                 run_simulation(model, name, s, multivariate, overwrite, fix_closure)
         else:
             f_args = [(model, name, s, multivariate, overwrite, fix_closure) for s in datasets]
-            ncores = get_suitable_ncores()
-            if site is not 'debug' and hasattr(model, 'memory_requirement'):
-                ncores = max(1, int((psutil.virtual_memory().total / 2) // model.memory_requirement))
-            logger.info("Running on %d core(s)" % ncores)
+            ncores, n_threads = get_pool_split([model])
+            logger.info("Running on %d core(s), %d thread(s) each" % (ncores, n_threads))
 
-            with Pool(ncores) as p:
-                p.starmap(run_simulation, f_args)
+            run_pool(ncores, f_args, [model], fix_closure, n_threads)
     else:
         run_simulation(model, name, site, multivariate, overwrite, fix_closure)
 
@@ -14,19 +14,22 @@ import seaborn as sns
 import pandas as pd
 import os
 import numpy as np
-import xarray as xr
 
 from dateutil.parser import parse
 
 from pals_utils.data import pals_site_name, pals_xr_to_df
 
 from .evaluate import get_PLUMBER_metrics, subset_metric_df, quantile_normalise
+from .sim_store import open_sim
+from .catalogue import record_artefact
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-sns.set_style('darkgrid')
+def set_style():
+    """Plot style for all empirical_lsm plots (see empirical_lsm.init)"""
+    sns.set_style('darkgrid')
 
 
 def empirical_lsm_palette(name="Final ensemble"):
@@ -55,6 +58,7 @@ def save_figure(path, fig=None):
     dir_path = os.path.dirname(path)
     os.makedirs(dir_path, exist_ok=True)
     fig.savefig(path)
+    record_artefact(path)
     logger.info('Figure saved to ' + os.path.abspath(path))
 
     pl.close(fig)
@@ -74,6 +78,7 @@ def save_plot(base_path, rel_path, filename):
     plot_path = os.path.join(dir_path, filename)
     pl.savefig(plot_path)
     pl.close()
+    record_artefact(plot_path)
 
     return os.path.join(rel_path, filename)
 
@@ -86,11 +91,7 @@ def get_benchmark(name, site):
     :returns: xarray dataset
 
     """
-    file_path = 'model_data/{name}/{name}_{site}.nc'
-
-    benchmark = xr.open_dataset(file_path.format(name=name, site=site))
-
-    return benchmark
+    return open_sim(name, site)
 
 
 def diagnostic_plots(sim_data, flux_data, name, site=None):
@@ -106,6 +107,7 @@ def diagnostic_plots(sim_data, flux_data, name, site=None):
         site = pals_site_name(flux_data)
 
     logger.info('Running standard plots for %s at %s' % (name, site))
+    set_style()
 
     base_path = 'source/models/{n}'.format(n=name)
     rel_path = 'figures/{s}'.format(s=site)
@@ -228,6 +230,7 @@ def get_PLUMBER_plot(model_dir, site='all'):
     """
     name = model_dir.replace('source/models/', '')
 
+    set_style()
     sns.set_palette(sns.color_palette(['red', 'pink', 'orange', 'black', 'blue']))
 
     metric_df = get_PLUMBER_metrics(name, site)
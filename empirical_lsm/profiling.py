@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: profiling.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Opt-in function-level profiling of pipeline tasks.
+
+Tasks (run, eval and rst for one model and site) decorated with profiled() are
+profiled when a profiler is configured, with configure(profiler='cprofile') or the
+EMPIRICAL_LSM_PROFILE environment variable ('cprofile' or 'pyinstrument'). This works
+the same inside Pool workers and in the main process. Each task writes a stats file
+to logs/profile/<model>/, and merge_profiles() combines a model's stats into one
+report, with the hottest functions grouped by package (empirical_lsm modules,
+pandas, sklearn, numpy, ...).
+"""
+
+import os
+import io
+import glob
+import inspect
+import pstats
+import cProfile
+import functools
+
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+PROFILE_CONFIG = dict(
+    # None, 'cprofile', or 'pyinstrument'
+    profiler=os.environ.get('EMPIRICAL_LSM_PROFILE') or None,
+    dir='logs/profile',
+    # number of functions in each section of the merged report
+    top=30,
+)
+
+PROFILERS = ['cprofile', 'pyinstrument']
+
+# Report sections, by path fragment of the profiled function's file
+FUNCTION_GROUPS = OrderedDict([
+    ('empirical_lsm.transforms', 'empirical_lsm/transforms.py'),
+    ('empirical_lsm.clusterregression', 'empirical_lsm/clusterregression.py'),
+    ('empirical_lsm (other)', 'empirical_lsm/'),
+    ('pandas', '/pandas/'),
+    ('sklearn', '/sklearn/'),
+    ('numpy', '/numpy/'),
+    ('xarray', '/xarray/'),
+])
+
+
+def configure(**kwargs):
+    """Update the profiling configuration (see PROFILE_CONFIG)"""
+    for k in kwargs:
+        if k not in PROFILE_CONFIG:
+            raise KeyError("Unknown profiling option: %s" % k)
+    if kwargs.get('profiler') not in PROFILERS + [None]:
+        raise ValueError("Unknown profiler: %s" % kwargs['profiler'])
+    PROFILE_CONFIG.update(kwargs)
+
+
+def get_profile_dir(name):
+    return os.path.join(PROFILE_CONFIG['dir'], name)
+
+
+def get_profile_path(name, site, stage, profiler):
+    ext = 'prof' if profiler == 'cprofile' else 'pyisession'
+    return os.path.join(get_profile_dir(name), '{n}_{s}_{t}.{e}'.format(n=name, s=site, t=stage, e=ext))
+
+
+def _run_cprofile(path, f, args, kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(f, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
+
+
+def _run_pyinstrument(path, f, args, kwargs):
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        raise ImportError("pyinstrument profiling requires pyinstrument (pip install pyinstrument)")
+
+    profiler = Profiler()
+    profiler.start()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        profiler.stop()
+        profiler.last_session.save(path)
+
+
+def profiled(stage):
+    """Decorator profiling a task function, if a profiler is configured
+
+    The decorated function must have name and site arguments.
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            profiler = PROFILE_CONFIG['profiler']
+            if profiler is None:
+                return f(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            name, site = bound.arguments['name'], bound.arguments['site']
+            os.makedirs(get_profile_dir(name), exist_ok=True)
+            path = get_profile_path(name, site, stage, profiler)
+            logger.info("Profiling {t} for {n} at {s} to {p}".format(t=stage, n=name, s=site, p=path))
+
+            if profiler == 'cprofile':
+                return _run_cprofile(path, f, args, kwargs)
+            else:
+                return _run_pyinstrument(path, f, args, kwargs)
+        return wrapped
+    return decorator
+
+
+def get_function_group(filename):
+    for group, fragment in FUNCTION_GROUPS.items():
+        if fragment in filename.replace(os.sep, '/'):
+            return group
+    return 'other'
+
+
+def format_cprofile_report(stats, top):
+    """Report of the hottest functions overall, and within each package group"""
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(top)
+    stats.sort_stats('tottime').print_stats(top)
+
+    groups = OrderedDict((g, []) for g in list(FUNCTION_GROUPS) + ['other'])
+    for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in stats.stats.items():
+        groups[get_function_group(filename)].append((tt, ct, nc, '{f}:{l}({n})'.format(f=filename, l=lineno, n=funcname)))
+
+    out.write("\nHot functions by package (own time / cumulative time in seconds, calls)\n")
+    for group, functions in groups.items():
+        if len(functions) == 0:
+            continue
+        total = sum(f[0] for f in functions)
+        out.write("\n{g}: {t:.2f}s own time\n".format(g=group, t=total))
+        for tt, ct, nc, function in sorted(functions, reverse=True)[:top]:
+            out.write("    {tt:10.3f} {ct:10.3f} {nc:10d}  {f}\n".format(tt=tt, ct=ct, nc=nc, f=function))
+
+    return out.getvalue()
+
+
+def merge_profiles(name, top=None):
+    """Merge all of a model's task profiles into one report
+
+    :returns: path of the report, or None if there are no profiles
+    """
+    if top is None:
+        top = PROFILE_CONFIG['top']
+    profile_dir = get_profile_dir(name)
+
+    report_path = os.path.join(profile_dir, '{n}_report.txt'.format(n=name))
+    reports = []
+
+    prof_files = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    if len(prof_files) > 0:
+        stats = pstats.Stats(*prof_files)
+        merged_path = os.path.join(profile_dir, '{n}_merged.pstats'.format(n=name))
+        stats.dump_stats(merged_path)
+        reports.append("cProfile: {n} tasks, merged stats in {p}\n\n{r}".format(
+            n=len(prof_files), p=merged_path, r=format_cprofile_report(stats, top)))
+
+    session_files = sorted(glob.glob(os.path.join(profile_dir, '*.pyisession')))
+    if len(session_files) > 0:
+        from pyinstrument.session import Session
+        from pyinstrument.renderers import ConsoleRenderer
+
+        session = Session.load(session_files[0])
+        for f in session_files[1:]:
+            session = Session.combine(session, Session.load(f))
+        reports.append("pyinstrument: {n} tasks\n\n{r}".format(
+            n=len(session_files), r=ConsoleRenderer(unicode=False, color=False).render(session)))
+
+    if len(reports) == 0:
+        return None
+
+    with open(report_path, 'w') as f:
+        f.write('\n\n'.join(reports))
+    logger.info("Wrote merged profile report for {n} to {p}".format(n=name, p=report_path))
+
+    return report_path
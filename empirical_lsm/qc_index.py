@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: qc_index.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Per-site QC validity bitmap index.
+
+For each site and variable, two packed bitmaps (np.packbits) over timesteps are stored:
+"finite" (the value is not NaN/inf), and "qc" (the QC flag is good, or there is no QC
+flag). "valid" is both. Per-variable counts and the source files' sizes and mtimes are
+stored as JSON metadata in the same .npz file, so sample counts can be looked up
+without loading the bitmaps or the data, the index is replaced atomically, and it
+is rebuilt when the source data changes. The counts are used for training set size
+estimates (see resource_model.get_n_training_samples).
+
+Code that already has a site's data in memory should use get_qc_flag_mask directly.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from datetime import datetime as dt
+
+from pals_utils.data import get_met_data, get_flux_data, get_config
+
+from empirical_lsm import init_config
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+QC_INDEX_DIR = 'cache/qc_index'
+
+KINDS = ['finite', 'qc', 'valid']
+
+
+def get_qc_format():
+    init_config(overwrite=False)
+    return get_config(['qc_format'])
+
+
+def get_good_qc():
+    """Value of the QC flag for good data, for the configured QC format"""
+    qc_format = get_qc_format()
+    if qc_format == 'PALS':
+        return 1
+    elif qc_format == 'FluxnetLSM':
+        return 0
+    else:
+        raise ValueError("Unknown qc_format: %s" % qc_format)
+
+
+def get_qc_flag_mask(ds, v, good_qc=None):
+    """Boolean mask over timesteps at which a variable's QC flag is good (all True without a flag)"""
+    if v + '_qc' not in ds:
+        return np.ones(ds[v].size, dtype=bool)
+    if good_qc is None:
+        good_qc = get_good_qc()
+
+    return ds[v + '_qc'].values.ravel() == good_qc
+
+
+def compute_qc_bitmaps(datasets, good_qc):
+    """Compute packed bitmaps for all time-varying variables in some site datasets
+
+    :datasets: list of xarray datasets for one site (e.g. met and flux)
+    :returns: (dict of packed bitmaps keyed by "<var>.<kind>", dict of per-variable counts, n_times)
+    """
+    bitmaps = {}
+    counts = {}
+    n_times = None
+    for ds in datasets:
+        for v in ds.data_vars:
+            if v.endswith('_qc') or 'time' not in ds[v].dims:
+                continue
+            values = ds[v].values.ravel()
+            if n_times is None:
+                n_times = len(values)
+
+            finite = np.isfinite(values)
+            qc = get_qc_flag_mask(ds, v, good_qc)
+
+            bitmaps[v + '.finite'] = np.packbits(finite)
+            bitmaps[v + '.qc'] = np.packbits(qc)
+            counts[v] = dict(finite=int(finite.sum()), qc=int(qc.sum()), valid=int((finite & qc).sum()))
+
+    return bitmaps, counts, n_times
+
+
+def get_index_path(site):
+    return os.path.join(QC_INDEX_DIR, site + '.npz')
+
+
+def get_sources(datasets):
+    """[path, size, mtime] of the files the datasets were opened from"""
+    sources = []
+    for ds in datasets:
+        path = ds.encoding.get('source')
+        if path is not None and os.path.exists(path):
+            stat = os.stat(path)
+            sources.append([path, stat.st_size, stat.st_mtime])
+
+    return sources
+
+
+def sources_changed(sources):
+    """Whether any source file has changed (or gone) since the index was built"""
+    for path, size, mtime in sources:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        if stat.st_size != size or stat.st_mtime != mtime:
+            return True
+
+    return False
+
+
+def build_site_qc_index(site):
+    """Build and write the QC index for a site from its met and flux data
+
+    The index is written to a temporary file and renamed into place.
+    """
+    os.makedirs(QC_INDEX_DIR, exist_ok=True)
+    path = get_index_path(site)
+
+    met_data = get_met_data(site)[site]
+    flux_data = get_flux_data([site])[site]
+    try:
+        bitmaps, counts, n_times = compute_qc_bitmaps([met_data, flux_data], get_good_qc())
+        sources = get_sources([met_data, flux_data])
+    finally:
+        met_data.close()
+        flux_data.close()
+
+    meta = dict(site=site, n_times=n_times, qc_format=get_qc_format(), sources=sources,
+                counts=counts, created=str(dt.now()))
+
+    # np.savez adds .npz to names without it
+    tmp_path = '{p}.tmp{pid}.npz'.format(p=path, pid=os.getpid())
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **bitmaps)
+    os.rename(tmp_path, path)
+
+    logger.info("Built QC index for {s} ({n} variables, {t} timesteps)".format(s=site, n=len(counts), t=n_times))
+
+    return meta
+
+
+def get_site_qc_meta(site, rebuild=False):
+    """QC index metadata for a site (including per-variable counts), building the index if necessary
+
+    The index is rebuilt if the QC format or any of its source files have changed.
+    """
+    path = get_index_path(site)
+    if rebuild or not os.path.exists(path):
+        return build_site_qc_index(site)
+
+    with np.load(path) as index:
+        meta = json.loads(str(index['meta']))
+    if meta['qc_format'] != get_qc_format() or sources_changed(meta['sources']):
+        return build_site_qc_index(site)
+
+    return meta
+
+
+def get_packed_mask(site, variables, kind='valid'):
+    """AND of the packed bitmaps for the given variables
+
+    :kind: 'finite', 'qc', or 'valid'
+    :returns: (packed bitmap, n_times)
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown bitmap kind: %s" % kind)
+    n_times = get_site_qc_meta(site)['n_times']
+    kinds = ['finite', 'qc'] if kind == 'valid' else [kind]
+
+    with np.load(get_index_path(site)) as bitmaps:
+        packed = None
+        for v in variables:
+            for k in kinds:
+                if packed is None:
+                    packed = bitmaps[v + '.' + k].copy()
+                else:
+                    np.bitwise_and(packed, bitmaps[v + '.' + k], out=packed)
+
+    return packed, n_times
+
+
+def count_samples(site, variables, kind='valid'):
+    """Number of timesteps at which all variables are good, without loading any data
+
+    Single variable counts are read from the index metadata.
+    """
+    if len(variables) == 1:
+        return get_site_qc_meta(site)['counts'][variables[0]][kind]
+
+    packed, n_times = get_packed_mask(site, variables, kind)
+
+    return int(np.unpackbits(packed, count=n_times).sum())
+
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: resource_model.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Memory and runtime estimates for model runs.
+
+Peak memory and wall time of a fit+predict run are estimated from an analytical
+model of the estimator (family, clusters, trees, lagged features) and the amount of
+training data. Each completed run appends a profiling record to RESOURCE_LOG;
+estimates are scaled by the median observed/predicted ratio of past runs of the same
+model spec (or failing that, the same estimator family).
+"""
+
+import os
+import json
+
+import numpy as np
+import psutil
+
+from datetime import datetime as dt
+
+from empirical_lsm.model_cache import get_spec_hash
+from empirical_lsm.qc_index import get_site_qc_meta, count_samples
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+RESOURCE_LOG = 'logs/resources.jsonl'
+
+# Python, numpy, sklearn, pandas etc.
+BASE_MEMORY = 300e6
+
+# Copies of the training data held at once (store view, complete rows, wrapper copies)
+DATA_COPIES = 4
+
+# Bytes per tree node (sklearn node struct plus values)
+TREE_NODE_BYTES = 80
+
+# Per-family runtime coefficients, in seconds per unit of work (see get_analytic_estimate)
+RUNTIME_COEFS = {
+    'linear': 2e-8,
+    'cluster': 5e-9,
+    'tree': 2e-7,
+    'boost': 2e-7,
+    'neighbours': 1e-7,
+    'mlp': 2e-7,
+    'svr': 1e-8,
+    'mean': 1e-8,
+    'unknown': 1e-7,
+}
+
+# Records are only used for refinement once there are this many
+MIN_RECORDS = 3
+
+# Parsed once per process, see load_records
+_records = None
+
+
+##################
+# Model features
+##################
+
+def iter_estimators(est):
+    """Yield an estimator and all estimators nested in it (wrappers, pipelines, clusterers)"""
+    yield est
+    if not hasattr(est, 'get_params'):
+        return
+    for value in est.get_params(deep=False).values():
+        if hasattr(value, 'get_params') and not isinstance(value, type):
+            yield from iter_estimators(value)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                # pipeline steps are (name, estimator) tuples
+                item = item[1] if isinstance(item, tuple) else item
+                if hasattr(item, 'get_params'):
+                    yield from iter_estimators(item)
+
+
+def get_model_features(model, n_samples, n_outputs=3):
+    """Features of a model run that drive memory use and runtime
+
+    :model: unfitted model
+    :n_samples: number of training samples
+    :n_outputs: number of flux variables fitted
+    :returns: dict of features
+    """
+    features = dict(family='unknown', n_samples=int(n_samples), n_outputs=n_outputs,
+                    n_features=len(getattr(model, 'forcing_vars', [])) or 1,
+                    n_clusters=1, n_estimators=1)
+
+    for est in iter_estimators(model):
+        name = type(est).__name__
+        params = est.get_params(deep=False)
+        if 'var_lags' in params:
+            features['n_features'] = sum(len(l) for l in params['var_lags'].values())
+        if 'n_clusters' in params:
+            features['n_clusters'] = params['n_clusters']
+            if features['family'] == 'unknown':
+                features['family'] = 'cluster'
+        if name in ['LinearRegression', 'SGDRegressor'] and features['family'] == 'unknown':
+            features['family'] = 'linear'
+        elif name in ['RandomForestRegressor', 'ExtraTreesRegressor', 'DecisionTreeRegressor']:
+            features['family'] = 'tree'
+            features['n_estimators'] = params.get('n_estimators', 1)
+            features['bootstrap'] = bool(params.get('bootstrap', False))
+        elif name == 'AdaBoostRegressor':
+            features['family'] = 'boost'
+            features['n_estimators'] = params.get('n_estimators', 50)
+        elif name == 'KNeighborsRegressor':
+            features['family'] = 'neighbours'
+        elif name == 'MLPRegressor':
+            features['family'] = 'mlp'
+        elif name == 'SVR':
+            features['family'] = 'svr'
+        elif name == 'Mean' and features['family'] == 'unknown':
+            features['family'] = 'mean'
+
+    return features
+
+
+##################
+# Estimates
+##################
+
+def get_analytic_estimate(features):
+    """Analytical peak memory (bytes) and runtime (seconds) estimate for a model run"""
+    n = features['n_samples']
+    f = features['n_features']
+    k = features['n_clusters']
+    n_out = features['n_outputs']
+    family = features['family']
+
+    data_bytes = n * (f + n_out) * 8
+    memory = BASE_MEMORY + DATA_COPIES * data_bytes
+
+    if family == 'cluster':
+        # chunked distance matrices and per-cluster copies of the data
+        memory += min(n, 100000) * k * 8 + data_bytes
+        work = n * k * f * 100
+    elif family == 'linear':
+        work = n * f * f
+    elif family == 'tree':
+        # fully grown trees have up to ~2 nodes per unique sample; bootstrapping leaves ~63% unique
+        unique = 0.63 if features.get('bootstrap', False) else 1.0
+        memory += features['n_estimators'] * 2 * n * unique * TREE_NODE_BYTES * n_out
+        work = features['n_estimators'] * n * np.log2(max(n, 2)) * f * n_out
+    elif family == 'boost':
+        memory += n * 8 * 4
+        work = features['n_estimators'] * n * f * n_out
+    elif family == 'neighbours':
+        memory += data_bytes
+        work = n * f * np.log2(max(n, 2)) * n_out
+    elif family == 'svr':
+        memory += 200e6
+        work = n * n * f * n_out
+    else:
+        work = n * f * n_out
+
+    runtime = RUNTIME_COEFS.get(family, RUNTIME_COEFS['unknown']) * work
+
+    return dict(memory=float(memory), runtime=float(runtime))
+
+
+def load_records(reload=False):
+    """Profiling records of past runs (read once per process)"""
+    global _records
+    if _records is None or reload:
+        _records = []
+        if os.path.exists(RESOURCE_LOG):
+            with open(RESOURCE_LOG) as f:
+                for line in f:
+                    try:
+                        _records.append(json.loads(line))
+                    except ValueError:
+                        continue
+
+    return _records
+
+
+def get_correction(records, key, value):
+    """Median observed/predicted ratios from records matching key=value, or None"""
+    matching = [r for r in records if r.get(key) == value and r['predicted_memory'] > 0 and r['predicted_runtime'] > 0]
+    if len(matching) < MIN_RECORDS:
+        return None
+
+    return dict(memory=float(np.median([r['memory'] / r['predicted_memory'] for r in matching])),
+                runtime=float(np.median([r['runtime'] / r['predicted_runtime'] for r in matching])))
+
+
+def estimate_resources(model, n_samples, n_outputs=3):
+    """Estimate peak memory and runtime of fitting and running a model
+
+    :model: unfitted model
+    :n_samples: number of training samples
+    :n_outputs: number of flux variables fitted
+    :returns: dict with memory (bytes), runtime (seconds), and source ('analytic', or the refinement level)
+    """
+    features = get_model_features(model, n_samples, n_outputs)
+    estimate = get_analytic_estimate(features)
+    estimate['source'] = 'analytic'
+
+    records = load_records()
+    for key, value in [('spec', get_spec_hash(model)), ('family', features['family'])]:
+        correction = get_correction(records, key, value)
+        if correction is not None:
+            estimate['memory'] *= correction['memory']
+            estimate['runtime'] *= correction['runtime']
+            estimate['source'] = key
+            break
+
+    return estimate
+
+
+def record_resources(model, n_samples, memory, runtime, n_outputs=3, **kwargs):
+    """Append a profiling record for a completed run, for refining later estimates
+
+    :memory: observed memory use (bytes)
+    :runtime: observed wall time (seconds)
+    """
+    features = get_model_features(model, n_samples, n_outputs)
+    predicted = get_analytic_estimate(features)
+    record = dict(features,
+                  spec=get_spec_hash(model),
+                  name=getattr(model, 'name', None),
+                  memory=float(memory),
+                  runtime=float(runtime),
+                  predicted_memory=predicted['memory'],
+                  predicted_runtime=predicted['runtime'],
+                  time=str(dt.now()),
+                  **kwargs)
+
+    os.makedirs(os.path.dirname(RESOURCE_LOG), exist_ok=True)
+    # a single short write in append mode, so concurrent workers don't interleave records
+    with open(RESOURCE_LOG, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    if _records is not None:
+        _records.append(record)
+
+
+##################
+# Scheduling
+##################
+
+def get_memory_budget(fraction=0.8):
+    """Memory available for model runs, in bytes"""
+    return psutil.virtual_memory().available * fraction
+
+
+def get_pool_size(models, n_samples, max_cores=None, memory_budget=None):
+    """Number of concurrent runs that fit in memory, for the most demanding model
+
+    :models: list of unfitted models that will be run
+    :n_samples: number of training samples per run
+    :max_cores: upper limit (default: all cpus)
+    :returns: number of processes, at least 1
+    """
+    if max_cores is None:
+        max_cores = os.cpu_count()
+    if memory_budget is None:
+        memory_budget = get_memory_budget()
+
+    peak = max(estimate_resources(m, n_samples)['memory'] for m in models)
+    ncores = int(max(1, min(max_cores, memory_budget // peak)))
+    logger.info("Estimated peak memory {m:.1f}GB per run, budget {b:.1f}GB: using {n} process(es)"
+                .format(m=peak / 1e9, b=memory_budget / 1e9, n=ncores))
+
+    return ncores
+
+
+def get_n_training_samples(sites, variables):
+    """Number of usable training samples over a list of training sites, from the QC index
+
+    Counts the timesteps at which all of the variables are finite and pass QC, without
+    loading any data once the index exists. Derived variables (not in the index) are ignored.
+    """
+    n_samples = 0
+    for s in sites:
+        meta = get_site_qc_meta(s)
+        site_vars = [v for v in variables if v in meta['counts']]
+        n_samples += count_samples(s, site_vars) if len(site_vars) > 0 else meta['n_times']
+
+    return n_samples
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: scheduler.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Memory-aware scheduler for (model, site, stage) tasks.
+
+All tasks (run, eval and rst stages, for all models and sites) go through one
+long-lived worker pool. Tasks become ready when the previous stage for the same
+model and site is done, and ready tasks are started longest-first, as long as
+their estimated memory fits in the remaining memory budget (see resource_model).
+Heavy and light models are co-scheduled, so cores aren't left idle at the tail of
+each model. Jobs are recorded in the ledger, and tasks that are already done with
+unchanged inputs are skipped, so an interrupted pipeline resumes where it stopped.
+Run tasks get a BLAS/OpenMP thread limit from the thread budget, and the threads
+of running tasks are kept within the total (see thread_budget).
+"""
+
+import queue
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime as dt
+from multiprocessing import Pool
+
+from pals_utils.data import get_config, get_sites
+
+from empirical_lsm.models import get_model
+from empirical_lsm.data import get_train_sites, get_train_store
+from empirical_lsm.offline_simulation import run_simulation, share_train_stores, get_suitable_ncores, \
+    get_model_met_vars
+from empirical_lsm.model_cache import get_data_fingerprint
+from empirical_lsm.sim_store import sim_exists
+from empirical_lsm.offline_eval import eval_simulation, main_rst_gen
+from empirical_lsm.resource_model import estimate_resources, get_memory_budget, get_n_training_samples
+from empirical_lsm.training_store import TrainingSet, release_blocks, init_worker
+from empirical_lsm.thread_budget import get_thread_split, get_total_threads, thread_limit, init_worker as init_worker_threads
+from empirical_lsm import ledger
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+STAGES = ['run', 'eval', 'rst']
+
+# Options that affect each stage's output, for the ledger's input hashes
+STAGE_OPTIONS = dict(
+    run=['multivariate', 'fix_closure'],
+    eval=['plots', 'fix_closure'],
+    rst=[],
+)
+
+# Rough estimates for stages that don't fit a model
+STAGE_ESTIMATES = dict(
+    eval=dict(memory=1.5e9, runtime=60.0),
+    rst=dict(memory=300e6, runtime=5.0),
+)
+
+Task = namedtuple('Task', ['name', 'site', 'stage'])
+
+
+def run_task(task, model, options, threads=1):
+    """Run a single task (in a worker process)
+
+    :options: dict of multivariate, overwrite, fix_closure, plots
+    :threads: BLAS/OpenMP thread limit for the task
+    :returns: (task, seconds, error message or None)
+    """
+    t_start = dt.now()
+    try:
+        if task.stage == 'run':
+            with thread_limit(threads):
+                run_simulation(model, task.name, task.site, options['multivariate'],
+                               options['overwrite'], options['fix_closure'])
+        elif task.stage == 'eval':
+            eval_simulation(task.name, task.site, plots=options['plots'], fix_closure=options['fix_closure'],
+                            raise_errors=True)
+        elif task.stage == 'rst':
+            main_rst_gen(task.name, task.site)
+        else:
+            raise ValueError("Unknown stage: %s" % task.stage)
+    except Exception as e:
+        # Keep the pool alive, the failure is reported by the scheduler
+        logger.exception("{t} failed".format(t=task))
+        return task, (dt.now() - t_start).total_seconds(), repr(e)
+
+    return task, (dt.now() - t_start).total_seconds(), None
+
+
+def get_site_list(sites):
+    """List of sites from a site set name, or a single site name"""
+    try:
+        return get_sites(sites)
+    except KeyError:
+        return [sites]
+
+
+class TaskScheduler(object):
+
+    """Schedules (model, site, stage) tasks on one pool, against a memory budget"""
+
+    def __init__(self, names, sites, stages, ncores=None, memory_budget=None, no_mp=False,
+                 multivariate=True, overwrite=False, fix_closure=True, plots=False,
+                 use_ledger=True, retry_failed=False):
+        """
+        :names: model names
+        :sites: list of site names
+        :stages: stages to run for each (model, site), in order (see STAGES)
+        :ncores: maximum concurrent tasks (default: offline_simulation.get_suitable_ncores())
+        :memory_budget: bytes available to tasks (default: resource_model.get_memory_budget())
+        :use_ledger: record jobs in the ledger, and skip tasks that are up to date
+        :retry_failed: only run tasks that previously failed or were interrupted (and their later stages)
+        """
+        self.ncores = get_suitable_ncores() if ncores is None else ncores
+        self.memory_budget = get_memory_budget() if memory_budget is None else memory_budget
+        self.no_mp = no_mp
+        self.use_ledger = use_ledger
+        self.retry_failed = retry_failed
+        self.options = dict(multivariate=multivariate, overwrite=overwrite,
+                            fix_closure=fix_closure, plots=plots)
+
+        stages = [s for s in STAGES if s in stages]
+        self.models = OrderedDict((n, get_model(n)) for n in names) if 'run' in stages else {}
+
+        self.estimates = {}
+        self.threads = {}
+        self.train_data = {}
+        # single-threaded tasks are only limited by ncores
+        self.total_threads = max(get_total_threads(), self.ncores)
+        if 'run' in stages:
+            train_vars = get_config(['vars', 'met']) + get_config(['vars', 'flux'])
+            n_samples = get_n_training_samples(get_train_sites(), train_vars)
+            n_outputs = len(get_config(['vars', 'flux']))
+            for n, m in self.models.items():
+                self.estimates[n] = estimate_resources(m, n_samples, n_outputs)
+                max_processes = min(self.ncores, int(self.memory_budget // max(self.estimates[n]['memory'], 1)))
+                self.threads[n] = get_thread_split([m], n_samples, max_processes, self.total_threads)[1]
+            if use_ledger:
+                # fingerprint of each model's training data, for the run stage input hashes
+                for n, m in self.models.items():
+                    store = get_train_store(get_model_met_vars(m), get_config(['vars', 'flux']),
+                                            fix_closure=fix_closure)
+                    self.train_data[n] = get_data_fingerprint(TrainingSet(store))
+
+        self.running = {}
+        self.memory_in_use = 0
+        self.threads_in_use = 0
+        self.n_tasks = len(names) * len(sites) * len(stages)
+        self.completed = []
+        self.failed = []
+        self.skipped = []
+        self.up_to_date = []
+        self.input_hashes = {}
+        self.max_queue_depth = 0
+        self.t_start = None
+
+        if use_ledger:
+            ledger.mark_interrupted()
+
+        # tasks waiting on the previous stage, keyed by that stage's task
+        self.waiting = {}
+        self.ready = []
+        for n in names:
+            for s in sites:
+                tasks = [Task(n, s, stage) for stage in stages]
+                for prev, task in zip(tasks[:-1], tasks[1:]):
+                    self.waiting[prev] = task
+                self.make_ready(tasks[0])
+
+    def make_ready(self, task, rerun_dependency=False):
+        """Queue a task whose previous stage is done, unless the ledger says it's up to date
+
+        Up to date tasks are skipped, and their next stage made ready in turn. Run tasks
+        are never up to date if their simulation is missing (e.g. deleted by check_sanity).
+
+        :rerun_dependency: the previous stage was run in this pass, so this task always runs
+        """
+        if not self.use_ledger:
+            self.ready.append(task)
+            return
+
+        options = dict((k, self.options[k]) for k in STAGE_OPTIONS[task.stage])
+        input_hash = ledger.get_input_hash(task.name, task.site, task.stage,
+                                           model=self.models.get(task.name),
+                                           train_data=self.train_data.get(task.name), **options)
+        self.input_hashes[task] = input_hash
+
+        job = ledger.get_job(task.name, task.site, task.stage)
+        if rerun_dependency:
+            up_to_date = False
+        elif task.stage == 'run' and (self.options['overwrite'] or not sim_exists(task.name, task.site)):
+            up_to_date = False
+        elif self.retry_failed and job is None:
+            # never attempted
+            up_to_date = True
+        else:
+            up_to_date = job is not None and job['status'] == 'done' and job['input_hash'] == input_hash
+
+        if up_to_date:
+            self.up_to_date.append(task)
+            dependent = self.waiting.pop(task, None)
+            if dependent is not None:
+                self.make_ready(dependent)
+        else:
+            self.ready.append(task)
+
+    def get_estimate(self, task):
+        if task.stage == 'run':
+            return self.estimates[task.name]
+        return STAGE_ESTIMATES[task.stage]
+
+    def get_threads(self, task):
+        if task.stage == 'run':
+            return self.threads[task.name]
+        return 1
+
+    def next_task(self):
+        """Longest ready task that fits in the remaining memory and threads, or None
+
+        If nothing is running, the longest task is started regardless, so tasks bigger
+        than the whole budget still run (alone).
+        """
+        if len(self.ready) == 0 or len(self.running) >= self.ncores:
+            return None
+
+        self.ready.sort(key=lambda t: self.get_estimate(t)['runtime'], reverse=True)
+        for i, task in enumerate(self.ready):
+            if (self.memory_in_use + self.get_estimate(task)['memory'] <= self.memory_budget and
+                    self.threads_in_use + self.get_threads(task) <= self.total_threads):
+                return self.ready.pop(i)
+
+        if len(self.running) == 0:
+            task = self.ready.pop(0)
+            logger.warning("{t} needs more than the memory budget, running it alone".format(t=task))
+            return task
+
+        return None
+
+    def start(self, task):
+        self.running[task] = dt.now()
+        self.memory_in_use += self.get_estimate(task)['memory']
+        self.threads_in_use += self.get_threads(task)
+        if self.use_ledger:
+            ledger.start_job(task.name, task.site, task.stage, self.input_hashes[task])
+
+    def finish(self, task, seconds, error):
+        del self.running[task]
+        self.memory_in_use -= self.get_estimate(task)['memory']
+        self.threads_in_use -= self.get_threads(task)
+        if self.use_ledger:
+            ledger.finish_job(task.name, task.site, task.stage, seconds, error)
+
+        dependent = self.waiting.pop(task, None)
+        if error is None:
+            self.completed.append((task, seconds))
+            if dependent is not None:
+                self.make_ready(dependent, rerun_dependency=True)
+        else:
+            self.failed.append((task, error))
+            logger.error("{t} failed: {e}".format(t=task, e=error))
+            # skip later stages for this model and site
+            while dependent is not None:
+                self.skipped.append(dependent)
+                dependent = self.waiting.pop(dependent, None)
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        stats = self.stats()
+        logger.info("[{d}/{n}] {t} done in {s:.0f}s; running {r} ({m:.1f}GB), queued {q}, {tp:.1f} tasks/min"
+                    .format(d=stats['done'], n=self.n_tasks, t=task, s=seconds, r=stats['running'],
+                            m=self.memory_in_use / 1e9, q=stats['queue_depth'], tp=stats['throughput']))
+
+    def queue_depth(self):
+        """Tasks not yet started (ready, or waiting on another stage)"""
+        return len(self.ready) + len(self.waiting)
+
+    def stats(self):
+        """Throughput and queue statistics"""
+        elapsed = 0 if self.t_start is None else (dt.now() - self.t_start).total_seconds()
+        done = len(self.completed) + len(self.failed) + len(self.skipped) + len(self.up_to_date)
+        stage_times = {}
+        for task, seconds in self.completed:
+            stage_times.setdefault(task.stage, []).append(seconds)
+
+        return dict(
+            tasks=self.n_tasks,
+            done=done,
+            completed=len(self.completed),
+            failed=len(self.failed),
+            skipped=len(self.skipped),
+            up_to_date=len(self.up_to_date),
+            running=len(self.running),
+            ready=len(self.ready),
+            queue_depth=self.queue_depth(),
+            max_queue_depth=self.max_queue_depth,
+            memory_in_use=self.memory_in_use,
+            elapsed=elapsed,
+            throughput=60 * done / elapsed if elapsed > 0 else 0.0,
+            stage_mean_seconds={s: sum(t) / len(t) for s, t in stage_times.items()},
+        )
+
+    def run(self):
+        """Run all tasks
+
+        :returns: stats dict (see stats())
+        """
+        self.t_start = dt.now()
+        self.max_queue_depth = self.queue_depth()
+        logger.info("Scheduling {n} tasks on {c} core(s), memory budget {b:.1f}GB"
+                    .format(n=self.n_tasks, c=1 if self.no_mp else self.ncores, b=self.memory_budget / 1e9))
+
+        if self.no_mp:
+            while len(self.ready) > 0:
+                task = self.next_task()
+                self.start(task)
+                self.finish(*run_task(task, self.models.get(task.name), self.options, self.get_threads(task)))
+        else:
+            self._run_pool()
+
+        stats = self.stats()
+        logger.info("Finished {c} tasks ({f} failed, {s} skipped, {u} already up to date) in {t:.0f}s"
+                    .format(c=stats['completed'], f=stats['failed'], s=stats['skipped'],
+                            u=stats['up_to_date'], t=stats['elapsed']))
+
+        return stats
+
+    def _run_pool(self):
+        handles, blocks = share_train_stores(list(self.models.values()), self.options['fix_closure'])
+        results = queue.Queue()
+        try:
+            with Pool(self.ncores, initializer=init_worker_threads, initargs=(1, init_worker, (handles,))) as p:
+                while len(self.ready) > 0 or len(self.running) > 0:
+                    task = self.next_task()
+                    while task is not None:
+                        self.start(task)
+                        p.apply_async(run_task, (task, self.models.get(task.name), self.options, self.get_threads(task)),
+                                      callback=results.put,
+                                      error_callback=lambda e, t=task: results.put((t, 0.0, repr(e))))
+                        task = self.next_task()
+
+                    self.finish(*results.get())
+        finally:
+            release_blocks(blocks)
+
+
+def run_tasks(names, sites, stages, **kwargs):
+    """Run stages for all models and sites on one scheduler
+
+    :sites: site set name (e.g. 'PLUMBER_ext'), or a single site
+    :kwargs: passed to TaskScheduler
+    :returns: stats dict
+    """
+    scheduler = TaskScheduler(names, get_site_list(sites), stages, **kwargs)
+
+    return scheduler.run()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: sim_store.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Simulation output store.
+
+All simulation reads and writes go through this module. Time-varying variables are
+written as compressed, time-chunked float32 by default. Simulations are either stored
+one file per (model, site) at model_data/<model>/<model>_<site>.nc, or consolidated
+into one file per model at model_data/<model>/<model>.nc, with one netCDF group per site.
+"""
+
+import os
+import fcntl
+import netCDF4
+
+import numpy as np
+import xarray as xr
+
+from contextlib import contextmanager
+
+from empirical_lsm.catalogue import record_artefact, remove_artefact
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SIM_STORE_DIR = 'model_data'
+
+SIM_STORE_CONFIG = dict(
+    # write new simulations to one consolidated file per model
+    consolidated=False,
+    # encoding of time-varying float variables (dtype=None keeps the original dtype)
+    dtype='float32',
+    zlib=True,
+    shuffle=True,
+    complevel=4,
+    # one year of half-hourly data
+    time_chunk=17520,
+)
+
+
+def configure(**kwargs):
+    """Update the simulation store configuration (see SIM_STORE_CONFIG)"""
+    for k in kwargs:
+        if k not in SIM_STORE_CONFIG:
+            raise KeyError("Unknown sim store option: %s" % k)
+    SIM_STORE_CONFIG.update(kwargs)
+
+
+def get_sim_path(name, site=None):
+    """Path of a simulation file
+
+    :site: site name, or None for the consolidated model file
+    """
+    if site is None:
+        return '{d}/{n}/{n}.nc'.format(d=SIM_STORE_DIR, n=name)
+    else:
+        return '{d}/{n}/{n}_{s}.nc'.format(d=SIM_STORE_DIR, n=name, s=site)
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Lock a file against concurrent writers, via a sidecar .lock file"""
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_sim_encoding(sim_data, config=None):
+    """netCDF encoding for the time-varying float variables in sim_data"""
+    if config is None:
+        config = SIM_STORE_CONFIG
+
+    encoding = {}
+    for v in sim_data.data_vars:
+        var = sim_data[v]
+        if 'time' not in var.dims or not np.issubdtype(var.dtype, np.floating):
+            continue
+        chunks = tuple(min(config['time_chunk'], n) if d == 'time' else n
+                       for d, n in zip(var.dims, var.shape))
+        encoding[v] = dict(zlib=config['zlib'], shuffle=config['shuffle'],
+                           complevel=config['complevel'], chunksizes=chunks)
+        if config['dtype'] is not None:
+            encoding[v]['dtype'] = config['dtype']
+
+    return encoding
+
+
+def get_consolidated_sites(name):
+    """Sites in a model's consolidated file"""
+    path = get_sim_path(name)
+    if not os.path.exists(path):
+        return []
+    with file_lock(path, shared=True):
+        with netCDF4.Dataset(path) as ds:
+            return sorted(ds.groups)
+
+
+def list_sim_sites(name):
+    """All sites with simulations for a model, in either layout"""
+    prefix = '{n}_'.format(n=name)
+    model_dir = os.path.dirname(get_sim_path(name))
+    if os.path.isdir(model_dir):
+        sites = [f[len(prefix):-3] for f in os.listdir(model_dir)
+                 if f.startswith(prefix) and f.endswith('.nc')]
+    else:
+        sites = []
+
+    return sorted(set(sites).union(get_consolidated_sites(name)))
+
+
+def sim_exists(name, site):
+    """Whether a simulation exists for a model at a site"""
+    return os.path.exists(get_sim_path(name, site)) or site in get_consolidated_sites(name)
+
+
+def write_sim(sim_data, name, site, consolidated=None):
+    """Write a simulation to the store, overwriting any existing simulation
+
+    :consolidated: write to the consolidated model file (default: SIM_STORE_CONFIG['consolidated'])
+    :returns: path written to
+    """
+    if consolidated is None:
+        consolidated = SIM_STORE_CONFIG['consolidated']
+
+    encoding = get_sim_encoding(sim_data)
+    os.makedirs(os.path.dirname(get_sim_path(name)), exist_ok=True)
+
+    if consolidated:
+        path = get_sim_path(name)
+        with file_lock(path):
+            mode = 'a' if os.path.exists(path) else 'w'
+            sim_data.to_netcdf(path, mode=mode, group=site, encoding=encoding, engine='netcdf4')
+        # Don't leave a stale per-site copy that would shadow the new one
+        if os.path.exists(get_sim_path(name, site)):
+            os.remove(get_sim_path(name, site))
+            remove_artefact(get_sim_path(name, site))
+    else:
+        path = get_sim_path(name, site)
+        # Write then rename, so readers never see a partial file
+        tmp_path = '{p}.tmp{pid}'.format(p=path, pid=os.getpid())
+        sim_data.to_netcdf(tmp_path, encoding=encoding, engine='netcdf4')
+        os.rename(tmp_path, path)
+
+    record_artefact(path, site)
+
+    return path
+
+
+def open_sim(name, site):
+    """Open a simulation from the store
+
+    Per-site files are opened lazily; simulations in a consolidated file are loaded
+    into memory, so the file isn't held open while other processes write to it.
+
+    :returns: xarray dataset
+    """
+    path = get_sim_path(name, site)
+    if os.path.exists(path):
+        return xr.open_dataset(path)
+
+    path = get_sim_path(name)
+    if site in get_consolidated_sites(name):
+        with file_lock(path, shared=True):
+            with xr.open_dataset(path, group=site) as ds:
+                return ds.load()
+
+    raise FileNotFoundError("No simulation for {n} at {s} in {d}".format(n=name, s=site, d=SIM_STORE_DIR))
+
+
+def remove_sim(name, site):
+    """Remove a simulation from the store
+
+    netCDF groups can't be deleted, so simulations in a consolidated file are only
+    replaced when the model is re-run.
+    """
+    path = get_sim_path(name, site)
+    if os.path.exists(path):
+        os.remove(path)
+        remove_artefact(path)
+    elif site in get_consolidated_sites(name):
+        logger.warning("Can't remove {n} at {s} from the consolidated file, re-run to replace it"
+                       .format(n=name, s=site))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_catalogue.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the artefact catalogue
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import xarray as xr
+
+from empirical_lsm.catalogue import parse_artefact_path, record_artefact, list_artefacts
+
+
+class TestParseArtefactPath(unittest.TestCase):
+    """Test artefact path parsing"""
+
+    def test_sims(self):
+        self.assertEqual(parse_artefact_path('model_data/STH_km27/STH_km27_Tumba.nc'), ('sim', 'STH_km27', 'Tumba'))
+        self.assertEqual(parse_artefact_path('model_data/STH_km27/STH_km27.nc'), ('sim', 'STH_km27', None))
+
+    def test_source_files(self):
+        self.assertEqual(parse_artefact_path('./source/models/S_lin/metrics/S_lin_Tumba_metrics.csv'),
+                         ('metrics', 'S_lin', 'Tumba'))
+        self.assertEqual(parse_artefact_path('source/models/S_lin/figures/Tumba/S_lin_Qle_Tumba_qq_plot.png'),
+                         ('figure', 'S_lin', 'Tumba'))
+        self.assertEqual(parse_artefact_path('source/models/S_lin/figures/S_lin_all_PLUMBER_plot_all_metrics.png'),
+                         ('figure', 'S_lin', None))
+        self.assertEqual(parse_artefact_path('source/models/S_lin/S_lin_Tumba.rst'), ('rst', 'S_lin', 'Tumba'))
+        self.assertEqual(parse_artefact_path('source/models/S_lin/index.rst'), ('rst', 'S_lin', None))
+
+    def test_unknown(self):
+        self.assertIsNone(parse_artefact_path('plots/annual_mean/2000/x.png'))
+        self.assertIsNone(parse_artefact_path('model_data/S_lin/other.nc'))
+
+
+class TestCatalogue(unittest.TestCase):
+    """Test recording artefacts, in an empty working directory"""
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_consolidated_sites(self):
+        path = 'model_data/a/a.nc'
+        os.makedirs('model_data/a')
+        for site, value in [('X', 1.0), ('Y', 2.0)]:
+            ds = xr.Dataset(dict(Qle=('time', np.full(10, value))))
+            ds.to_netcdf(path, mode='a' if os.path.exists(path) else 'w', group=site, engine='netcdf4')
+            record_artefact(path, site)
+        x_hash = list_artefacts('sim', 'a', 'X')[0]['hash']
+
+        # rewriting one site doesn't change the other site's hash
+        xr.Dataset(dict(Qle=('time', np.zeros(10)))).to_netcdf(path, mode='a', group='Y', engine='netcdf4')
+        record_artefact(path, 'Y')
+        artefacts = list_artefacts('sim', 'a')
+        self.assertEqual([a['site'] for a in artefacts], ['X', 'Y'])
+        self.assertEqual(artefacts[0]['hash'], x_hash)
+        self.assertEqual(artefacts[0]['size'], 80)
+        self.assertNotEqual(artefacts[1]['hash'], x_hash)
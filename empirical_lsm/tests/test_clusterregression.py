@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_clusterregression.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the ModelByCluster wrapper
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+
+from collections import OrderedDict
+
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.linear_model import LinearRegression
+
+from empirical_lsm.clusterregression import ModelByCluster
+from empirical_lsm.transforms import MissingDataWrapper, LagAverageWrapper
+
+
+class TestClusterSample(unittest.TestCase):
+    """Test subsampled clustering"""
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        n = 4000
+        self.X = rng.rand(n, 3)
+        self.y = self.X.dot([[1.0], [2.0], [3.0]]) + 0.1 * rng.rand(n, 1)
+
+        index = pd.MultiIndex.from_arrays(
+            [np.arange(n), np.repeat(['site1', 'site2', 'site3', 'site4'], n // 4)],
+            names=['time', 'site'])
+        self.X_df = pd.DataFrame(self.X, index=index)
+        self.y_df = pd.DataFrame(self.y, index=index)
+
+    def get_model(self, cluster_sample=None):
+        return ModelByCluster(MiniBatchKMeans(8, random_state=0, n_init=3), LinearRegression(),
+                              cluster_sample=cluster_sample, chunk_size=500, random_state=0)
+
+    def test_sample_is_stratified(self):
+        model = self.get_model(0.1)
+        sample_idx = model._get_sample_index(self.X_df)
+        sites = self.X_df.index.get_level_values('site')[sample_idx]
+
+        self.assertEqual(len(sample_idx), 400)
+        npt.assert_array_equal(pd.Series(sites).value_counts().values, 100)
+
+    def test_sample_size(self):
+        model = self.get_model(500)
+        self.assertEqual(len(model._get_sample_index(self.X)), 500)
+
+        model = self.get_model(10000)
+        self.assertEqual(len(model._get_sample_index(self.X)), self.X.shape[0])
+
+    def test_regressions_use_all_data(self):
+        model = self.get_model(0.1).fit(self.X_df, self.y_df)
+
+        self.assertIn('assign', model.fit_times_)
+        n_fitted = sum(np.sum(model._predict_clusters(self.X) == c) for c in model.estimators_)
+        self.assertEqual(n_fitted, self.X.shape[0])
+
+    def test_predictions_close_to_full(self):
+        full = self.get_model().fit(self.X, self.y).predict(self.X)
+        sampled = self.get_model(0.25).fit(self.X, self.y).predict(self.X)
+
+        self.assertLess(np.abs(full - sampled).mean(), 0.05)
+
+
+class TestClusterMerging(unittest.TestCase):
+    """Test merging of under-populated clusters"""
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        # two big blobs, and a handful of outliers
+        self.X = np.concatenate([rng.normal(0, 0.1, [500, 2]),
+                                 rng.normal(5, 0.1, [500, 2]),
+                                 rng.normal(50, 0.1, [5, 2])])
+        self.y = self.X.sum(axis=1, keepdims=True)
+
+    def test_small_cluster_merged(self):
+        clusterer = MiniBatchKMeans(3, random_state=0, n_init=3)
+        model = ModelByCluster(clusterer, LinearRegression(), min_cluster_size=100)
+        model.fit(self.X, self.y)
+
+        small = np.flatnonzero(model.cluster_counts_ < 100)
+        self.assertGreater(len(small), 0)
+        for c in small:
+            self.assertNotIn(c, model.estimators_)
+            self.assertNotEqual(model.cluster_map_[c], c)
+
+        predicted = model.predict(self.X)
+        self.assertTrue(np.isfinite(predicted).all())
+
+    def test_merging_disabled(self):
+        clusterer = MiniBatchKMeans(3, random_state=0, n_init=3)
+        model = ModelByCluster(clusterer, LinearRegression(), min_cluster_size=None)
+        model.fit(self.X, self.y)
+
+        npt.assert_array_equal(model.cluster_map_, np.arange(3))
+        self.assertEqual(len(model.estimators_), 3)
+
+
+class TestSharedFit(unittest.TestCase):
+    """Test fitting several output variables on one clustering"""
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        n = 2000
+        self.X = rng.rand(n, 3)
+        self.ys = OrderedDict([('Qle', self.X.dot([[1.0], [2.0], [3.0]])),
+                               ('Qh', self.X.dot([[3.0], [2.0], [1.0]]))])
+        # Qh is missing for the first quarter of the data
+        self.ys['Qh'][:n // 4] = np.nan
+
+    def get_model(self):
+        return MissingDataWrapper(ModelByCluster(MiniBatchKMeans(8, random_state=0, n_init=3), LinearRegression()))
+
+    def test_matches_separate_fits(self):
+        shared = self.get_model().fit_multi(self.X, self.ys)
+        predictions = shared.predict_multi(self.X)
+
+        separate = self.get_model()
+        separate.fit(self.X, self.ys['Qle'])
+        npt.assert_allclose(predictions['Qle'], separate.predict(self.X))
+
+        # Qh is fitted on the same clusters, but only on its valid rows
+        self.assertTrue(np.isfinite(predictions['Qh']).all())
+        npt.assert_allclose(predictions['Qh'], self.X.dot([[3.0], [2.0], [1.0]]), atol=1e-8)
+
+    def test_variable_without_data(self):
+        self.ys['Qh'][:] = np.nan
+        predictions = self.get_model().fit_multi(self.X, self.ys).predict_multi(self.X)
+
+        self.assertTrue(np.isfinite(predictions['Qle']).all())
+        self.assertTrue(np.isnan(predictions['Qh']).all())
+
+    def test_variable_missing_in_cluster(self):
+        # two blobs, with Qh missing in the second
+        rng = np.random.RandomState(0)
+        X = np.concatenate([rng.rand(500, 3), rng.rand(500, 3) + 10])
+        ys = OrderedDict([('Qle', X.dot([[1.0], [2.0], [3.0]])),
+                          ('Qh', X.dot([[3.0], [2.0], [1.0]]))])
+        ys['Qh'][500:] = np.nan
+        model = ModelByCluster(MiniBatchKMeans(2, random_state=0, n_init=3), LinearRegression())
+        predictions = model.fit_multi(X, ys).predict_multi(X)
+
+        self.assertEqual(len(model.multi_estimators_['Qh']), 1)
+        self.assertTrue(np.isfinite(predictions['Qh']).all())
+        npt.assert_allclose(predictions['Qh'], X.dot([[3.0], [2.0], [1.0]]), atol=1e-8)
+
+    def test_lagged(self):
+        X = pd.DataFrame(self.X, columns=['Tair', 'SWdown', 'Qair'],
+                         index=pd.date_range('2000-01-01', periods=self.X.shape[0], freq='30min'))
+        var_lags = OrderedDict([('Tair', ['cur', '2h']), ('SWdown', ['cur']), ('Qair', ['cur'])])
+        model = LagAverageWrapper(var_lags, self.get_model())
+        predictions = model.fit_multi(X, self.ys).predict_multi(X)
+
+        self.assertEqual(list(predictions), ['Qle', 'Qh'])
+        self.assertEqual(predictions['Qle'].shape, (self.X.shape[0], 1))
+        self.assertTrue(np.isfinite(predictions['Qh']).all())
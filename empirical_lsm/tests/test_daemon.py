@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_daemon.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the warm job daemon
+"""
+
+import io
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from multiprocessing import get_context
+
+from empirical_lsm import daemon
+
+
+SCRIPT = """
+import os
+import logging
+logger = logging.getLogger('test_script')
+
+
+def main(args):
+    logger.info("hello %s", args['<name>'])
+    if args['--fail']:
+        raise ValueError("failed on purpose")
+    with open('out.txt', 'w') as f:
+        f.write(str(os.getppid()))
+"""
+
+
+class TestDaemon(unittest.TestCase):
+    """Test running scripts through a daemon on a temporary socket"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmp_dir, 'daemon.sock')
+        self.script = os.path.join(self.tmp_dir, 'script.py')
+        with open(self.script, 'w') as f:
+            f.write(SCRIPT)
+
+        self.server = get_context('fork').Process(target=daemon.serve, args=(self.socket,), kwargs=dict(modules=[]))
+        self.server.start()
+        for i in range(100):
+            if daemon.is_running(self.socket):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        daemon.stop(self.socket)
+        self.server.join(timeout=5)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_submit(self):
+        self.assertTrue(daemon.is_running(self.socket))
+
+        logs = io.StringIO()
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            daemon.submit_script(self.script, {'<name>': 'world', '--fail': False}, self.socket, logs)
+        finally:
+            os.chdir(cwd)
+        self.assertIn("hello world", logs.getvalue())
+        # run in a process forked from the daemon
+        with open(os.path.join(self.tmp_dir, 'out.txt')) as f:
+            self.assertEqual(int(f.read()), self.server.pid)
+
+        with self.assertRaises(daemon.DaemonJobError) as cm:
+            daemon.submit_script(self.script, {'<name>': 'again', '--fail': True}, self.socket, io.StringIO())
+        self.assertIn("failed on purpose", str(cm.exception))
+
+    def test_stop(self):
+        self.assertTrue(daemon.stop(self.socket))
+        self.server.join(timeout=5)
+        self.assertFalse(daemon.is_running(self.socket))
+        self.assertFalse(os.path.exists(self.socket))
+        self.assertFalse(daemon.stop(self.socket))
+
+    def test_run_script_fallback(self):
+        result = daemon.run_script(self.script, lambda args: args['x'], {'x': 3},
+                                   socket_path=os.path.join(self.tmp_dir, 'missing.sock'))
+        self.assertEqual(result, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
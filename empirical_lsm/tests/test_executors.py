@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_executors.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the shared-directory work queue executor
+"""
+
+import os
+import time
+import json
+import shutil
+import tempfile
+import unittest
+
+from pals_utils.data import get_config, set_config
+
+from empirical_lsm import executors
+from empirical_lsm.thread_budget import get_thread_limit
+
+
+def get_worker_settings():
+    return get_config(['vars', 'flux']), get_thread_limit()
+
+
+class TestQueueExecutor(unittest.TestCase):
+    """Test queueing, running and requeueing tasks"""
+
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.old_poll = executors.EXECUTOR_CONFIG['poll']
+        executors.configure(poll=0.05)
+
+    def tearDown(self):
+        executors.configure(poll=self.old_poll)
+        shutil.rmtree(self.queue_dir)
+
+    def test_local_workers(self):
+        with executors.QueueExecutor(self.queue_dir, local_workers=2) as ex:
+            results = ex.starmap(divmod, [(7, 2), (9, 4), (10, 5)])
+        self.assertEqual(results, [(3, 1), (2, 1), (2, 0)])
+
+    def test_errors(self):
+        with executors.QueueExecutor(self.queue_dir, local_workers=1) as ex:
+            with self.assertRaises(RuntimeError):
+                ex.starmap(divmod, [(1, 0)])
+
+    def test_requeue_dead_worker(self):
+        ex = executors.QueueExecutor(self.queue_dir)
+        job = ex.submit(divmod, [(7, 2)])
+
+        task_file, task = executors.claim_task(self.queue_dir, 'dead-worker')
+        lease_path = os.path.join(self.queue_dir, 'running', task_file + '.lease')
+        with open(lease_path) as f:
+            self.assertEqual(json.load(f)['worker'], 'dead-worker')
+        self.assertEqual(executors.requeue_stale_tasks(self.queue_dir, lease=60), 0)
+
+        stale = time.time() - 120
+        os.utime(lease_path, (stale, stale))
+        self.assertEqual(executors.requeue_stale_tasks(self.queue_dir, lease=60), 1)
+        self.assertEqual(os.listdir(os.path.join(self.queue_dir, 'running')), [])
+
+        self.assertEqual(executors.run_worker(self.queue_dir, idle_timeout=0), 1)
+        self.assertEqual(ex.wait(job, 1), [(3, 1)])
+
+    def test_worker_context(self):
+        old_flux_vars = get_config(['vars', 'flux'])
+        try:
+            set_config(['vars', 'flux'], ['Qle'])
+            ex = executors.QueueExecutor(self.queue_dir, n_threads=2)
+            job = ex.submit(get_worker_settings, [()])
+
+            # the worker applies the submitter's settings, not its own
+            set_config(['vars', 'flux'], ['Qh'])
+            self.assertEqual(executors.run_worker(self.queue_dir, idle_timeout=0), 1)
+            self.assertEqual(ex.wait(job, 1), [(['Qle'], 2)])
+            self.assertIsNone(get_thread_limit())
+        finally:
+            set_config(['vars', 'flux'], old_flux_vars)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_gridded_prediction.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for vectorised gridded prediction
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import xarray as xr
+
+from collections import OrderedDict
+from sklearn.linear_model import LinearRegression
+
+from empirical_lsm.transforms import LagAverageWrapper
+from empirical_lsm.gridded_prediction import predict_gridded, get_land_mask, get_forcing_array, \
+    predict_tiled, get_cell_memory, get_tiles
+
+
+MET_VARS = ['SWdown', 'Tair']
+FLUX_VARS = ['Qh', 'Qle']
+
+
+def make_dataset(n_lon=4, n_lat=3, n_times=48, seed=0):
+    """Synthetic gridded forcing, with a couple of ocean (fill value) cells"""
+    rng = np.random.RandomState(seed)
+    coords = dict(lon=np.arange(n_lon) + 0.5, lat=np.arange(n_lat) - 0.5, time=np.arange(n_times))
+    data = OrderedDict()
+    for v in MET_VARS:
+        values = rng.rand(n_lon, n_lat, n_times)
+        values[0, 0, :] = 1e20
+        values[2, 1, :] = 1e20
+        data[v] = xr.DataArray(values, dims=['lon', 'lat', 'time'], coords=coords)
+
+    return xr.Dataset(data)
+
+
+def predict_naive(model, dataset, datafreq=None):
+    """Per-cell reference prediction, as (var, lon, lat, time)"""
+    forcing = get_forcing_array(dataset, MET_VARS)
+    result = np.full([len(FLUX_VARS)] + list(forcing.shape[1:]), np.nan)
+    for lon, lat in zip(*np.nonzero(get_land_mask(forcing))):
+        X = forcing[:, lon, lat, :].T
+        if datafreq is None:
+            result[:, lon, lat, :] = model.predict(X).T
+        else:
+            X = pd.DataFrame(X, columns=MET_VARS)
+            result[:, lon, lat, :] = np.asarray(model.predict(X, datafreq=datafreq)).T
+
+    return result
+
+
+class TestPredictGridded(unittest.TestCase):
+    """Test predict_gridded against a per-cell loop"""
+
+    def setUp(self):
+        self.dataset = make_dataset()
+        rng = np.random.RandomState(1)
+        self.X = rng.rand(200, len(MET_VARS))
+        self.y = self.X.dot(rng.rand(len(MET_VARS), len(FLUX_VARS)))
+
+    def check(self, model, datafreq=None, batch_memory=None):
+        prediction = predict_gridded(model, self.dataset, FLUX_VARS, datafreq=datafreq,
+                                     met_vars=MET_VARS, batch_memory=batch_memory)
+        expected = predict_naive(model, self.dataset, datafreq)
+        for i, fv in enumerate(FLUX_VARS):
+            self.assertEqual(prediction[fv].dims, ('lon', 'lat', 'time'))
+            npt.assert_allclose(prediction[fv].values, expected[i])
+
+        return prediction
+
+    def test_land_mask(self):
+        mask = get_land_mask(get_forcing_array(self.dataset))
+        self.assertEqual(mask.sum(), 10)
+        self.assertFalse(mask[0, 0])
+        self.assertFalse(mask[2, 1])
+
+    def test_single_batch(self):
+        model = LinearRegression().fit(self.X, self.y)
+        prediction = self.check(model)
+        self.assertTrue(np.isnan(prediction['Qle'].values[0, 0]).all())
+
+    def test_multiple_batches(self):
+        model = LinearRegression().fit(self.X, self.y)
+        # room for about 3 cells per batch
+        self.check(model, batch_memory=3 * 8 * 48 * 8)
+
+    def test_lag_model(self):
+        var_lags = OrderedDict([('SWdown', ['cur', '2h']), ('Tair', ['cur', '6h'])])
+        model = LagAverageWrapper(var_lags, LinearRegression())
+        model.fit(self.X, self.y, datafreq=0.5)
+        # lags must not leak between neighbouring cells
+        self.check(model, datafreq=0.5, batch_memory=3 * 8 * 48 * 10)
+
+
+class TestPredictTiled(unittest.TestCase):
+    """Test tiled prediction to netCDF, and resuming"""
+
+    def setUp(self):
+        self.dataset = make_dataset(n_lon=5, n_lat=4)
+        rng = np.random.RandomState(1)
+        X = rng.rand(200, len(MET_VARS))
+        self.model = LinearRegression().fit(X, X.dot(rng.rand(len(MET_VARS), len(FLUX_VARS))))
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = {fv: os.path.join(self.tmp_dir, 'test_%s.nc' % fv) for fv in FLUX_VARS}
+        # full latitude bands of 5 cells, with a quarter of the budget for prediction batches
+        self.memory = 4 / 3 * 5.5 * get_cell_memory(len(MET_VARS), 48, len(FLUX_VARS))
+        self.regions = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load_region(self, region):
+        self.regions.append(region)
+        return self.dataset.isel(**region)
+
+    def check_output(self):
+        expected = predict_gridded(self.model, self.dataset, FLUX_VARS, met_vars=MET_VARS)
+        for fv in FLUX_VARS:
+            with xr.open_dataset(self.paths[fv]) as ds:
+                npt.assert_allclose(ds[fv].values, expected[fv].values, rtol=1e-6)
+                npt.assert_array_equal(ds['lat'].values, self.dataset['lat'].values)
+
+    def test_tiles(self):
+        self.assertEqual(get_tiles(5, 4, (5, 3)), [(0, 5, 0, 3), (0, 5, 3, 4)])
+        self.assertEqual(get_tiles(5, 1, (2, 1)), [(0, 2, 0, 1), (2, 4, 0, 1), (4, 5, 0, 1)])
+
+    def test_predict_tiled(self):
+        done = predict_tiled(self.model, self.load_region, FLUX_VARS, self.paths,
+                             met_vars=MET_VARS, memory=self.memory)
+        self.assertEqual(len(done), 4)
+        self.check_output()
+        # the progress sidecar is removed when all tiles are done
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['test_Qh.nc', 'test_Qle.nc'])
+
+    def test_resume(self):
+        def failing_load(region):
+            if len(self.regions) == 4:
+                raise RuntimeError("interrupted")
+            return self.load_region(region)
+
+        # two grid slices, then two tiles before the failure
+        with self.assertRaises(RuntimeError):
+            predict_tiled(self.model, failing_load, FLUX_VARS, self.paths,
+                          met_vars=MET_VARS, memory=self.memory)
+
+        done = predict_tiled(self.model, self.load_region, FLUX_VARS, self.paths,
+                             met_vars=MET_VARS, memory=self.memory)
+        self.assertEqual(done, [(0, 5, 2, 3), (0, 5, 3, 4)])
+        self.check_output()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_ledger.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the pipeline state ledger
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from empirical_lsm import ledger
+from empirical_lsm.scheduler import TaskScheduler, Task
+
+
+class TestLedger(unittest.TestCase):
+    """Test job recording and resuming, in an empty working directory"""
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_jobs(self):
+        h = ledger.get_input_hash('a', 'X', 'rst')
+        self.assertFalse(ledger.is_up_to_date('a', 'X', 'rst', h))
+
+        ledger.start_job('a', 'X', 'rst', h)
+        self.assertEqual(ledger.get_job('a', 'X', 'rst')['status'], 'running')
+        self.assertEqual(ledger.mark_interrupted(), 1)
+
+        ledger.start_job('a', 'X', 'rst', h)
+        ledger.finish_job('a', 'X', 'rst', 1.0)
+        self.assertTrue(ledger.is_up_to_date('a', 'X', 'rst', h))
+        self.assertEqual(ledger.get_job('a', 'X', 'rst')['attempts'], 2)
+        self.assertFalse(ledger.is_up_to_date('a', 'X', 'rst', ledger.get_input_hash('a', 'X', 'rst', plots=True)))
+
+    def test_resume(self):
+        ledger.start_job('a', 'X', 'eval', ledger.get_input_hash('a', 'X', 'eval', plots=False, fix_closure=True))
+        ledger.finish_job('a', 'X', 'eval', 1.0)
+        ledger.start_job('a', 'Y', 'eval', ledger.get_input_hash('a', 'Y', 'eval', plots=False, fix_closure=True))
+        ledger.finish_job('a', 'Y', 'eval', 1.0, error='failed')
+
+        scheduler = TaskScheduler(['a'], ['X', 'Y', 'Z'], ['eval', 'rst'], ncores=2, memory_budget=100e9)
+        self.assertEqual(scheduler.up_to_date, [Task('a', 'X', 'eval')])
+        self.assertEqual(set(scheduler.ready),
+                         set([Task('a', 'X', 'rst'), Task('a', 'Y', 'eval'), Task('a', 'Z', 'eval')]))
+
+        scheduler = TaskScheduler(['a'], ['X', 'Y', 'Z'], ['eval', 'rst'], ncores=2, memory_budget=100e9,
+                                  retry_failed=True)
+        self.assertEqual(scheduler.ready, [Task('a', 'Y', 'eval')])
+
+        # later stages of a retried task run, although they were never attempted
+        scheduler.start(scheduler.next_task())
+        scheduler.finish(Task('a', 'Y', 'eval'), 1.0, None)
+        self.assertEqual(scheduler.ready, [Task('a', 'Y', 'rst')])
+
+
+if __name__ == '__main__':
+    unittest.main()
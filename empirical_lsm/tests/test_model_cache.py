@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_model_cache.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the fitted model cache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sklearn.linear_model import LinearRegression
+
+from empirical_lsm import model_cache
+from empirical_lsm.model_defs import parse_model_name, km_lin
+
+
+class TestSpecHash(unittest.TestCase):
+    """Test canonical model spec hashing"""
+
+    def test_equivalent_names(self):
+        self.assertEqual(model_cache.get_spec_hash(parse_model_name('STH_km27')),
+                         model_cache.get_spec_hash(parse_model_name('STH_km27.2')))
+
+    def test_different_models(self):
+        self.assertNotEqual(model_cache.get_spec_hash(km_lin(27)),
+                            model_cache.get_spec_hash(km_lin(243)))
+        self.assertNotEqual(model_cache.get_spec_hash(LinearRegression()),
+                            model_cache.get_spec_hash(LinearRegression(fit_intercept=False)))
+
+    def test_forcing_vars(self):
+        self.assertNotEqual(model_cache.get_spec_hash(parse_model_name('ST_lin')),
+                            model_cache.get_spec_hash(parse_model_name('SH_lin')))
+
+
+class TestEviction(unittest.TestCase):
+    """Test LRU eviction"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache_dir = model_cache.MODEL_CACHE_DIR
+        model_cache.MODEL_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        model_cache.MODEL_CACHE_DIR = self.old_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def test_least_recently_used_evicted(self):
+        for i in range(5):
+            path = model_cache.get_fit_path('fit%d' % i)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (i, i))
+
+        model_cache.evict_fits(250, keep=[model_cache.get_fit_path('fit0')])
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['fit0.pickle', 'fit4.pickle'])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_package.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for lazy submodule loading
+"""
+
+import sys
+import json
+import subprocess
+import unittest
+
+
+def loaded_after(code):
+    """Modules in sys.modules after running code in a fresh interpreter"""
+    script = "import sys, json\nsys.path[:0] = {p!r}\n{c}\nprint(json.dumps(list(sys.modules)))".format(
+        p=sys.path, c=code)
+    out = subprocess.check_output([sys.executable, '-c', script])
+
+    return set(json.loads(out.decode().strip().splitlines()[-1]))
+
+
+class TestLazyImports(unittest.TestCase):
+    """Test that submodules are only imported when used"""
+
+    def test_import_package(self):
+        loaded = loaded_after("import empirical_lsm")
+        for m in ['empirical_lsm.plots', 'empirical_lsm.data', 'seaborn', 'pals_utils']:
+            self.assertNotIn(m, loaded)
+
+    def test_import_transforms(self):
+        loaded = loaded_after("import empirical_lsm.transforms")
+        for m in ['empirical_lsm.plots', 'empirical_lsm.data', 'seaborn', 'tabulate']:
+            self.assertNotIn(m, loaded)
+
+    def test_attribute_access(self):
+        import empirical_lsm
+        self.assertIn('clusterregression', dir(empirical_lsm))
+        self.assertEqual(empirical_lsm.clusterregression.__name__, 'empirical_lsm.clusterregression')
+        with self.assertRaises(AttributeError):
+            empirical_lsm.not_a_module
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_qc_index.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the QC bitmap index
+"""
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import xarray as xr
+import numpy.testing as npt
+
+from empirical_lsm.qc_index import compute_qc_bitmaps, get_qc_flag_mask, sources_changed
+
+
+class TestQCBitmaps(unittest.TestCase):
+    """Test bitmap computation"""
+
+    def setUp(self):
+        n = 21
+        qle = np.arange(n, dtype=float)
+        qle[[1, 5]] = np.nan
+        qle_qc = np.ones(n)
+        qle_qc[[5, 7, 20]] = 0
+        self.ds = xr.Dataset(dict(Qle=('time', qle), Qle_qc=('time', qle_qc),
+                                  Tair=('time', np.ones(n)), latitude=((), 10.0)),
+                             coords=dict(time=np.arange(n)))
+
+    def test_bitmaps(self):
+        bitmaps, counts, n_times = compute_qc_bitmaps([self.ds], good_qc=1)
+
+        self.assertEqual(n_times, 21)
+        self.assertEqual(sorted(bitmaps), ['Qle.finite', 'Qle.qc', 'Tair.finite', 'Tair.qc'])
+        self.assertEqual(counts['Qle'], dict(finite=19, qc=18, valid=17))
+        self.assertEqual(counts['Tair'], dict(finite=21, qc=21, valid=21))
+
+        valid = np.unpackbits(bitmaps['Qle.finite'] & bitmaps['Qle.qc'], count=n_times).astype(bool)
+        npt.assert_array_equal(np.flatnonzero(~valid), [1, 5, 7, 20])
+
+    def test_flag_mask(self):
+        npt.assert_array_equal(np.flatnonzero(~get_qc_flag_mask(self.ds, 'Qle', good_qc=1)), [5, 7, 20])
+        self.assertTrue(get_qc_flag_mask(self.ds, 'Tair', good_qc=1).all())
+
+    def test_sources_changed(self):
+        with tempfile.NamedTemporaryFile() as f:
+            stat = os.stat(f.name)
+            sources = [[f.name, stat.st_size, stat.st_mtime]]
+            self.assertFalse(sources_changed(sources))
+            f.write(b'new data')
+            f.flush()
+            self.assertTrue(sources_changed(sources))
+        self.assertTrue(sources_changed(sources))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_resource_model.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for memory and runtime estimates
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.linear_model import LinearRegression
+
+from empirical_lsm import resource_model
+from empirical_lsm.model_defs import parse_model_name
+
+
+class TestEstimates(unittest.TestCase):
+    """Test analytic estimates and refinement from records"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_log = resource_model.RESOURCE_LOG
+        resource_model.RESOURCE_LOG = os.path.join(self.tmp_dir, 'logs', 'resources.jsonl')
+        resource_model.load_records(reload=True)
+
+    def tearDown(self):
+        resource_model.RESOURCE_LOG = self.old_log
+        resource_model.load_records(reload=True)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_families(self):
+        features = resource_model.get_model_features(parse_model_name('STH_km27'), 1000)
+        self.assertEqual(features['family'], 'cluster')
+        self.assertEqual(features['n_clusters'], 27)
+        self.assertEqual(features['n_features'], 3)
+
+    def test_tree_memory(self):
+        n = 10 ** 6
+        lin = resource_model.estimate_resources(LinearRegression(), n)
+        trees = resource_model.estimate_resources(ExtraTreesRegressor(n_estimators=100), n)
+        self.assertGreater(trees['memory'], 10 * lin['memory'])
+        self.assertGreater(trees['runtime'], lin['runtime'])
+        self.assertEqual(lin['source'], 'analytic')
+
+    def test_correction(self):
+        model = LinearRegression()
+        analytic = resource_model.estimate_resources(model, 1000)
+        for i in range(resource_model.MIN_RECORDS):
+            resource_model.record_resources(model, 1000, analytic['memory'] * 2, analytic['runtime'] * 3)
+        resource_model.load_records(reload=True)
+
+        refined = resource_model.estimate_resources(model, 1000)
+        self.assertEqual(refined['source'], 'spec')
+        self.assertAlmostEqual(refined['memory'], analytic['memory'] * 2)
+        self.assertAlmostEqual(refined['runtime'], analytic['runtime'] * 3)
+
+    def test_pool_size(self):
+        model = LinearRegression()
+        peak = resource_model.estimate_resources(model, 1000)['memory']
+        self.assertEqual(resource_model.get_pool_size([model], 1000, max_cores=8, memory_budget=peak * 2.5), 2)
+        self.assertEqual(resource_model.get_pool_size([model], 1000, max_cores=8, memory_budget=peak / 2), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
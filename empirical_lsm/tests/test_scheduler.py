@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_scheduler.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the (model, site, stage) task scheduler
+"""
+
+import unittest
+
+from empirical_lsm.scheduler import TaskScheduler, Task
+
+
+class TestScheduler(unittest.TestCase):
+    """Test dependency ordering and memory bin-packing, without running any tasks"""
+
+    def get_scheduler(self, **kwargs):
+        scheduler = TaskScheduler(['a', 'b'], ['X', 'Y'], ['eval', 'rst'], ncores=4, use_ledger=False, **kwargs)
+        scheduler.estimates = {}
+        return scheduler
+
+    def test_dependencies(self):
+        scheduler = self.get_scheduler(memory_budget=100e9)
+        started = []
+        task = scheduler.next_task()
+        while task is not None:
+            scheduler.start(task)
+            started.append(task)
+            task = scheduler.next_task()
+        self.assertEqual(set(t.stage for t in started), set(['eval']))
+        self.assertEqual(scheduler.queue_depth(), 4)
+
+        scheduler.finish(Task('a', 'X', 'eval'), 1.0, None)
+        self.assertEqual(scheduler.next_task(), Task('a', 'X', 'rst'))
+
+        scheduler.finish(Task('b', 'X', 'eval'), 1.0, 'failed')
+        self.assertEqual(scheduler.stats()['skipped'], 1)
+        self.assertEqual(scheduler.stats()['failed'], 1)
+
+    def test_memory_budget(self):
+        # room for one eval and one rst task
+        scheduler = self.get_scheduler(memory_budget=2e9)
+        scheduler.ready = [Task('a', 'X', 'rst'), Task('a', 'Y', 'eval'), Task('b', 'X', 'eval')]
+
+        first = scheduler.next_task()
+        self.assertEqual(first.stage, 'eval')
+        scheduler.start(first)
+        second = scheduler.next_task()
+        self.assertEqual(second.stage, 'rst')
+        scheduler.start(second)
+        self.assertIsNone(scheduler.next_task())
+
+        scheduler.finish(first, 1.0, None)
+        self.assertEqual(scheduler.next_task().stage, 'eval')
+
+    def test_oversized(self):
+        scheduler = self.get_scheduler(memory_budget=1e6)
+        self.assertEqual(scheduler.next_task().stage, 'eval')
+
+
+if __name__ == '__main__':
+    unittest.main()
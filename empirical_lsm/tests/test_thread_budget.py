@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_thread_budget.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for the process/thread split
+"""
+
+import os
+import sys
+import unittest
+
+from unittest import mock
+
+from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.neural_network import MLPRegressor
+
+from empirical_lsm import thread_budget
+
+
+class TestThreadSplit(unittest.TestCase):
+    """Test choosing processes x threads"""
+
+    def test_serial_family(self):
+        processes, threads = thread_budget.get_thread_split([ExtraTreesRegressor()], 1000, max_processes=8, total_threads=8)
+        self.assertEqual((processes, threads), (8, 1))
+
+    def test_memory_limited(self):
+        processes, threads = thread_budget.get_thread_split([MLPRegressor()], 1000, max_processes=2, total_threads=8)
+        self.assertEqual(processes, 2)
+        self.assertGreater(threads, 1)
+        self.assertLessEqual(processes * threads, 8)
+
+        # serial models don't benefit from the spare cores
+        processes, threads = thread_budget.get_thread_split([ExtraTreesRegressor()], 1000, max_processes=2, total_threads=8)
+        self.assertEqual(threads, 1)
+
+    def test_measured_speedups(self):
+        records = [dict(family='mlp', threads=t, runtime=r, predicted_runtime=10.0)
+                   for t, r in [(1, 10.0), (2, 5.0), (4, 10.0)] for i in range(3)]
+        records.append(dict(family='mlp', threads=8, runtime=1.0, predicted_runtime=10.0))
+        measured = thread_budget.get_measured_speedups('mlp', records)
+        self.assertEqual(measured, {1: 1.0, 2: 2.0, 4: 1.0})
+
+        self.assertEqual(thread_budget.get_measured_speedups('tree', records), {})
+
+    def test_thread_limit(self):
+        with thread_budget.thread_limit(2):
+            self.assertEqual(thread_budget.get_thread_limit(), 2)
+        self.assertIsNone(thread_budget.get_thread_limit())
+
+    def test_thread_limit_without_threadpoolctl(self):
+        # no limit is applied, so none is recorded
+        with mock.patch.dict(sys.modules, {'threadpoolctl': None}):
+            with thread_budget.thread_limit(2):
+                self.assertIsNone(thread_budget.get_thread_limit())
+
+    def test_configure(self):
+        with self.assertRaises(KeyError):
+            thread_budget.configure(not_an_option=1)
+        old_total = thread_budget.THREAD_BUDGET_CONFIG['total']
+        thread_budget.configure(total=3)
+        self.assertEqual(thread_budget.get_total_threads(), 3)
+        thread_budget.configure(total=old_total)
+        self.assertEqual(thread_budget.get_total_threads(), os.cpu_count() if old_total is None else old_total)
+
+
+if __name__ == '__main__':
+    unittest.main()
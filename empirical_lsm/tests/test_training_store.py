@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_training_store.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Tests for training data stores and leave-one-out views
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+import numpy.testing as npt
+
+from empirical_lsm.training_store import assemble_store, TrainingSet
+
+
+def make_site_frames(sites, n=10):
+    frames = []
+    for i, s in enumerate(sites):
+        index = pd.MultiIndex.from_arrays(
+            [pd.date_range('2000-01-01', periods=n, freq='30min'), [s] * n],
+            names=['time', 'site'])
+        met = pd.DataFrame(dict(SWdown=np.arange(n) + 100.0 * i, Tair=np.ones(n) * i), index=index)
+        flux = pd.DataFrame(dict(Qle=np.arange(n) * 2.0 + 100.0 * i), index=index)
+        frames.append((met, flux))
+    # one missing flux value at the last site
+    frames[-1][1].iloc[0] = np.nan
+    return frames
+
+
+class TestTrainingSet(unittest.TestCase):
+    """Test leave-one-out TrainingSet views"""
+
+    def setUp(self):
+        self.sites = ['site1', 'site2', 'site3']
+        self.frames = make_site_frames(self.sites)
+        store = assemble_store(self.sites, self.frames, ['SWdown', 'Tair'], ['Qle'])
+        self.train_set = TrainingSet(store)
+
+    def test_leave_out_middle(self):
+        view = self.train_set.leave_out('site2')
+
+        self.assertEqual(view.sites, ['site1', 'site3'])
+        self.assertEqual(view.n_rows, 20)
+        self.assertEqual(view.segments(), [slice(0, 10), slice(20, 30)])
+        npt.assert_array_equal(view.row_index(), np.r_[0:10, 20:30])
+
+        expected = pd.concat([self.frames[0][0], self.frames[2][0]])
+        pd.testing.assert_frame_equal(view.frame('met'), expected, check_index_type=False)
+
+    def test_leave_out_edge_is_zero_copy(self):
+        view = self.train_set.leave_out('site3')
+
+        self.assertEqual(view.segments(), [slice(0, 20)])
+        self.assertTrue(np.shares_memory(view.frame('met').values, self.train_set.store['met']))
+
+    def test_leave_out_unknown_site(self):
+        view = self.train_set.leave_out('elsewhere')
+        self.assertEqual(view.n_rows, 30)
+
+    def test_masked_view(self):
+        masked = self.train_set.leave_out('site1').masked('flux')
+
+        self.assertEqual(masked.count(), 20)
+        self.assertTrue(np.shares_memory(masked.data, self.train_set.store['flux']))
+
+    def test_complete_rows(self):
+        rows = self.train_set.leave_out('site1').complete_rows(['SWdown', 'Tair'], ['Qle'])
+        npt.assert_array_equal(rows, np.r_[10:20, 21:30])
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: thread_budget.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Splits the machine's cores between worker processes and BLAS/OpenMP threads.
+
+Without limits, every Pool worker's numpy/sklearn calls can start one BLAS or OpenMP
+thread per core, oversubscribing the machine. Pool workers here are limited to a
+thread count chosen so that processes x threads fits the core budget. The split is
+chosen to maximise throughput: memory-limited pools get more threads per process,
+and models whose runs don't speed up with threads get one. Speedups come from past
+runs in the resource log (see resource_model) when there are enough of them, and
+otherwise from per-family Amdahl estimates.
+
+Limits are applied with threadpoolctl if it's installed. The usual environment
+variables are also set, but only affect child processes started later - BLAS is
+already loaded in forked workers - so without threadpoolctl no limit is recorded
+(get_thread_limit() returns None), and runs aren't logged with a thread count that
+was never applied.
+"""
+
+import os
+
+import numpy as np
+
+from contextlib import contextmanager
+
+from empirical_lsm.resource_model import get_model_features, load_records, MIN_RECORDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+THREAD_BUDGET_CONFIG = dict(
+    # total threads across all processes (default: all cpus)
+    total=None,
+    # largest thread count per process that is considered
+    max_threads=8,
+)
+
+# Parallel fraction of a run's work, for Amdahl speedup estimates
+PARALLEL_FRACTIONS = {
+    'linear': 0.3,
+    'cluster': 0.5,
+    'tree': 0.0,
+    'boost': 0.0,
+    'neighbours': 0.5,
+    'mlp': 0.8,
+    'svr': 0.0,
+    'mean': 0.0,
+    'unknown': 0.3,
+}
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# Thread limit applied in this process (by threadpoolctl), if any
+_thread_limit = None
+
+
+def configure(**kwargs):
+    """Update the thread budget configuration (see THREAD_BUDGET_CONFIG)"""
+    for k in kwargs:
+        if k not in THREAD_BUDGET_CONFIG:
+            raise KeyError("Unknown thread budget option: %s" % k)
+    THREAD_BUDGET_CONFIG.update(kwargs)
+
+
+def get_total_threads():
+    total = THREAD_BUDGET_CONFIG['total']
+    return os.cpu_count() if total is None else total
+
+
+##################
+# Choosing the split
+##################
+
+def get_measured_speedups(family, records=None):
+    """Speedup by thread count for an estimator family, from past runs
+
+    Runtimes are normalised by the analytic prediction, so runs of different sizes
+    are comparable.
+
+    :returns: dict of {threads: speedup relative to 1 thread}, empty without enough single-thread runs
+    """
+    if records is None:
+        records = load_records()
+
+    ratios = {}
+    for r in records:
+        if r.get('family') == family and r.get('threads') is not None and r['predicted_runtime'] > 0:
+            ratios.setdefault(r['threads'], []).append(r['runtime'] / r['predicted_runtime'])
+
+    ratios = {t: np.median(v) for t, v in ratios.items() if len(v) >= MIN_RECORDS}
+    if 1 not in ratios:
+        return {}
+
+    return {t: float(ratios[1] / r) for t, r in ratios.items()}
+
+
+def get_speedup(family, threads, measured=None):
+    """Speedup of a run with threads threads, relative to one thread"""
+    if measured is not None and threads in measured:
+        return measured[threads]
+
+    f = PARALLEL_FRACTIONS.get(family, PARALLEL_FRACTIONS['unknown'])
+
+    return 1 / ((1 - f) + f / threads)
+
+
+def get_thread_split(models, n_samples, max_processes, total_threads=None):
+    """Number of processes, and threads per process, for running models
+
+    :models: list of unfitted models that will be run
+    :n_samples: number of training samples per run
+    :max_processes: upper limit on processes (e.g. from the memory budget, see resource_model.get_pool_size)
+    :returns: (processes, threads)
+    """
+    if total_threads is None:
+        total_threads = get_total_threads()
+    max_processes = max(1, min(max_processes, total_threads))
+
+    families = set(get_model_features(m, n_samples)['family'] for m in models)
+    measured = dict((f, get_measured_speedups(f)) for f in families)
+
+    best = None
+    for threads in range(1, min(THREAD_BUDGET_CONFIG['max_threads'], total_threads) + 1):
+        processes = min(max_processes, total_threads // threads)
+        # the slowest family determines the benefit of extra threads
+        speedup = min(get_speedup(f, threads, measured[f]) for f in families)
+        throughput = processes * speedup
+        # prefer fewer threads unless more are clearly better
+        if best is None or throughput > best[0] * 1.01:
+            best = (throughput, processes, threads)
+
+    logger.info("Thread budget: {p} process(es) x {t} thread(s) of {n}".format(p=best[1], t=best[2], n=total_threads))
+
+    return best[1], best[2]
+
+
+##################
+# Applying limits
+##################
+
+def limit_threads(n_threads):
+    """Limit BLAS/OpenMP threads in this process, and its child processes"""
+    global _thread_limit
+
+    for v in THREAD_ENV_VARS:
+        os.environ[v] = str(n_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.warning("threadpoolctl not installed, threads are not limited in this process")
+        return
+
+    threadpool_limits(limits=n_threads)
+    _thread_limit = n_threads
+
+
+@contextmanager
+def thread_limit(n_threads):
+    """Temporarily limit BLAS/OpenMP threads in this process (e.g. for one task in a shared pool)"""
+    global _thread_limit
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.debug("threadpoolctl not installed, threads are not limited in this process")
+        yield
+        return
+
+    previous = _thread_limit
+    _thread_limit = n_threads
+    try:
+        with threadpool_limits(limits=n_threads):
+            yield
+    finally:
+        _thread_limit = previous
+
+
+def get_thread_limit():
+    """Thread limit applied in this process, or None if threads weren't actually limited"""
+    return _thread_limit
+
+
+def init_worker(n_threads, initializer=None, initargs=()):
+    """Pool initializer: limit threads, then run another initializer"""
+    limit_threads(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: training_store.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Cached, memory-mapped multi-site training data.
+
+Multi-site training data is loaded once per (site list, variable set, qc, fix_closure),
+and written as contiguous met and flux arrays plus a site offset index. Later runs
+(and Pool workers) memory-map the arrays, so they load almost instantly and share
+pages through the OS cache.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from pals_utils.data import get_multisite_met_df, get_multisite_flux_df
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TRAINING_STORE_DIR = 'cache/training'
+
+# Stores attached from a parent process (see init_worker), by store path
+_attached_stores = {}
+
+
+def get_store_key(sites, met_vars, flux_vars, qc=True, fix_closure=True):
+    """Unique key for a training data set
+
+    :returns: short hex digest
+    """
+    spec = json.dumps(dict(sites=list(sites), met_vars=list(met_vars), flux_vars=list(flux_vars),
+                           qc=bool(qc), fix_closure=bool(fix_closure)),
+                      sort_keys=True)
+    return hashlib.sha1(spec.encode()).hexdigest()[:16]
+
+
+def get_store_path(sites, met_vars, flux_vars, qc=True, fix_closure=True):
+    """Path to the store directory for a training data set"""
+    key = get_store_key(sites, met_vars, flux_vars, qc, fix_closure)
+    return os.path.join(TRAINING_STORE_DIR, key)
+
+
+def load_site_frames(site, met_vars, flux_vars, qc=True, fix_closure=True):
+    """Load met and flux dataframes for a single site, with matching indices
+
+    :returns: (met_df, flux_df)
+    """
+    met = get_multisite_met_df([site], variables=met_vars, qc=qc, name=True)
+    flux = get_multisite_flux_df([site], variables=flux_vars, qc=qc, name=True, fix_closure=fix_closure)
+    if not met.index.equals(flux.index):
+        flux = flux.reindex(met.index)
+
+    return met, flux
+
+
+def load_sites(sites, met_vars, flux_vars, qc=True, fix_closure=True, nthreads=None):
+    """Load met and flux frames for all sites concurrently
+
+    netCDF reads are serialised by xarray's HDF5 lock, but decoding, QC masking and
+    dataframe conversion overlap between sites, so a cold load is bounded by the
+    slowest site rather than the sum of all sites.
+
+    :nthreads: size of the loader thread pool (default: one per site, up to the number of cpus)
+    :returns: (list of (met_df, flux_df) tuples in site order, dict of per-site load times in seconds)
+    """
+    if nthreads is None:
+        nthreads = min(len(sites), os.cpu_count())
+
+    def load_timed(site):
+        t_start = dt.now()
+        frames = load_site_frames(site, met_vars, flux_vars, qc, fix_closure)
+        return frames, (dt.now() - t_start).total_seconds()
+
+    t_start = dt.now()
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as executor:
+            results = list(executor.map(load_timed, sites))
+    else:
+        results = [load_timed(s) for s in sites]
+    total_time = (dt.now() - t_start).total_seconds()
+
+    site_frames = [r[0] for r in results]
+    load_times = {s: r[1] for s, r in zip(sites, results)}
+
+    logger.info("Loaded {n} sites in {t:.1f}s using {nt} thread(s) (sum of site times {st:.1f}s):\n{l}".format(
+        n=len(sites), t=total_time, nt=nthreads, st=sum(load_times.values()),
+        l='\n'.join('    {s}: {t:.2f}s'.format(s=s, t=t) for s, t in load_times.items())))
+
+    return site_frames, load_times
+
+
+def fill_array(out, site_frames, i, offsets):
+    """Copy per-site frames into a preallocated array
+
+    :out: array with offsets[-1] rows
+    :i: 0 for met frames, 1 for flux frames
+    """
+    for start, end, frames in zip(offsets[:-1], offsets[1:], site_frames):
+        out[start:end] = frames[i].values
+
+    return out
+
+
+def get_store_meta(sites, site_frames, met_vars, flux_vars, qc=True, fix_closure=True, load_times=None):
+    """Store metadata, including the site offset index
+
+    :site_frames: list of (met_df, flux_df) tuples, in the same order as sites
+    :load_times: per-site load times, from load_sites
+    """
+    lengths = [met.shape[0] for met, flux in site_frames]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+
+    return dict(sites=list(sites),
+                offsets=offsets.tolist(),
+                met_vars=list(met_vars),
+                flux_vars=list(flux_vars),
+                qc=bool(qc),
+                fix_closure=bool(fix_closure),
+                index_names=list(site_frames[0][0].index.names),
+                load_times=load_times,
+                created=str(dt.now()))
+
+
+def assemble_store(sites, site_frames, met_vars, flux_vars, qc=True, fix_closure=True, load_times=None):
+    """In-memory store, with the same layout as load_training_store
+
+    :site_frames: list of (met_df, flux_df) tuples, in the same order as sites
+    """
+    meta = get_store_meta(sites, site_frames, met_vars, flux_vars, qc, fix_closure, load_times)
+    offsets = meta['offsets']
+    store = dict(meta=meta,
+                 path=None,
+                 met=fill_array(np.empty([offsets[-1], len(met_vars)]), site_frames, 0, offsets),
+                 flux=fill_array(np.empty([offsets[-1], len(flux_vars)]), site_frames, 1, offsets),
+                 index={})
+    for level in meta['index_names']:
+        if level != 'site':
+            store['index'][level] = np.concatenate(
+                [met.index.get_level_values(level).values for met, flux in site_frames])
+
+    return store
+
+
+def write_training_store(path, sites, site_frames, met_vars, flux_vars, qc=True, fix_closure=True,
+                         load_times=None):
+    """Write per-site frames to a store directory as contiguous arrays
+
+    The store is written to a temporary directory first and renamed into place,
+    so concurrent builders can't leave a partial store behind.
+
+    :site_frames: list of (met_df, flux_df) tuples, in the same order as sites
+    """
+    meta = get_store_meta(sites, site_frames, met_vars, flux_vars, qc, fix_closure, load_times)
+    offsets = meta['offsets']
+    index_names = meta['index_names']
+
+    tmp_path = '{p}.tmp-{pid}'.format(p=path, pid=os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for kind, i in [('met', 0), ('flux', 1)]:
+        shape = (offsets[-1], len(site_frames[0][i].columns))
+        array = np.lib.format.open_memmap(os.path.join(tmp_path, kind + '.npy'), mode='w+',
+                                          dtype=np.float64, shape=shape)
+        fill_array(array, site_frames, i, offsets)
+        array.flush()
+        del array
+
+    for level in index_names:
+        if level == 'site':
+            continue
+        values = np.concatenate([met.index.get_level_values(level).values for met, flux in site_frames])
+        np.save(os.path.join(tmp_path, 'index_%s.npy' % level), values)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process built the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return path
+
+
+def build_training_store(sites, met_vars, flux_vars, qc=True, fix_closure=True, nthreads=None):
+    """Load training data for all sites, and write it to the store
+
+    :nthreads: number of site-loading threads, see load_sites
+    :returns: path to the store directory
+    """
+    path = get_store_path(sites, met_vars, flux_vars, qc, fix_closure)
+    os.makedirs(TRAINING_STORE_DIR, exist_ok=True)
+
+    logger.info("Building training store for {n} sites at {p}".format(n=len(sites), p=path))
+    site_frames, load_times = load_sites(sites, met_vars, flux_vars, qc, fix_closure, nthreads)
+
+    return write_training_store(path, sites, site_frames, met_vars, flux_vars, qc, fix_closure, load_times)
+
+
+def load_training_store(path, mmap_mode='c'):
+    """Load a training store, memory-mapping the data arrays
+
+    The default copy-on-write mode shares pages between processes, but lets
+    callers modify their view without touching the store on disk.
+
+    :path: store directory
+    :returns: dict with meta, met, flux, and index arrays
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    store = dict(meta=meta,
+                 path=path,
+                 met=np.load(os.path.join(path, 'met.npy'), mmap_mode=mmap_mode),
+                 flux=np.load(os.path.join(path, 'flux.npy'), mmap_mode=mmap_mode),
+                 index={})
+    for level in meta['index_names']:
+        if level != 'site':
+            store['index'][level] = np.load(os.path.join(path, 'index_%s.npy' % level))
+
+    return store
+
+
+def get_training_store(sites, met_vars, flux_vars, qc=True, fix_closure=True, rebuild=False, nthreads=None):
+    """Load a training store, building it first if necessary
+
+    :rebuild: rebuild the store even if it exists (e.g. if the source data has changed)
+    :nthreads: number of site-loading threads for building, see load_sites
+    :returns: store dict, see load_training_store
+    """
+    path = get_store_path(sites, met_vars, flux_vars, qc, fix_closure)
+
+    if path in _attached_stores and not rebuild:
+        return _attached_stores[path]
+
+    if rebuild and os.path.isdir(path):
+        shutil.rmtree(path)
+    if not os.path.isdir(path):
+        build_training_store(sites, met_vars, flux_vars, qc, fix_closure, nthreads)
+    else:
+        logger.info("Loading training store from {p}".format(p=path))
+
+    return load_training_store(path)
+
+
+def get_store_key_path(store):
+    """Store path for a store dict (also for in-memory stores, which aren't on disk)"""
+    meta = store['meta']
+    return get_store_path(meta['sites'], meta['met_vars'], meta['flux_vars'],
+                          meta['qc'], meta['fix_closure'])
+
+
+def share_store(store):
+    """Picklable handle to a store, for passing to worker processes
+
+    Stores on disk are passed by path (workers memory-map the same file). In-memory
+    stores are copied once into shared memory blocks, and workers attach to them.
+
+    :returns: (handle, list of SharedMemory blocks to release with release_blocks)
+    """
+    handle = dict(key=get_store_key_path(store), meta=store['meta'])
+    if store['path'] is not None:
+        handle['path'] = store['path']
+        return handle, []
+
+    from multiprocessing import shared_memory
+
+    arrays = dict(met=store['met'], flux=store['flux'])
+    arrays.update({'index_' + level: values for level, values in store['index'].items()})
+
+    blocks = []
+    handle['arrays'] = {}
+    for name, array in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        handle['arrays'][name] = (shm.name, array.shape, array.dtype.str)
+        blocks.append(shm)
+
+    return handle, blocks
+
+
+def release_blocks(blocks):
+    """Free shared memory blocks created by share_store"""
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def attach_store(handle):
+    """Attach to a store shared by a parent process, without copying the data
+
+    :handle: handle from share_store
+    :returns: store dict
+    """
+    if 'path' in handle:
+        store = load_training_store(handle['path'])
+    else:
+        from multiprocessing import shared_memory
+
+        store = dict(meta=handle['meta'], path=None, index={}, blocks=[])
+        for name, (shm_name, shape, dtype) in handle['arrays'].items():
+            try:
+                # Don't let this process's resource tracker unlink the parent's block
+                shm = shared_memory.SharedMemory(name=shm_name, track=False)
+            except TypeError:  # python < 3.13
+                shm = shared_memory.SharedMemory(name=shm_name)
+            # keep a reference, or the buffer is released
+            store['blocks'].append(shm)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            if name.startswith('index_'):
+                store['index'][name[len('index_'):]] = array
+            else:
+                store[name] = array
+
+    _attached_stores[handle['key']] = store
+
+    return store
+
+
+def init_worker(handles):
+    """Pool initializer: attach shared training stores in a worker process
+
+    get_training_store then returns the attached stores instead of loading them.
+    """
+    for handle in handles:
+        attach_store(handle)
+
+
+def get_store_index(store, use_names=True, rows=slice(None)):
+    """Build a pandas index for (a subset of) the store rows
+
+    :use_names: include the 'site' index level
+    :rows: slice or index array of rows to include
+    """
+    meta = store['meta']
+    arrays = []
+    names = []
+    for level in meta['index_names']:
+        if level == 'site':
+            if not use_names:
+                continue
+            lengths = np.diff(meta['offsets'])
+            codes = np.repeat(np.arange(len(meta['sites'])), lengths)[rows]
+            arrays.append(np.asarray(meta['sites'], dtype=object)[codes])
+        else:
+            arrays.append(store['index'][level][rows])
+        names.append(level)
+
+    if len(arrays) == 1:
+        return pd.Index(arrays[0], name=names[0])
+    return pd.MultiIndex.from_arrays(arrays, names=names)
+
+
+class TrainingSet(object):
+
+    """Site-segmented training data, with zero-copy leave-one-out views.
+
+    All views share the store arrays. Rows are only copied when a dataframe is
+    requested for a non-contiguous selection (e.g. a site left out of the middle).
+    """
+
+    def __init__(self, store, exclude=(), use_names=True):
+        """Training set over a store
+
+        :store: store dict (see load_training_store and assemble_store)
+        :exclude: sites to leave out
+        :use_names: include the 'site' index level in dataframes
+        """
+        self.store = store
+        self.meta = store['meta']
+        self.exclude = tuple(exclude)
+        self.use_names = use_names
+
+        offsets = self.meta['offsets']
+        self._segments = [slice(offsets[i], offsets[i + 1])
+                          for i, s in enumerate(self.meta['sites']) if s not in self.exclude]
+
+    def __repr__(self):
+        return "TrainingSet({n} sites, {r} rows)".format(n=len(self.sites), r=self.n_rows)
+
+    @property
+    def sites(self):
+        return [s for s in self.meta['sites'] if s not in self.exclude]
+
+    @property
+    def n_rows(self):
+        return sum(seg.stop - seg.start for seg in self._segments)
+
+    def leave_out(self, site):
+        """Training set view without site (or the same sites, if site isn't in the set)"""
+        return TrainingSet(self.store, self.exclude + (site,), self.use_names)
+
+    def segments(self):
+        """Contiguous row ranges in the view, as slices into the store arrays
+
+        Adjacent sites are merged into a single slice.
+        """
+        merged = []
+        for seg in self._segments:
+            if len(merged) > 0 and merged[-1].stop == seg.start:
+                merged[-1] = slice(merged[-1].start, seg.stop)
+            else:
+                merged.append(seg)
+        return merged
+
+    def row_index(self):
+        """Index array of rows in the view, for estimators that accept one"""
+        return np.concatenate([np.arange(seg.start, seg.stop) for seg in self._segments])
+
+    def row_mask(self):
+        """Boolean mask over all store rows, True for rows in the view"""
+        mask = np.zeros(self.meta['offsets'][-1], dtype=bool)
+        for seg in self._segments:
+            mask[seg] = True
+        return mask
+
+    def masked(self, kind='met'):
+        """Masked array view of the store data - rows outside the view are masked
+
+        :kind: 'met' or 'flux'
+        """
+        data = self.store[kind]
+        mask = np.broadcast_to(~self.row_mask()[:, np.newaxis], data.shape)
+        return np.ma.masked_array(data, mask=mask, copy=False)
+
+    def complete_rows(self, met_vars=None, flux_vars=None):
+        """Index array of rows in the view with finite values for all given variables"""
+        rows = self.row_index()
+        ok = np.ones(len(rows), dtype=bool)
+        for kind, variables in [('met', met_vars), ('flux', flux_vars)]:
+            if variables is None:
+                continue
+            cols = self._columns(kind, variables)
+            for seg_start, seg in self._iter_segments(rows):
+                ok[seg_start:seg_start + seg.stop - seg.start] &= \
+                    np.isfinite(self.store[kind][seg, cols]).all(axis=1)
+        return rows[ok]
+
+    def _iter_segments(self, rows):
+        """(position in rows, store slice) for each segment"""
+        position = 0
+        for seg in self._segments:
+            yield position, seg
+            position += seg.stop - seg.start
+
+    def _columns(self, kind, variables):
+        all_vars = self.meta[kind + '_vars']
+        return [all_vars.index(v) for v in variables]
+
+    def frame(self, kind='met', variables=None, rows=None):
+        """Dataframe of (a subset of) the view
+
+        Contiguous views are returned without copying the data.
+
+        :kind: 'met' or 'flux'
+        :variables: columns to include (default all)
+        :rows: index array of store rows (default all rows in the view)
+        """
+        all_vars = self.meta[kind + '_vars']
+        if variables is None:
+            variables = all_vars
+
+        if rows is None:
+            segments = self.segments()
+            if len(segments) == 1:
+                rows = segments[0]
+            else:
+                rows = self.row_index()
+
+        if isinstance(rows, slice) and list(variables) == list(all_vars):
+            values = self.store[kind][rows]
+        else:
+            values = self.store[kind][rows][:, self._columns(kind, variables)]
+
+        index = get_store_index(self.store, self.use_names, rows)
+        return pd.DataFrame(values, index=index, columns=list(variables), copy=False)
@@ -15,7 +15,9 @@ import xarray as xr
 
 from collections import OrderedDict
 from sklearn.utils.validation import check_is_fitted
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+
+from empirical_lsm.instrument import timed
 
 import logging
 logger = logging.getLogger(__name__)
@@ -283,6 +285,7 @@ class LagAverageWrapper(BaseEstimator):
     """Modelwrapper that lags takes Tair, SWdown, RelHum, Wind, and Rainf, and lags them to estimate Qle fluxes."""
 
     partial_data_ok = True
+    shared_features_ok = True
 
     def __init__(self, var_lags, model, datafreq=0.5):
         """Model wrapper
@@ -318,6 +321,7 @@ class LagAverageWrapper(BaseEstimator):
                         lagged_data.append(lag_avg)
         return np.concatenate(lagged_data, axis=1)
 
+    @timed('lag')
     def _lag_data(self, X, var_lags=None, datafreq=None):
         """lag an array. Assumes that each column corresponds to variables listed in lags
 
@@ -340,11 +344,11 @@ class LagAverageWrapper(BaseEstimator):
             assert all([v in X.columns for v in var_lags]), "Variables in X do not match initialised var_lags"
             columns = ["%s_%s" % (k, v) for k, l in var_lags.items() for v in l]
             if 'site' in X.index.names:
-                # split-apply-combine by site
-                results = {}
-                for site in X.index.get_level_values('site').unique():
-                    results[site] = self._lag_array(X.ix[X.index.get_level_values('site') == site, list(var_lags)].values, var_lags, datafreq)
-                result = np.concatenate([d for d in results.values()])
+                # split-apply-combine by site (or grid cell); each site's rows must be contiguous
+                values = X[list(var_lags)].values
+                bounds = get_block_bounds(X.index.get_level_values('site'))
+                result = np.concatenate([self._lag_array(values[start:end], var_lags, datafreq)
+                                         for start, end in zip(bounds[:-1], bounds[1:])])
             else:
                 result = self._lag_array(X[list(var_lags)].values, var_lags, datafreq)
             result = pd.DataFrame(result, index=X.index, columns=columns)
@@ -379,16 +383,34 @@ class LagAverageWrapper(BaseEstimator):
 
         self.model.fit(lagged_data[fit_idx], y[fit_idx])
 
-    def predict(self, X, datafreq=None):
-        """predict model using X
+    def fit_multi(self, X, ys, datafreq=None):
+        """fit several output variables, lagging X only once
 
-        :X: Dataframe or ndarray of similar shape
-        :returns: array like y
+        :X: Dataframe, or ndarray with len(var_lags) columns
+        :ys: OrderedDict of {variable: y}, y may contain NaNs
 
         """
         if datafreq is None:
             datafreq = self.datafreq
 
+        lagged_data = self._lag_data(X, datafreq=datafreq)
+
+        self._means = np.nanmean(lagged_data, axis=0)
+
+        fit_idx = np.isfinite(lagged_data).all(axis=1)
+
+        logger.info("LAW: Data lagged once, fitting {nv} variables with {nk} samples out of {nx}".format(
+            nv=len(ys), nk=sum(fit_idx), nx=X.shape[0]))
+
+        self._heads = fit_multi(self.model, lagged_data[fit_idx], OrderedDict((v, y[fit_idx]) for v, y in ys.items()))
+
+        return self
+
+    def _lag_predict_data(self, X, datafreq=None):
+        """Lagged X for prediction, with initial NaNs filled with the fit means"""
+        if datafreq is None:
+            datafreq = self.datafreq
+
         if X.isnull().any().any():  # TODO: Probably won't work with numpy arrays, if that matters..
             raise ValueError("Can't predict with NAs in X - check your data.")
 
@@ -398,13 +420,31 @@ class LagAverageWrapper(BaseEstimator):
         for i in range(lagged_data.shape[1]):
             lagged_data.ix[np.isnan(lagged_data.iloc[:, i]), i] = self._means[i]
 
-        return self.model.predict(lagged_data)
+        return lagged_data
+
+    def predict(self, X, datafreq=None):
+        """predict model using X
+
+        :X: Dataframe or ndarray of similar shape
+        :returns: array like y
+
+        """
+        return self.model.predict(self._lag_predict_data(X, datafreq))
+
+    def predict_multi(self, X, datafreq=None):
+        """predict all variables fitted with fit_multi, lagging X only once
+
+        :returns: OrderedDict of {variable: prediction}
+        """
+        return predict_multi(self.model, self._heads, self._lag_predict_data(X, datafreq))
 
 
 class MarkovLagAverageWrapper(LagAverageWrapper):
     """Lags variables, and uses markov fitting when fluxes are included"""
 
     partial_data_ok = True
+    # fluxes are lagged inputs, so variables can't share features
+    shared_features_ok = False
 
     def __init__(self, var_lags, model, datafreq=0.5):
         super().__init__(var_lags, model, datafreq)
@@ -486,6 +526,7 @@ class MissingDataWrapper(BaseEstimator):
     """Model wrapper that kills NAs"""
 
     partial_data_ok = True
+    shared_features_ok = True
 
     def __init__(self, model):
         """kills NAs
@@ -509,6 +550,22 @@ class MissingDataWrapper(BaseEstimator):
         # make work with arrays and dataframes
         self.model.fit(X[qc_index], y[qc_index])
 
+    def fit_multi(self, X, ys):
+        """Removes rows with NAs in X, then fits several output variables
+
+        Rows with NAs in a variable's y are dropped by the wrapped model, for that variable only.
+
+        :X: Numpy array-like
+        :ys: OrderedDict of {variable: y}
+        """
+        qc_index = np.isfinite(np.asarray(X)).all(axis=1)
+
+        logger.info("MDW: Dropping data... using {n} samples of {N} for {nv} variables".format(
+            n=qc_index.sum(), N=X.shape[0], nv=len(ys)))
+        self._heads = fit_multi(self.model, X[qc_index], OrderedDict((v, y[qc_index]) for v, y in ys.items()))
+
+        return self
+
     def predict(self, X):
         """pass on model prediction
 
@@ -518,11 +575,62 @@ class MissingDataWrapper(BaseEstimator):
         """
         return self.model.predict(X)
 
+    def predict_multi(self, X):
+        """pass on model predictions for all variables fitted with fit_multi"""
+        return predict_multi(self.model, self._heads, X)
+
 
 #########################################
 # Helper functions
 #########################################
 
+def fit_multi(model, X, ys):
+    """Fit a wrapped model to several output variables on shared features
+
+    Uses model.fit_multi if the model supports it (shared_features_ok, e.g. ModelByCluster
+    clusters only once), otherwise fits a copy of the model per variable on the rows
+    where y is finite.
+
+    :ys: OrderedDict of {variable: y}, y may contain NaNs
+    :returns: dict of per-variable fitted copies, or None if model was fitted in place
+    """
+    if getattr(model, 'shared_features_ok', False):
+        model.fit_multi(X, ys)
+        return None
+
+    heads = OrderedDict()
+    for v, y in ys.items():
+        y_ok = np.isfinite(np.asarray(y, dtype=float)).reshape(len(y), -1).all(axis=1)
+        heads[v] = clone(model)
+        heads[v].fit(X[y_ok], y[y_ok])
+
+    return heads
+
+
+def predict_multi(model, heads, X):
+    """Predict all variables from a model fitted with fit_multi
+
+    :heads: return value of fit_multi
+    :returns: OrderedDict of {variable: prediction}
+    """
+    if heads is None:
+        return model.predict_multi(X)
+
+    return OrderedDict((v, h.predict(X)) for v, h in heads.items())
+
+
+def get_block_bounds(labels):
+    """Start positions of each run of equal labels, plus the end position
+
+    :labels: array-like of labels (e.g. site names), with each label's rows contiguous
+    :returns: array of boundaries, so block i is rows bounds[i]:bounds[i + 1]
+    """
+    labels = np.asarray(labels)
+    starts = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+
+    return np.concatenate([[0], starts, [len(labels)]])
+
+
 def rolling_window(a, rows):
     """from http://www.rigtorp.se/2011/01/01/rolling-statistics-numpy.html"""
     shape = a.shape[:-1] + (a.shape[-1] - rows + 1, rows)
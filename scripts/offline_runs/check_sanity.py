@@ -8,30 +8,38 @@ Github: https://github.com/naught101/empirical_lsm
 Description: Checks existing model output for sanity
 
 Usage:
-    check_sanity.py data (all|<model>...) [--sites=<sites>] [--re-run] [--re-eval] [--delete]
-    check_sanity.py metrics (all|<model>...) [--sites=<sites>] [--re-run] [--re-eval] [--delete]
+    check_sanity.py data (all|<model>...) [--sites=<sites>] [--re-run] [--re-eval] [--delete] [--daemon]
+    check_sanity.py metrics (all|<model>...) [--sites=<sites>] [--re-run] [--re-eval] [--delete] [--daemon]
     check_sanity.py (-h | --help | --version)
 
 Options:
     -h, --help    Show this screen and exit.
+    --daemon      Run in the warm daemon if it's running, see scripts/tools/lsm_daemon.py
 """
 
 from docopt import docopt
 
 import os
-from glob import glob
 
-from empirical_lsm.data import get_sites
-from empirical_lsm.checks import check_model_data, check_metrics
-
-from empirical_lsm.offline_simulation import run_model_site_tuples_mp
-from empirical_lsm.offline_eval import eval_simulation
+import empirical_lsm
+from empirical_lsm.daemon import run_script
 
 from pals_utils.logging import setup_logger
 logger = setup_logger(None, 'logs/check_sanity.log')
 
 
 def main(args):
+    # imported here, so --daemon dispatch doesn't pay for them
+    from empirical_lsm.data import get_sites
+    from empirical_lsm.checks import check_model_data, check_metrics
+
+    from empirical_lsm.offline_simulation import run_model_site_tuples_mp
+    from empirical_lsm.offline_eval import eval_simulation
+    from empirical_lsm.sim_store import remove_sim
+    from empirical_lsm.catalogue import list_models, remove_artefact
+    from empirical_lsm.model_search import get_available_models
+
+    empirical_lsm.init()
     if args['--sites'] is None:
         sites = get_sites('PLUMBER_ext')
     else:
@@ -42,9 +50,9 @@ def main(args):
 
     if args['all']:
         if args['data']:
-            models = [os.path.basename(f) for f in glob('model_data/*')]
+            models = list_models(kinds=['sim'])
         else:
-            models = [os.path.basename(f) for f in glob('source/models/*')]
+            models = get_available_models()
     else:
         models = args['<model>']
 
@@ -58,8 +66,10 @@ def main(args):
     if len(bad_sims) > 0:
         if args['--delete']:
             for m, s in bad_sims:
-                os.remove('model_data/{m}/{m}_{s}.nc'.format(m=m, s=s))
-                os.remove('source/models/{m}/metrics/{m}_{s}_metrics.csv'.format(m=m, s=s))
+                remove_sim(m, s)
+                metrics_path = 'source/models/{m}/metrics/{m}_{s}_metrics.csv'.format(m=m, s=s)
+                os.remove(metrics_path)
+                remove_artefact(metrics_path)
             summary += " and deleted"
 
         if args['--re-run']:
@@ -78,4 +88,4 @@ def main(args):
 if __name__ == '__main__':
     args = docopt(__doc__)
 
-    main(args)
+    run_script(__file__, main, args, use_daemon=args['--daemon'])
@@ -8,22 +8,24 @@ Github: https://github.com/naught101/empirical_lsm
 Description: Runs all steps of the offline runs/empirical_lsm search page generator
 
 Usage:
-    eval_all.py <model>... [--sites=<sites>] [--run] [--multivariate] [--eval [--plot]] [--rst] [--html] [--rebuild] [--no-mp] [--overwrite] [--no-fix-closure]
+    eval_all.py <model>... [--sites=<sites>] [--run] [--multivariate] [--eval [--plot]] [--rst] [--html] [--rebuild] [--no-mp] [--overwrite] [--no-fix-closure] [--retry-failed] [--profile=<profiler>] [--daemon]
     eval_all.py (-h | --help | --version)
 
 Options:
-    -h, --help       Show this screen and exit.
-    --sites=<sites>  Sites to run the models at [default: PLUMBER_ext]
+    -h, --help            Show this screen and exit.
+    --sites=<sites>       Sites to run the models at [default: PLUMBER_ext]
+    --retry-failed        Only run tasks that failed or were interrupted last time (and their later stages)
+    --profile=<profiler>  Profile each task with cprofile or pyinstrument, and merge the results
+                          into logs/profile/<model>/<model>_report.txt
+    --daemon              Run in the warm daemon if it's running, see scripts/tools/lsm_daemon.py
 """
 
 from docopt import docopt
 
 import subprocess
 
-from empirical_lsm.offline_simulation import run_simulation_mp
-from empirical_lsm.offline_eval import eval_simulation_mp, main_rst_gen_mp
-from empirical_lsm.model_sets import get_model_set
-from empirical_lsm.model_search import model_site_index_rst_mp, model_search_index_rst, get_available_models
+import empirical_lsm
+from empirical_lsm.daemon import run_script
 
 from pals_utils.logging import setup_logger
 logger = setup_logger(__name__, 'logs/eval_all.log')
@@ -31,21 +33,26 @@ logger = setup_logger(__name__, 'logs/eval_all.log')
 
 def eval_simulation_all(names, sites, run=False, multivariate=True, evalu=False,
                         plots=False, rst=False, html=False, rebuild=False, no_mp=False,
-                        overwrite=False, fix_closure=True):
-
-    # All scripts already use multiprocessing
-    if run:
-        for name in names:
-            run_simulation_mp(name, sites, no_mp=no_mp, multivariate=multivariate,
-                              overwrite=overwrite, fix_closure=fix_closure)
-
-    if evalu:
-        for name in names:
-            eval_simulation_mp(name, sites, plots=plots, no_mp=no_mp, fix_closure=fix_closure)
+                        overwrite=False, fix_closure=True, retry_failed=False):
+    # imported here, so --daemon dispatch doesn't pay for them
+    from empirical_lsm.scheduler import run_tasks, STAGES
+    from empirical_lsm import profiling
+    from empirical_lsm.model_search import model_site_index_rst_mp, model_search_index_rst
+
+    # All (model, site) stages share one memory-aware worker pool. Tasks that are
+    # already done (according to the ledger) are skipped.
+    stages = [s for s, selected in zip(STAGES, [run, evalu, rst]) if selected]
+    if len(stages) > 0:
+        stats = run_tasks(names, sites, stages, no_mp=no_mp, multivariate=multivariate,
+                          overwrite=overwrite, fix_closure=fix_closure, plots=plots,
+                          retry_failed=retry_failed)
+        logger.info("Scheduler stats: {s}".format(s=stats))
+
+        if profiling.PROFILE_CONFIG['profiler'] is not None:
+            for name in names:
+                profiling.merge_profiles(name)
 
     if rst:
-        for name in names:
-            main_rst_gen_mp(name, sites, no_mp=no_mp)
         model_site_index_rst_mp(names, rebuild, no_mp=no_mp)
         model_search_index_rst()
 
@@ -54,6 +61,11 @@ def eval_simulation_all(names, sites, run=False, multivariate=True, evalu=False,
 
 
 def main(args):
+    from empirical_lsm import profiling
+    from empirical_lsm.model_sets import get_model_set
+    from empirical_lsm.model_search import get_available_models
+
+    empirical_lsm.init(plots=True)
 
     if args['<model>'] == ['all']:
         names = get_available_models()
@@ -63,6 +75,9 @@ def main(args):
         except:
             names = args['<model>']
 
+    if args['--profile']:
+        profiling.configure(profiler=args['--profile'])
+
     eval_simulation_all(names=names,
                         sites=args['--sites'],
                         run=args['--run'],
@@ -74,7 +89,8 @@ def main(args):
                         rebuild=args['--rebuild'],
                         no_mp=args['--no-mp'],
                         overwrite=args['--overwrite'],
-                        fix_closure=not args['--no-fix-closure']
+                        fix_closure=not args['--no-fix-closure'],
+                        retry_failed=args['--retry-failed']
                         )
 
     return
@@ -83,4 +99,4 @@ def main(args):
 if __name__ == '__main__':
     args = docopt(__doc__)
 
-    main(args)
+    run_script(__file__, main, args, use_daemon=args['--daemon'])
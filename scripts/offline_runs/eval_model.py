@@ -8,22 +8,28 @@ Github: https://github.com/naught101/empirical_lsm
 Description: Evaluates a model (sim or set of sims) and produces rst output with diagnostics
 
 Usage:
-    eval_model.py eval <name> <site> [<file>] [--no-mp] [--plot] [--no-fix-closure] [--no-qc]
-    eval_model.py rst-gen <name> <site> [--no-mp]
+    eval_model.py eval <name> <site> [<file>] [--no-mp] [--plot] [--no-fix-closure] [--no-qc] [--daemon]
+    eval_model.py rst-gen <name> <site> [--no-mp] [--daemon]
 
 Options:
     -h, --help  Show this screen and exit.
+    --daemon    Run in the warm daemon if it's running, see scripts/tools/lsm_daemon.py
 """
 
 from docopt import docopt
 
-from empirical_lsm.offline_eval import eval_simulation_mp, main_rst_gen_mp
+import empirical_lsm
+from empirical_lsm.daemon import run_script
 
 from pals_utils.logging import setup_logger
 logger = setup_logger(__name__, 'logs/eval_model.log')
 
 
 def main(args):
+    # imported here, so --daemon dispatch doesn't pay for them
+    from empirical_lsm.offline_eval import eval_simulation_mp, main_rst_gen_mp
+
+    empirical_lsm.init(plots=True)
     name = args['<name>']
     site = args['<site>']
     sim_file = args['<file>']
@@ -44,4 +50,4 @@ def main(args):
 if __name__ == '__main__':
     args = docopt(__doc__)
 
-    main(args)
+    run_script(__file__, main, args, use_daemon=args['--daemon'])
@@ -20,7 +20,8 @@ import numpy as np
 import xarray as xr
 
 from pals_utils.data import get_flux_data
-from empirical_lsm.data import get_sites, get_sim_nc_path
+from empirical_lsm.data import get_sites
+from empirical_lsm.sim_store import write_sim
 
 from pals_utils.logging import setup_logger
 logger = setup_logger(__name__, 'logs/check_sanity.log')
@@ -72,14 +73,12 @@ def main_import_benchmark(name, site):
         print(s, end=', ', flush=True)
         logger.info("Importing {n} data for {s}", dict(n=name, s=s))
         s_file = 'data/PALS/benchmarks/{n}/{n}_{s}Fluxnet.1.4.nc'.format(n=name, s=s)
-        nc_path = get_sim_nc_path(name, s)
-
         sim_data = xr.open_dataset(s_file)
 
         fix_benchmark(sim_data, name, s)
 
         # WARNING! over writes existing sim!
-        sim_data.to_netcdf(nc_path)
+        write_sim(sim_data, name, s)
 
         sim_data.close()
 
@@ -97,8 +96,6 @@ def main_import_sim(name, site, sim_file):
     # Hacky solution just for PLUMBER benchmarks
     logger.info('Importing {n} data for: {s}'.format(n=name, s=site))
 
-    nc_path = get_sim_nc_path(name, site)
-
     data_vars = ['Qh', 'Qle', 'NEE']
     with xr.open_dataset(sim_file) as ds:
         d_vars = [v for v in data_vars if v in ds]
@@ -142,8 +139,8 @@ def main_import_sim(name, site, sim_file):
             sim_data = sim_data.isel(time=slice(70128))
 
     # WARNING! over writes existing sim!
-    logger.info('Writing to', nc_path)
-    sim_data.to_netcdf(nc_path)
+    nc_path = write_sim(sim_data, name, site)
+    logger.info('Wrote to %s' % nc_path)
 
     sim_data.close()
 
@@ -18,6 +18,7 @@ Options:
 
 from docopt import docopt
 
+import empirical_lsm
 from empirical_lsm.model_sets import get_combo_model_names
 
 from empirical_lsm.offline_simulation import run_simulation_mp
@@ -30,6 +31,7 @@ logger = setup_logger(__name__, 'logs/model_combos.log')
 def main(sites, run=False, multivariate=True, evalu=False, plots=False,
          no_mp=False, overwrite=False, fix_closure=True):
 
+    empirical_lsm.init(plots=plots)
     names = get_combo_model_names()
 
     if args['--run']:
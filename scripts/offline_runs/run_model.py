@@ -8,38 +8,58 @@ Github: https://github.com/naught101/empirical_lsm
 Description: Fits and runs a basic model.
 
 Usage:
-    run_model.py run <name> <site> [--no-mp] [--multivariate] [--overwrite] [--no-fix-closure]
+    run_model.py run <name> <site> [--no-mp] [--multivariate] [--overwrite] [--no-fix-closure] [--instrument] [--profile=<profiler>] [--queue=<queue_dir>] [--daemon]
 
 Options:
-    -h, --help  Show this screen and exit.
+    -h, --help            Show this screen and exit.
+    --instrument          Record per-stage timing and peak memory (see scripts/tools/profile_summary.py)
+    --profile=<profiler>  Profile each task with cprofile or pyinstrument, and merge the results
+                          into logs/profile/<name>/<name>_report.txt
+    --queue=<queue_dir>   Run sites through a shared-directory work queue, see scripts/tools/queue_worker.py
+    --daemon              Run in the warm daemon if it's running, see scripts/tools/lsm_daemon.py
 """
 
 from docopt import docopt
 
-from pals_utils.data import set_config
-
-from empirical_lsm.offline_simulation import run_simulation_mp
+import empirical_lsm
+from empirical_lsm.daemon import run_script
 
 from pals_utils.logging import setup_logger
 logger = setup_logger(__name__, 'logs/run_model.log')
 
-set_config(['vars', 'flux'], ['NEE', 'Qle', 'Qh'])
-
 
 def main(args):
+    # imported here, so --daemon dispatch doesn't pay for them
+    from pals_utils.data import set_config
+    from empirical_lsm.offline_simulation import run_simulation_mp
+    from empirical_lsm import instrument, profiling, executors
+
+    empirical_lsm.init()
+    set_config(['vars', 'flux'], ['NEE', 'Qle', 'Qh'])
+
     name = args['<name>']
     site = args['<site>']
 
+    if args['--instrument']:
+        instrument.configure(enabled=True)
+    if args['--profile']:
+        profiling.configure(profiler=args['--profile'])
+    if args['--queue']:
+        executors.configure(backend='queue', queue_dir=args['--queue'])
+
     run_simulation_mp(name, site,
                       no_mp=args['--no-mp'],
                       multivariate=args['--multivariate'],
                       overwrite=args['--overwrite'],
                       fix_closure=not args['--no-fix-closure'])
 
+    if args['--profile']:
+        profiling.merge_profiles(name)
+
     return
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
 
-    main(args)
+    run_script(__file__, main, args, use_daemon=args['--daemon'])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: benchmark_cluster_sample.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Compares fit time and metrics of subsampled clustering against full-data clustering
+
+Usage:
+    benchmark_cluster_sample.py <site> [--k=<k>] [--sample=<sample>...] [--var=<var>]
+    benchmark_cluster_sample.py (-h | --help | --version)
+
+Options:
+    -h, --help         Show this screen and exit.
+    --k=<k>            Number of clusters [default: 243]
+    --sample=<sample>  Cluster sample sizes (ints) or fractions (floats) [default: 0.1]
+    --var=<var>        Flux variable to fit [default: Qle]
+"""
+
+from docopt import docopt
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime as dt
+
+from sklearn.linear_model import LinearRegression
+
+from pals_utils.data import get_flux_data
+from pals_utils.stats import run_metrics
+
+import empirical_lsm
+from empirical_lsm.data import get_train_test_data
+from empirical_lsm.model_defs import km_regression
+
+from pals_utils.logging import setup_logger
+logger = setup_logger(__name__, 'logs/benchmark_cluster_sample.log')
+
+
+def parse_sample(sample):
+    return float(sample) if '.' in sample else int(sample)
+
+
+def fit_predict_timed(model, data, var):
+    """Fit and predict a model, returning predictions and the fit time in seconds"""
+    train_set = data['train_set']
+    qc_rows = train_set.complete_rows(met_vars=data['met_vars'], flux_vars=[var])
+    X = train_set.frame('met', rows=qc_rows)
+    y = train_set.frame('flux', [var], rows=qc_rows)
+
+    t_start = dt.now()
+    model.fit(X, y)
+    fit_time = (dt.now() - t_start).total_seconds()
+
+    return model.predict(data['met_test']).ravel(), fit_time
+
+
+def main(args):
+    empirical_lsm.init()
+
+    site = args['<site>']
+    var = args['--var']
+    k = int(args['--k'])
+    met_vars = ['SWdown', 'Tair', 'RelHum']
+
+    data = get_train_test_data(site, met_vars, [var], use_names=True)
+    with get_flux_data([site])[site] as ds:
+        obs = ds[var].values.ravel()
+
+    results = {}
+    baseline, baseline_time = fit_predict_timed(km_regression(k, LinearRegression()), data, var)
+    results['full'] = dict(run_metrics(baseline, obs), fit_time=baseline_time, speedup=1.0)
+
+    for sample in args['--sample']:
+        sample = parse_sample(sample)
+        model = km_regression(k, LinearRegression(), cluster_sample=sample)
+        sim, fit_time = fit_predict_timed(model, data, var)
+        metrics = run_metrics(sim, obs)
+        metrics.update(fit_time=fit_time,
+                       speedup=baseline_time / fit_time,
+                       max_abs_diff=np.nanmax(np.abs(sim - baseline)))
+        results['sample=%s' % sample] = metrics
+
+    results = pd.DataFrame(results)
+    print(results.round(4))
+    logger.info("Cluster sample benchmark at {s}:\n{r}".format(s=site, r=results))
+
+    return
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    main(args)
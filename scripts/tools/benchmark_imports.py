@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: benchmark_imports.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Measures the import time of empirical_lsm modules in fresh interpreters
+
+Each module is imported in a new python process, and the median time over the
+repeats is reported, along with the heavy libraries that were pulled in. The
+"eager" row imports every submodule, as "import empirical_lsm" used to.
+
+Usage:
+    benchmark_imports.py [<module>...] [--repeats=<n>]
+    benchmark_imports.py (-h | --help | --version)
+
+Options:
+    -h, --help       Show this screen and exit.
+    <module>         Modules to import [default: the typical worker and CLI imports]
+    --repeats=<n>    Number of fresh interpreters per module [default: 5]
+"""
+
+from docopt import docopt
+
+import sys
+import json
+import subprocess
+
+import numpy as np
+
+from tabulate import tabulate
+
+
+DEFAULT_MODULES = [
+    'empirical_lsm',
+    'empirical_lsm.transforms',
+    'empirical_lsm.clusterregression',
+    'empirical_lsm.models',
+    'empirical_lsm.daemon',
+    'empirical_lsm.offline_simulation',
+]
+
+HEAVY_MODULES = ['pandas', 'xarray', 'sklearn', 'matplotlib', 'seaborn', 'tabulate', 'psutil', 'pals_utils']
+
+EAGER = 'eager'
+
+TIMER = """
+import sys, time, json, importlib
+t_start = time.perf_counter()
+module = importlib.import_module({module!r})
+if {eager!r}:
+    for m in module.__all__:
+        getattr(module, m)
+seconds = time.perf_counter() - t_start
+print(json.dumps(dict(seconds=seconds, loaded=[m for m in {heavy!r} if m in sys.modules])))
+"""
+
+
+def time_import(module, eager=False):
+    """Import time in a fresh interpreter
+
+    :returns: (seconds, list of heavy modules loaded)
+    """
+    code = TIMER.format(module=module, eager=eager, heavy=HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    result = json.loads(out.decode().strip().splitlines()[-1])
+
+    return result['seconds'], result['loaded']
+
+
+def main(args):
+    modules = args['<module>'] if len(args['<module>']) > 0 else DEFAULT_MODULES + [EAGER]
+    repeats = int(args['--repeats'])
+
+    rows = []
+    for module in modules:
+        if module == EAGER:
+            times = [time_import('empirical_lsm', eager=True) for i in range(repeats)]
+        else:
+            times = [time_import(module) for i in range(repeats)]
+        rows.append([module, np.median([t[0] for t in times]), ', '.join(times[-1][1])])
+
+    print(tabulate(rows, headers=['module', 'median seconds', 'heavy modules loaded'], floatfmt='.3f'))
+
+    return
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    main(args)
@@ -43,9 +43,18 @@ def get_cluster_regression_centers(model):
 
 
 def get_cluster_regression_counts(model):
+    if hasattr(model, 'cluster_counts_'):
+        return(model.cluster_counts_)
     return(model.clusterer_.counts_)
 
 
+def get_cluster_regression_merges(model):
+    """Under-populated clusters merged at fit time, as {cluster: merged_into}"""
+    if not hasattr(model, 'cluster_map_'):
+        return {}
+    return {c: t for c, t in enumerate(model.cluster_map_.tolist()) if c != t}
+
+
 def get_cluster_regression_n_iter(model):
     return(model.clusterer_.n_iter_)
 
@@ -71,10 +80,14 @@ def main(args):
     model = get_cluster_regression_model(wrapper)
 
     counts = get_cluster_regression_counts(model)
+    merges = get_cluster_regression_merges(model)
+    if len(merges) > 0:
+        logger.info("{n} under-populated clusters merged at fit time: {m}".format(n=len(merges), m=merges))
+
     count_threshold = 100
-    if (counts < count_threshold).any():
-        bad_clusters = np.where(counts < count_threshold)[0]
-        logger.warning("low counts at clusters", bad_clusters.tolist())
+    bad_clusters = [c for c in np.where(counts < count_threshold)[0] if c not in merges]
+    if len(bad_clusters) > 0:
+        logger.warning("low counts at clusters: {c}".format(c=bad_clusters))
 
     return
 
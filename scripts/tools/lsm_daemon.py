@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: lsm_daemon.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Starts or stops the warm job daemon (see empirical_lsm.daemon)
+
+Start it in the directory the pipeline runs in, then pass --daemon to run_model.py,
+eval_model.py, check_sanity.py or eval_all.py.
+
+Usage:
+    lsm_daemon.py start [<model>...] [--socket=<path>] [--max-jobs=<n>]
+    lsm_daemon.py stop [--socket=<path>]
+    lsm_daemon.py status [--socket=<path>]
+    lsm_daemon.py (-h | --help | --version)
+
+Options:
+    -h, --help       Show this screen and exit.
+    <model>          Models whose training stores are loaded up front
+    --socket=<path>  Daemon socket (default: $EMPIRICAL_LSM_DAEMON or cache/daemon.sock)
+    --max-jobs=<n>   Maximum concurrent jobs [default: 8]
+"""
+
+from docopt import docopt
+
+import empirical_lsm
+from empirical_lsm import daemon
+
+from pals_utils.logging import setup_logger
+logger = setup_logger(None, 'logs/lsm_daemon.log')
+
+
+def main(args):
+    socket_path = args['--socket']
+
+    if args['start']:
+        empirical_lsm.init(plots=True)
+        daemon.configure(max_jobs=int(args['--max-jobs']))
+        daemon.serve(socket_path, preload=args['<model>'])
+    elif args['stop']:
+        if daemon.stop(socket_path):
+            print("Daemon stopped")
+        else:
+            print("No daemon running")
+    elif args['status']:
+        print("Daemon running" if daemon.is_running(socket_path) else "No daemon running")
+
+    return
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    main(args)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: profile_summary.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Summarises per-stage timing and peak memory from the profile log
+
+Runs are profiled when instrumentation is enabled, e.g. with
+EMPIRICAL_LSM_INSTRUMENT=1 or run_model.py --instrument.
+
+Usage:
+    profile_summary.py [<model>...] [--by-site] [--log=<log>]
+    profile_summary.py (-h | --help | --version)
+
+Options:
+    -h, --help   Show this screen and exit.
+    --by-site    Summarise each (model, site) separately
+    --log=<log>  Profile log [default: logs/profile.jsonl]
+"""
+
+from docopt import docopt
+
+import pandas as pd
+
+from tabulate import tabulate
+
+from empirical_lsm.instrument import load_profiles
+
+
+def get_stage_df(records):
+    """One row per (run, stage)"""
+    rows = []
+    for i, r in enumerate(records):
+        for stage, s in r['stages'].items():
+            rows.append(dict(run=i, name=r.get('name'), site=r.get('site'), stage=stage,
+                             seconds=s['seconds'], peak_rss=s['peak_rss'] / 1e9, calls=s['calls']))
+
+    return pd.DataFrame(rows)
+
+
+def summarise(stage_df, by_site=False):
+    """Mean and max seconds, and max peak RSS (GB), per model (and site) and stage"""
+    groups = ['name', 'site', 'stage'] if by_site else ['name', 'stage']
+
+    summary = stage_df.groupby(groups).agg(
+        runs=('run', 'nunique'),
+        mean_seconds=('seconds', 'mean'),
+        max_seconds=('seconds', 'max'),
+        peak_rss_GB=('peak_rss', 'max'))
+
+    return summary
+
+
+def main(args):
+    records = load_profiles(args['--log'])
+    if len(args['<model>']) > 0:
+        records = [r for r in records if r.get('name') in args['<model>']]
+    if len(records) == 0:
+        print("No profile records found")
+        return
+
+    summary = summarise(get_stage_df(records), args['--by-site'])
+
+    print(tabulate(summary.reset_index(), headers='keys', tablefmt='simple', showindex=False, floatfmt='.2f'))
+
+    return
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    main(args)
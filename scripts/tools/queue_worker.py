@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: queue_worker.py
+Author: naught101
+Email: naught101@email.com
+Github: https://github.com/naught101/empirical_lsm
+Description: Runs tasks from a shared-directory work queue (see empirical_lsm.executors)
+
+Start any number of these, on any nodes that share the queue directory and the
+working directory, then run the pipeline with EMPIRICAL_LSM_QUEUE=<queue_dir> or
+--queue=<queue_dir>.
+
+Usage:
+    queue_worker.py <queue_dir> [--idle-timeout=<seconds>] [--max-tasks=<n>]
+    queue_worker.py (-h | --help | --version)
+
+Options:
+    -h, --help                Show this screen and exit.
+    --idle-timeout=<seconds>  Exit after waiting this long for new tasks (default: run forever)
+    --max-tasks=<n>           Exit after running this many tasks
+"""
+
+from docopt import docopt
+
+import empirical_lsm
+from empirical_lsm.executors import run_worker
+
+from pals_utils.logging import setup_logger
+logger = setup_logger(__name__, 'logs/queue_worker.log')
+
+
+def main(args):
+    empirical_lsm.init(plots=True)
+
+    idle_timeout = args['--idle-timeout']
+    max_tasks = args['--max-tasks']
+
+    run_worker(args['<queue_dir>'],
+               idle_timeout=None if idle_timeout is None else float(idle_timeout),
+               max_tasks=None if max_tasks is None else int(max_tasks))
+
+    return
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    main(args)